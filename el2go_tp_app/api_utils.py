@@ -8,25 +8,128 @@ import requests
 import json
 import time
 import base64
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
 
+from requests.adapters import HTTPAdapter
 
+from .blob_index import BlobIndex, object_id
+from .cache import ProvisioningCache
+from .device_index import get_device_index
+from .journal import ProvisioningJournal
+from .metrics import get_metrics
 from .parameters import *
+from .polling import MAX_RATE_LIMIT_RETRIES, Backoff, is_rate_limited, polling_backoff, retry_after
+from .scheduler import PRIORITY_DEFAULT, PRIORITY_DOWNLOAD, PRIORITY_POLL, SingleFlight, get_scheduler
+from .streaming import collect_apdus, stream_secure_objects, write_apdus
 
-header_ = {}
 
+class EL2GOClient:
+    """Keep-alive HTTP client shared by all EL2GO API calls.
 
-def set_header(el2go_api_key: str):
-    global header_
-    header_ = {'accept': 'application/json', 'EL2G-API-Key': el2go_api_key}
+    Every request goes through one ``requests.Session`` so the TCP/TLS connection to the
+    EL2GO backend is reused between the assign, polling and download calls. Requests wait
+    for a token of the scheduler of the API key, shared with the other stations when
+    ``scheduler_socket`` names a running broker; answers with 429 are sent again after the
+    time given by Retry-After.
+    """
 
+    def __init__(self, el2go_api_key: str, pool_size: int = DEFAULT_POOL_SIZE,
+                 max_requests_per_second: float = 0, scheduler_socket: str = "") -> None:
+        self.scheduler = get_scheduler(el2go_api_key, max_requests_per_second, scheduler_socket)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({'accept': 'application/json', 'EL2G-API-Key': el2go_api_key})
 
-def assign_device_to_devicegroup(config: ConfigParameters):
+    # Requests with a lower priority value get their token first, see scheduler.PRIORITY_*
+    def request(self, method: str, url: str, priority: int = PRIORITY_DEFAULT, **kwargs) -> requests.Response:
+        backoff = Backoff(initial=1.0, maximum=30.0)
+        for _ in range(MAX_RATE_LIMIT_RETRIES):
+            self.scheduler.acquire(priority)
+            response = self._send(method, url, **kwargs)
+            if not is_rate_limited(response):
+                return response
+            # a streamed answer holds its pooled connection until it is closed
+            response.close()
+            # every request sharing the scheduler waits, not only this one
+            delay = retry_after(response)
+            self.scheduler.block(delay if delay is not None else backoff.next_delay())
+        self.scheduler.acquire(priority)
+        return self._send(method, url, **kwargs)
+
+    # One timed HTTP call, the rate limiter wait is not part of the span
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        metrics = get_metrics()
+        with metrics.span("http_request", method=method, url=url) as labels:
+            response = self.session.request(method, url, **kwargs)
+            labels["status"] = response.status_code
+        metrics.add("http_requests_total", method=method, status=response.status_code)
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> "EL2GOClient":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+_clients: Dict[str, EL2GOClient] = {}
+_clients_lock = threading.Lock()
+
+
+# Return the process-wide client for the API key of the given configuration
+def get_client(config: ConfigParameters) -> EL2GOClient:
+    with _clients_lock:
+        client = _clients.get(config.el2go_api_key)
+        if client is None:
+            client = EL2GOClient(config.el2go_api_key, config.pool_size, config.max_requests_per_second,
+                                 config.scheduler_socket)
+            _clients[config.el2go_api_key] = client
+        return client
+
+
+# Find the device-group in which a device is currently registered, "" if there is none
+def find_device_group(config: ConfigParameters, device_id: str, client: Optional[EL2GOClient] = None) -> str:
+    return find_device_groups(config, [device_id], client)[device_id]
+
+
+# Find the device-group of every device, the index is rebuilt at most once for all of them. The groups
+# are confirmed live, they are unclaimed as a whole.
+def find_device_groups(config: ConfigParameters, device_ids: List[str],
+                       client: Optional[EL2GOClient] = None) -> Dict[str, str]:
+    client = client or get_client(config)
+    return get_device_index(config).lookup_many_confirmed(client, device_ids)
+
+
+def unclaim_devicegroup(config: ConfigParameters, device_group_id: str, client: Optional[EL2GOClient] = None):
+    client = client or get_client(config)
+    response = client.post(f"{config.el2go_api_url}/products/{config.nc12}/device-groups/"
+                           f"{device_group_id}/unclaim")
+    print_response(response)
+    get_device_index(config).remove_group(device_group_id)
+    return response
+
+
+def assign_device_to_devicegroup(config: ConfigParameters, client: Optional[EL2GOClient] = None,
+                                 journal: Optional[ProvisioningJournal] = None):
+    client = client or get_client(config)
     params = {"deviceIds": [config.device_id]}
-    set_header(config.el2go_api_key)
 
     # assign device to device group operation
-    response = requests.post(f"{config.el2go_api_url}/products/{config.nc12}/device-groups/{config.device_group_id}/devices",
-                             headers=header_, json=params)
+    response = client.post(f"{config.el2go_api_url}/products/{config.nc12}/device-groups/{config.device_group_id}/devices",
+                           json=params)
     if response.status_code == 422:
         print_response(response)
         response_json = json.loads(json.dumps(response.json()))
@@ -36,40 +139,58 @@ def assign_device_to_devicegroup(config: ConfigParameters):
             print("Device is already assigned in another group")
 
             print("Get device-group-id of group in which the device is assigned")
-            device_group_id_to_unassign = ""
-            response = requests.get(f"{config.el2go_api_url}/products/{config.nc12}/device-groups", headers=header_)
-            response_json = json.loads(json.dumps(response.json()))
-            found = False
-            for device_group in response_json["content"]:
-                check_id = device_group["id"]
-                response = requests.get(f"{config.el2go_api_url}/products/{config.nc12}/device-groups/{check_id}/devices",
-                                        headers=header_)
-                response_json = json.loads(json.dumps(response.json()))
-                for device_json in response_json["content"]:
-                    if device_json["device"]["id"] == config.device_id:
-                        device_group_id_to_unassign = check_id
-                        found = True
-                        break
-                if found:
-                    break
-            if found:
+            device_group_id_to_unassign = find_device_group(config, config.device_id, client)
+            if device_group_id_to_unassign:
                 print("Unassign device from devicegroup")
-                params = {"deviceIds": [device_group_id_to_unassign]}
-                response = requests.post(f"{config.el2go_api_url}/products/{config.nc12}/device-groups/"
-                                         f"{device_group_id_to_unassign}/unclaim", headers=header_)
-                print_response(response)
+                response = unclaim_devicegroup(config, device_group_id_to_unassign, client)
 
                 # Try again
                 print("Try to assign device to device-group again")
+    elif 200 <= response.status_code <= 299:
+        get_device_index(config).set_group([config.device_id], config.device_group_id)
+        if journal is not None:
+            journal.record(config.device_id, "assigned", device_group_id=config.device_group_id)
 
     return handle_response(response)
 
 
-# Request the generation status of Secure Objects
-def wait_secure_objects_generated(config: ConfigParameters):
+# Assign a whole lot of devices to the device group with a single request
+def assign_devices_to_devicegroup(config: ConfigParameters, device_ids: List[str],
+                                  client: Optional[EL2GOClient] = None):
+    client = client or get_client(config)
+    url = f"{config.el2go_api_url}/products/{config.nc12}/device-groups/{config.device_group_id}/devices"
+    response = client.post(url, json={"deviceIds": device_ids})
+    if response.status_code == 422:
+        print_response(response)
+        print("Some devices are already assigned in another group")
+
+        # unassign every group holding one of the devices, then assign the whole batch again
+        groups = find_device_groups(config, device_ids, client)
+        for device_group_id in dict.fromkeys(group for group in groups.values() if group):
+            print(f"Unassign devices from devicegroup {device_group_id}")
+            unclaim_devicegroup(config, device_group_id, client)
+
+        print("Try to assign devices to device-group again")
+        response = client.post(url, json={"deviceIds": device_ids})
+
+    if 200 <= response.status_code <= 299:
+        get_device_index(config).set_group(device_ids, config.device_group_id)
+    return handle_response(response)
+
+
+# Status queries of the same device running at the same time share one request
+_status_queries = SingleFlight()
+
+
+# Request the generation status of Secure Objects of one device, STATUS_FAILED if the request fails
+def get_provisioning_state(config: ConfigParameters, device_id: str, client: Optional[EL2GOClient] = None):
+    client = client or get_client(config)
     params = {"hardware-family-type": [config.hardware_family_type]}
-    response = requests.get(f"{config.el2go_api_url}/rtp/devices/{config.device_id}/secure-object-provisionings",
-                            headers=header_, params=params)
+    url = f"{config.el2go_api_url}/rtp/devices/{device_id}/secure-object-provisionings"
+    response = _status_queries.do((config.el2go_api_key, url, config.hardware_family_type),
+                                  lambda: client.get(url, params=params, priority=PRIORITY_POLL))
+    if handle_response(response) == -1:
+        return "STATUS_FAILED"
 
     response_json = json.loads(json.dumps(response.json()))
     for provisioning in response_json["content"]:
@@ -78,40 +199,199 @@ def wait_secure_objects_generated(config: ConfigParameters):
     return "GENERATION_COMPLETED"
 
 
+# Request the generation status of Secure Objects
+def wait_secure_objects_generated(config: ConfigParameters, client: Optional[EL2GOClient] = None):
+    return get_provisioning_state(config, config.device_id, client)
+
+
+# Request the generation status of Secure Objects of every device in the batch, a device whose
+# request fails is STATUS_FAILED and the others are still polled
+def wait_secure_objects_generated_batch(config: ConfigParameters, device_ids: List[str],
+                                        client: Optional[EL2GOClient] = None) -> Dict[str, str]:
+    client = client or get_client(config)
+    statuses = {}
+    for device_id in device_ids:
+        try:
+            statuses[device_id] = get_provisioning_state(config, device_id, client)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Polling the generation status of device {device_id} failed: {e}")
+            statuses[device_id] = "STATUS_FAILED"
+    return statuses
+
+
 # Download Secure Objects
-def download_provisionings(config: ConfigParameters):
-    params = {"productHardwareFamilyType": str(config.hardware_family_type), "deviceIds": [config.device_id]}
-    response = requests.post(f"{config.el2go_api_url}/rtp/device-groups/{config.device_group_id}"
-                             f"/devices/download-provisionings", headers=header_, json=params)
+def download_provisionings(config: ConfigParameters, client: Optional[EL2GOClient] = None):
+    return download_provisionings_batch(config, [config.device_id], client)
+
+
+# Download Secure Objects of several devices with a single request
+def download_provisionings_batch(config: ConfigParameters, device_ids: List[str],
+                                 client: Optional[EL2GOClient] = None):
+    client = client or get_client(config)
+    params = {"productHardwareFamilyType": str(config.hardware_family_type), "deviceIds": device_ids}
+    response = client.post(f"{config.el2go_api_url}/rtp/device-groups/{config.device_group_id}"
+                           f"/devices/download-provisionings", json=params, priority=PRIORITY_DOWNLOAD)
     handle_response(response)
     return response.content.decode("utf-8")
 
 
-def download_secure_objects(config: ConfigParameters):
-    time.sleep(2)
+# Download Secure Objects without reading the whole answer into memory, the caller has to close the response
+def download_provisionings_stream(config: ConfigParameters, device_ids: List[str],
+                                  client: Optional[EL2GOClient] = None) -> requests.Response:
+    client = client or get_client(config)
+    params = {"productHardwareFamilyType": str(config.hardware_family_type), "deviceIds": device_ids}
+    return client.post(f"{config.el2go_api_url}/rtp/device-groups/{config.device_group_id}"
+                       f"/devices/download-provisionings", json=params, stream=True, priority=PRIORITY_DOWNLOAD)
+
+
+# Store the createApdu of every Secure Object of one device to a .bin file and its sidecar index
+def write_secure_objects(device_provisioning: dict, output: str) -> None:
+    index = BlobIndex()
+    apdus = []
+    for position, rtp_provisioning in enumerate(device_provisioning["rtpProvisionings"]):
+        apdus.append(base64.b64decode(rtp_provisioning["apdus"]["createApdu"]["apdu"]))
+        index.add(object_id(rtp_provisioning, position), apdus[-1])
+    # the index goes first, a stale index of an earlier blob never validates the new one
+    index.write(output)
+    with open(output, "wb") as f:
+        for apdu in apdus:
+            f.write(apdu)
+
+
+# Poll the generation status of config.device_id until it is completed, fails, the timeout expires
+# or cancel is set (status CANCELLED)
+def poll_generation_status(config: ConfigParameters, client: Optional[EL2GOClient] = None,
+                           cancel: Optional[threading.Event] = None) -> str:
+    client = client or get_client(config)
+    cancel = cancel or threading.Event()
+    backoff = polling_backoff(config.delay)
+    provisioning_status = "GENERATION_TRIGGERED"
+    start_time = time.time()
+    with get_metrics().span("generation_wait", device_id=config.device_id) as labels:
+        while time.time() < start_time + config.timeout:
+            if cancel.is_set():
+                provisioning_status = "CANCELLED"
+                break
+            provisioning_status = wait_secure_objects_generated(config, client)
+            if provisioning_status == "GENERATION_COMPLETED":
+                break
+            elif provisioning_status == "GENERATION_TRIGGERED":
+                # if generation of Secure Objects is triggered retry with a specific delay until timeout
+                print("Secure Objects generation is triggered, application will try again till timeout")
+            else:
+                # for any other case return an error
+                print("Error in Secure Objects, some objects has state: " + provisioning_status)
+                break
+            cancel.wait(min(backoff.next_delay(), max(0.0, start_time + config.timeout - time.time())))
+        labels["status"] = provisioning_status
+    return provisioning_status
+
+
+# The decoded APDUs are also appended to apdus when a list is given. With a journal the generation
+# status is not polled again for a device whose Secure Objects were generated in an earlier run.
+# Setting cancel stops the polling and skips the download.
+def download_secure_objects(config: ConfigParameters, client: Optional[EL2GOClient] = None,
+                            output: str = "Secure_Objects.bin", apdus: Optional[List[bytes]] = None,
+                            journal: Optional[ProvisioningJournal] = None,
+                            cancel: Optional[threading.Event] = None):
+    client = client or get_client(config)
+    metrics = get_metrics()
+    if journal is not None and journal.is_done(config.device_id, "generated", max_age=config.index_ttl,
+                                               device_group_id=config.device_group_id):
+        provisioning_status = "GENERATION_COMPLETED"
+    else:
+        provisioning_status = poll_generation_status(config, client, cancel)
+        if provisioning_status == "GENERATION_COMPLETED" and journal is not None:
+            journal.record(config.device_id, "generated", device_group_id=config.device_group_id)
+    if cancel is not None and cancel.is_set():
+        return "CANCELLED"
+
+    # If generation status is completed download and store objects to a .bin file
+    if provisioning_status == "GENERATION_COMPLETED":
+        # APDUs are written as they arrive
+        with metrics.span("download", device_id=config.device_id) as labels, \
+                download_provisionings_stream(config, [config.device_id], client) as response:
+            if handle_response(response) == -1:
+                return "DOWNLOAD_FAILED"
+            decoded = stream_secure_objects(response)
+            if apdus is not None:
+                decoded = collect_apdus(decoded, apdus)
+            written = write_apdus(decoded, lambda device_id: output)
+            labels["bytes"] = sum(written.values())
+        metrics.add("download_bytes_total", labels["bytes"])
+        if not written:
+            print(f"Secure Objects of device {config.device_id} are missing from the download")
+            return "DOWNLOAD_FAILED"
+        if journal is not None:
+            journal.record(config.device_id, "downloaded", device_group_id=config.device_group_id,
+                           bytes=labels["bytes"])
+    return provisioning_status
+
+
+# Poll all devices of the batch and download their Secure Objects with one request,
+# every device gets its own Secure_Objects_<device id>.bin in output_dir unless output_path names the file.
+# The SHA-256 and size of every written file are put into digests, keyed by its path.
+def download_secure_objects_batch(config: ConfigParameters, device_ids: List[str], output_dir: str = ".",
+                                  client: Optional[EL2GOClient] = None,
+                                  output_path: Optional[Callable[[str], str]] = None,
+                                  digests: Optional[Dict[str, Tuple[str, int]]] = None) -> Dict[str, str]:
+    client = client or get_client(config)
+    output_path = output_path or (lambda device_id: os.path.join(output_dir, f"Secure_Objects_{device_id}.bin"))
+    statuses = {device_id: "GENERATION_TRIGGERED" for device_id in device_ids}
+    backoff = polling_backoff(config.delay)
     start_time = time.time()
     while time.time() < start_time + config.timeout:
-        provisioning_status = wait_secure_objects_generated(config)
-
-        # If generation status is completed download and store objects to a .bin file
-        if provisioning_status == "GENERATION_COMPLETED":
-            downloaded_provisionings = download_provisionings(config)
-            response_json = json.loads(downloaded_provisionings)
-            with open("Secure_Objects.bin", "wb") as f:
-                for device_provisioning in response_json:
-                    for rtp_provisioning in device_provisioning["rtpProvisionings"]:
-                        f.write(base64.b64decode(rtp_provisioning["apdus"]["createApdu"]["apdu"]))
-            f.close()
+        # only devices still being generated are polled again
+        pending = [device_id for device_id, status in statuses.items() if status == "GENERATION_TRIGGERED"]
+        statuses.update(wait_secure_objects_generated_batch(config, pending, client))
+        pending = [device_id for device_id, status in statuses.items() if status == "GENERATION_TRIGGERED"]
+        if not pending:
             break
-        elif provisioning_status == "GENERATION_TRIGGERED":
-            # if generation of Secure Objects is triggered retry with a specific delay until timeout
-            print("Secure Objects generation is triggered, application will try again till timeout")
-        elif provisioning_status != "GENERATION_TRIGGERED":
-            # for any other case return an error
-            print(f"Error in Secure Objects, some objects has state: " + provisioning_status)
-            break
-        time.sleep(config.delay)
-    return provisioning_status
+        print(f"Secure Objects generation is triggered for {len(pending)} of {len(device_ids)} devices, "
+              f"application will try again till timeout")
+        time.sleep(min(backoff.next_delay(), max(0.0, start_time + config.timeout - time.time())))
+
+    for device_id, status in statuses.items():
+        if status not in ("GENERATION_COMPLETED", "GENERATION_TRIGGERED"):
+            print(f"Error in Secure Objects of device {device_id}, some objects has state: " + status)
+
+    completed = [device_id for device_id, status in statuses.items() if status == "GENERATION_COMPLETED"]
+    if completed:
+        with download_provisionings_stream(config, completed, client) as response:
+            if handle_response(response) == -1:
+                statuses.update({device_id: "DOWNLOAD_FAILED" for device_id in completed})
+                return statuses
+            written = write_apdus(stream_secure_objects(response), output_path, digests)
+        get_metrics().add("download_bytes_total", sum(written.values()))
+        # devices missing from the answer have no file, they are not reported as completed
+        for device_id in completed:
+            if device_id not in written:
+                print(f"Secure Objects of device {device_id} are missing from the download")
+                statuses[device_id] = "DOWNLOAD_FAILED"
+    return statuses
+
+
+# Secure Objects of config.device_id written to output, taken from the cache unless refresh is set.
+# Stages completed in an earlier run according to the journal are skipped.
+def get_device_secure_objects(config: ConfigParameters, output: str, cache: Optional[ProvisioningCache] = None,
+                              refresh: bool = False, client: Optional[EL2GOClient] = None,
+                              apdus: Optional[List[bytes]] = None,
+                              journal: Optional[ProvisioningJournal] = None,
+                              cancel: Optional[threading.Event] = None) -> str:
+    if cache is not None and not refresh and cache.get(config.device_group_id, config.device_id, output):
+        print(f"Secure Objects of device {config.device_id} taken from cache")
+        return "GENERATION_COMPLETED"
+
+    if journal is not None and not refresh and \
+            journal.is_done(config.device_id, "assigned", max_age=config.index_ttl,
+                            device_group_id=config.device_group_id):
+        print(f"Device {config.device_id} has already been assigned to device-group {config.device_group_id}")
+    else:
+        assign_device_to_devicegroup(config, client, journal)
+    status = download_secure_objects(config, client, output, apdus, None if refresh else journal, cancel)
+    if status == "GENERATION_COMPLETED" and cache is not None:
+        cache.put(config.device_group_id, config.device_id, output)
+    return status
 
 
 def print_response(response):
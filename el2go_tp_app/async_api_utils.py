@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""asyncio variant of the EL2GO API calls in api_utils.
+
+One event loop can keep the generation status of hundreds of devices in flight, every
+device is polled by its own coroutine with its own deadline taken from ``config.timeout``.
+Requires the optional ``httpx`` dependency (``pip install el2go_tp_app[async]``).
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+from .api_utils import get_device_index, print_response, write_secure_objects
+from .metrics import get_metrics
+from .parameters import DEFAULT_POOL_SIZE, ConfigParameters
+from .polling import MAX_RATE_LIMIT_RETRIES, Backoff, is_rate_limited, polling_backoff, retry_after
+from .scheduler import PRIORITY_DEFAULT, PRIORITY_DOWNLOAD, PRIORITY_POLL, get_scheduler
+
+
+class AsyncEL2GOClient:
+    """Keep-alive asyncio HTTP client shared by all EL2GO API coroutines.
+
+    Requests take a token of the same scheduler as the blocking client, so priorities, the
+    budget shared through the scheduler broker and the pause after a 429 apply to both.
+    """
+
+    def __init__(self, el2go_api_key: str, pool_size: int = DEFAULT_POOL_SIZE,
+                 max_requests_per_second: float = 0, scheduler_socket: str = "") -> None:
+        if httpx is None:
+            raise ImportError("The asyncio EL2GO client requires httpx, install it with 'pip install el2go_tp_app[async]'")
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.client = httpx.AsyncClient(
+            headers={'accept': 'application/json', 'EL2G-API-Key': el2go_api_key}, limits=limits
+        )
+        self.scheduler = get_scheduler(el2go_api_key, max_requests_per_second, scheduler_socket)
+        # the scheduler blocks, it waits in these threads; no more requests than connections can
+        # wait for a token, the others keep their order of priority in the scheduler
+        self._scheduler_threads = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="el2go-scheduler")
+
+    async def _acquire(self, priority: int) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._scheduler_threads, self.scheduler.acquire, priority)
+
+    # Requests with a lower priority value get their token first, see scheduler.PRIORITY_*
+    async def request(self, method: str, url: str, priority: int = PRIORITY_DEFAULT, **kwargs) -> "httpx.Response":
+        backoff = Backoff(initial=1.0, maximum=30.0)
+        for _ in range(MAX_RATE_LIMIT_RETRIES):
+            await self._acquire(priority)
+            response = await self._send(method, url, **kwargs)
+            if not is_rate_limited(response):
+                return response
+            # every request sharing the scheduler waits, not only this one
+            delay = retry_after(response)
+            self.scheduler.block(delay if delay is not None else backoff.next_delay())
+        await self._acquire(priority)
+        return await self._send(method, url, **kwargs)
+
+    async def _send(self, method: str, url: str, **kwargs) -> "httpx.Response":
+        metrics = get_metrics()
+        with metrics.span("http_request", method=method, url=url) as labels:
+            response = await self.client.request(method, url, **kwargs)
+            labels["status"] = response.status_code
+        metrics.add("http_requests_total", method=method, status=response.status_code)
+        return response
+
+    async def get(self, url: str, **kwargs) -> "httpx.Response":
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> "httpx.Response":
+        return await self.request("POST", url, **kwargs)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+        self._scheduler_threads.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncEL2GOClient":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+
+def handle_response(response) -> bool:
+    if response.status_code < 200 or response.status_code > 299:
+        print(f"API call {response.url} failed with {response.status_code}, {response.content.decode('utf-8')}")
+        return False
+    return True
+
+
+# Device-group of every device, "" for devices which are not registered. The groups are confirmed
+# live, they are unclaimed as a whole.
+async def find_device_groups(config: ConfigParameters, device_ids: List[str],
+                             client: AsyncEL2GOClient) -> Dict[str, str]:
+    return await get_device_index(config).lookup_many_confirmed_async(client, device_ids)
+
+
+async def assign_devices_to_devicegroup(config: ConfigParameters, device_ids: List[str],
+                                        client: AsyncEL2GOClient) -> bool:
+    url = f"{config.el2go_api_url}/products/{config.nc12}/device-groups/{config.device_group_id}/devices"
+    response = await client.post(url, json={"deviceIds": device_ids})
+    if response.status_code == 422:
+        print_response(response)
+        print("Some devices are already assigned in another group")
+
+        groups = await find_device_groups(config, device_ids, client)
+        for device_group_id in {group for group in groups.values() if group}:
+            print(f"Unassign devices from devicegroup {device_group_id}")
+            print_response(await client.post(f"{config.el2go_api_url}/products/{config.nc12}/device-groups/"
+                                             f"{device_group_id}/unclaim"))
+            get_device_index(config).remove_group(device_group_id)
+
+        print("Try to assign devices to device-group again")
+        response = await client.post(url, json={"deviceIds": device_ids})
+
+    if not handle_response(response):
+        return False
+    get_device_index(config).set_group(device_ids, config.device_group_id)
+    return True
+
+
+async def assign_device_to_devicegroup(config: ConfigParameters, client: AsyncEL2GOClient) -> bool:
+    return await assign_devices_to_devicegroup(config, [config.device_id], client)
+
+
+# Request the generation status of Secure Objects of one device, STATUS_FAILED if the request fails
+async def wait_secure_objects_generated(config: ConfigParameters, client: AsyncEL2GOClient,
+                                        device_id: Optional[str] = None) -> str:
+    device_id = device_id or config.device_id
+    params = {"hardware-family-type": [config.hardware_family_type]}
+    response = await client.get(f"{config.el2go_api_url}/rtp/devices/{device_id}/secure-object-provisionings",
+                                params=params, priority=PRIORITY_POLL)
+    if not handle_response(response):
+        return "STATUS_FAILED"
+    for provisioning in response.json()["content"]:
+        if provisioning["provisioningState"] != "GENERATION_COMPLETED":
+            return provisioning["provisioningState"]
+    return "GENERATION_COMPLETED"
+
+
+# Download Secure Objects of the given devices with a single request, None if the request fails
+async def download_provisionings(config: ConfigParameters, client: AsyncEL2GOClient,
+                                 device_ids: Optional[List[str]] = None) -> Optional[list]:
+    params = {
+        "productHardwareFamilyType": str(config.hardware_family_type),
+        "deviceIds": device_ids or [config.device_id],
+    }
+    response = await client.post(f"{config.el2go_api_url}/rtp/device-groups/{config.device_group_id}"
+                                 f"/devices/download-provisionings", json=params, priority=PRIORITY_DOWNLOAD)
+    if not handle_response(response):
+        return None
+    return response.json()
+
+
+# Poll one device until its generation leaves the triggered state
+async def poll_generation_status(config: ConfigParameters, device_id: str, client: AsyncEL2GOClient) -> str:
+    backoff = polling_backoff(config.delay)
+    while True:
+        status = await wait_secure_objects_generated(config, client, device_id)
+        if status != "GENERATION_TRIGGERED":
+            return status
+        await asyncio.sleep(backoff.next_delay())
+
+
+# Poll every device concurrently, each device gives up after config.timeout seconds
+async def wait_secure_objects_generated_many(config: ConfigParameters, device_ids: List[str],
+                                             client: AsyncEL2GOClient) -> Dict[str, str]:
+    async def poll_with_deadline(device_id: str) -> str:
+        try:
+            return await asyncio.wait_for(poll_generation_status(config, device_id, client), config.timeout)
+        except asyncio.TimeoutError:
+            return "GENERATION_TRIGGERED"
+        except Exception as e:
+            # one failing device does not stop the polling of the others
+            print(f"Polling the generation status of device {device_id} failed: {e}")
+            return "STATUS_FAILED"
+
+    statuses = await asyncio.gather(*[poll_with_deadline(device_id) for device_id in device_ids])
+    return dict(zip(device_ids, statuses))
+
+
+async def download_secure_objects_many(config: ConfigParameters, device_ids: List[str], output_dir: str = ".",
+                                       client: Optional[AsyncEL2GOClient] = None) -> Dict[str, str]:
+    if client is None:
+        async with AsyncEL2GOClient(config.el2go_api_key, config.pool_size, config.max_requests_per_second,
+                                    config.scheduler_socket) as client:
+            return await download_secure_objects_many(config, device_ids, output_dir, client)
+
+    statuses = await wait_secure_objects_generated_many(config, device_ids, client)
+    for device_id, status in statuses.items():
+        if status == "GENERATION_TRIGGERED":
+            print(f"Secure Objects generation timeout for device {device_id}")
+        elif status != "GENERATION_COMPLETED":
+            print(f"Error in Secure Objects of device {device_id}, some objects has state: " + status)
+
+    completed = [device_id for device_id, status in statuses.items() if status == "GENERATION_COMPLETED"]
+    if completed:
+        response_json = await download_provisionings(config, client, completed)
+        written = set()
+        for device_provisioning in response_json or []:
+            device_id = str(device_provisioning["deviceId"])
+            write_secure_objects(device_provisioning, os.path.join(output_dir, f"Secure_Objects_{device_id}.bin"))
+            written.add(device_id)
+        # devices missing from the answer have no file, they are not reported as completed
+        for device_id in completed:
+            if device_id not in written:
+                print(f"Secure Objects of device {device_id} are missing from the download")
+                statuses[device_id] = "DOWNLOAD_FAILED"
+    return statuses
+
+
+async def download_secure_objects(config: ConfigParameters, client: AsyncEL2GOClient,
+                                  output: str = "Secure_Objects.bin") -> str:
+    status = (await wait_secure_objects_generated_many(config, [config.device_id], client))[config.device_id]
+    if status == "GENERATION_COMPLETED":
+        response_json = await download_provisionings(config, client)
+        device_provisionings = [device_provisioning for device_provisioning in response_json or []
+                                if str(device_provisioning["deviceId"]) == str(config.device_id)]
+        if not device_provisionings:
+            print(f"Secure Objects of device {config.device_id} are missing from the download")
+            return "DOWNLOAD_FAILED"
+        write_secure_objects(device_provisionings[0], output)
+    elif status != "GENERATION_TRIGGERED":
+        print("Error in Secure Objects, some objects has state: " + status)
+    return status
+
+
+# Blocking entry point for callers without an event loop
+def run_download_secure_objects_many(config: ConfigParameters, device_ids: List[str],
+                                     output_dir: str = ".") -> Dict[str, str]:
+    return asyncio.run(download_secure_objects_many(config, device_ids, output_dir))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Provisioning of several boards in parallel."""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional
+
+from spsdk.mboot.scanner import get_mboot_interface
+
+from .el2go_tp_app import EL2GOMboot
+from .journal import ProvisioningJournal
+from .parameters import ConfigParameters
+from .pipeline import DeviceResult, provision
+from .probe import ProbeResult, probe
+
+logger = logging.getLogger(__name__)
+
+
+def interface_name(interface_args: Dict[str, str]) -> str:
+    return ", ".join(f"{key}={value}" for key, value in interface_args.items())
+
+
+# Open one board with the short probe timeout (ms) and check it is ready for provisioning
+def probe_interface(interface_args: Dict[str, str], timeout: int, fw_version: Optional[int] = None,
+                    command_timeouts: Optional[Dict[int, Optional[int]]] = None) -> ProbeResult:
+    try:
+        interface = get_mboot_interface(timeout=timeout, **interface_args)
+        with EL2GOMboot(interface, command_timeouts=command_timeouts) as mboot:
+            return probe(mboot, interface_name(interface_args), fw_version)
+    except Exception as e:
+        logger.debug(f"Probing {interface_name(interface_args)} failed", exc_info=True)
+        return ProbeResult(interface=interface_name(interface_args), message=str(e))
+
+
+# Probe all given boards at the same time, results are in the order of the interfaces
+def probe_interfaces(interfaces: List[Dict[str, str]], timeout: int, fw_version: Optional[int] = None,
+                     workers: Optional[int] = None,
+                     command_timeouts: Optional[Dict[int, Optional[int]]] = None) -> List[ProbeResult]:
+    if not interfaces:
+        return []
+    with ThreadPoolExecutor(max_workers=workers or len(interfaces)) as executor:
+        return list(executor.map(
+            lambda interface_args: probe_interface(interface_args, timeout, fw_version, command_timeouts), interfaces
+        ))
+
+
+# Open one board and run the complete provisioning flow on it. With probe_timeout set the board is
+# probed first and rejected before any EL2GO API call when it is not ready.
+def provision_device(interface_args: Dict[str, str], config: ConfigParameters, address: int,
+                     dry_run: bool, timeout: int, store_dir: Optional[str] = None,
+                     journal: Optional[ProvisioningJournal] = None, probe_timeout: int = 0,
+                     fw_version: Optional[int] = None,
+                     command_timeouts: Optional[Dict[int, Optional[int]]] = None) -> DeviceResult:
+    if probe_timeout:
+        probe_result = probe_interface(interface_args, probe_timeout, fw_version, command_timeouts)
+        if not probe_result.ready:
+            return DeviceResult(interface=interface_name(interface_args), elapsed=probe_result.elapsed,
+                                message=f"Pre-flight probe failed: {probe_result.message}")
+    try:
+        interface = get_mboot_interface(timeout=timeout, **interface_args)
+        with EL2GOMboot(interface, command_timeouts=command_timeouts) as mboot:
+            return provision(mboot, config, address, dry_run, interface_name(interface_args), store_dir,
+                             journal=journal)
+    except Exception as e:
+        logger.debug(f"Opening {interface_name(interface_args)} failed", exc_info=True)
+        return DeviceResult(interface=interface_name(interface_args), message=str(e))
+
+
+# Provision all given boards on a worker pool, results are yielded as soon as each board finishes
+def provision_devices(interfaces: List[Dict[str, str]], config: ConfigParameters, address: int,
+                      dry_run: bool, timeout: int, workers: Optional[int] = None,
+                      store_dir: Optional[str] = None,
+                      journal: Optional[ProvisioningJournal] = None, probe_timeout: int = 0,
+                      fw_version: Optional[int] = None,
+                      command_timeouts: Optional[Dict[int, Optional[int]]] = None) -> Iterator[DeviceResult]:
+    workers = workers or len(interfaces)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(provision_device, interface_args, config, address, dry_run, timeout, store_dir, journal,
+                            probe_timeout, fw_version, command_timeouts)
+            for interface_args in interfaces
+        ]
+        for future in as_completed(futures):
+            yield future.result()
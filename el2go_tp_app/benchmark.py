@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Throughput benchmark of the EL2GO API flow against the local mock backend.
+
+Run with ``python -m el2go_tp_app.benchmark``; every mode downloads the Secure Objects of
+its own set of devices and reports devices per minute, per-device latency and peak memory.
+With ``--baseline`` the results of an earlier ``--json`` run are the reference, the run fails
+when the throughput or the p99 latency of a mode got worse by more than ``--margin``.
+"""
+
+import contextlib
+import copy
+import io
+import json
+import math
+import os
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterator, List
+
+import click
+
+from .api_utils import assign_devices_to_devicegroup, download_secure_objects_batch, get_device_secure_objects
+from .mock_backend import MockBackend, MockEL2GOServer
+from .parameters import ConfigParameters
+
+MODES = ["single", "batch", "concurrent"]
+# Fraction by which a result may be worse than its baseline before it counts as a regression
+DEFAULT_MARGIN = 0.2
+
+
+@dataclass
+class BenchmarkResult:
+    mode: str
+    devices: int
+    succeeded: int
+    elapsed: float
+    devices_per_minute: float
+    p50_latency: float
+    p99_latency: float
+    peak_memory: int
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def __str__(self) -> str:
+        return (f"{self.mode:<11} {self.succeeded:>4}/{self.devices:<4} {self.devices_per_minute:>10.1f} dev/min  "
+                f"p50 {self.p50_latency * 1000:>8.1f} ms  p99 {self.p99_latency * 1000:>8.1f} ms  "
+                f"peak {self.peak_memory / 1024:>8.1f} KiB")
+
+
+# Nearest-rank percentile of the latencies
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def benchmark_config(url: str, timeout: int = 60) -> ConfigParameters:
+    config = ConfigParameters()
+    config.el2go_api_url = url
+    config.el2go_api_key = "benchmark"
+    config.nc12 = "935000000000"
+    config.device_group_id = "1"
+    config.hardware_family_type = "RW61x"
+    config.timeout = timeout
+    config.delay = 1
+    return config
+
+
+# Download the Secure Objects of one device the way get-secure-objects does, returns (success, latency)
+def run_single(config: ConfigParameters, device_id: str, output_dir: str):
+    start = time.perf_counter()
+    config = copy.copy(config)
+    config.device_id = device_id
+    try:
+        status = get_device_secure_objects(config, os.path.join(output_dir, f"{device_id}.bin"))
+    except Exception:
+        status = "FAILED"
+    return status == "GENERATION_COMPLETED", time.perf_counter() - start
+
+
+def run_mode(mode: str, config: ConfigParameters, device_ids: List[str], output_dir: str,
+             workers: int = 8, batch_size: int = 50) -> BenchmarkResult:
+    latencies: List[float] = []
+    succeeded = 0
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if mode == "single":
+        for device_id in device_ids:
+            success, latency = run_single(config, device_id, output_dir)
+            succeeded += success
+            latencies.append(latency)
+    elif mode == "concurrent":
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for success, latency in executor.map(lambda device_id: run_single(config, device_id, output_dir),
+                                                 device_ids):
+                succeeded += success
+                latencies.append(latency)
+    elif mode == "batch":
+        for offset in range(0, len(device_ids), batch_size):
+            lot = device_ids[offset:offset + batch_size]
+            lot_start = time.perf_counter()
+            try:
+                assign_devices_to_devicegroup(config, lot)
+                statuses = download_secure_objects_batch(config, lot, output_dir)
+            except Exception:
+                statuses = {}
+            # every device of a lot is ready when the whole lot is
+            latencies += [time.perf_counter() - lot_start] * len(lot)
+            succeeded += len([status for status in statuses.values() if status == "GENERATION_COMPLETED"])
+    else:
+        raise ValueError(f"Unknown benchmark mode '{mode}', available: {', '.join(MODES)}")
+    elapsed = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return BenchmarkResult(
+        mode=mode,
+        devices=len(device_ids),
+        succeeded=succeeded,
+        elapsed=elapsed,
+        devices_per_minute=succeeded / elapsed * 60 if elapsed else 0.0,
+        p50_latency=percentile(latencies, 50),
+        p99_latency=percentile(latencies, 99),
+        peak_memory=peak_memory,
+    )
+
+
+# Regressions of the results against the baseline results (BenchmarkResult.to_dict of an earlier run),
+# modes missing from the baseline are not compared
+def find_regressions(results: List[BenchmarkResult], baseline: List[Dict],
+                     margin: float = DEFAULT_MARGIN) -> List[str]:
+    references = {reference["mode"]: reference for reference in baseline}
+    regressions = []
+    for result in results:
+        reference = references.get(result.mode)
+        if reference is None:
+            continue
+        if result.devices_per_minute < reference["devices_per_minute"] * (1 - margin):
+            regressions.append(f"{result.mode}: {result.devices_per_minute:.1f} dev/min, baseline "
+                               f"{reference['devices_per_minute']:.1f} dev/min")
+        if result.p99_latency > reference["p99_latency"] * (1 + margin):
+            regressions.append(f"{result.mode}: p99 {result.p99_latency * 1000:.1f} ms, baseline "
+                               f"{reference['p99_latency'] * 1000:.1f} ms")
+    return regressions
+
+
+# The device index of the simulated devices is kept apart from the one of the real backend
+@contextlib.contextmanager
+def app_home(path: str) -> Iterator[None]:
+    previous = os.environ.get("EL2GO_TP_APP_HOME")
+    os.environ["EL2GO_TP_APP_HOME"] = path
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ["EL2GO_TP_APP_HOME"]
+        else:
+            os.environ["EL2GO_TP_APP_HOME"] = previous
+
+
+def run_benchmark(modes: List[str], devices: int, backend: MockBackend, workers: int = 8,
+                  batch_size: int = 50, timeout: int = 60) -> List[BenchmarkResult]:
+    """Run every mode against a fresh mock server, each mode with its own devices."""
+    results = []
+    with MockEL2GOServer(backend) as server, tempfile.TemporaryDirectory() as output_dir, \
+            app_home(os.path.join(output_dir, "home")), contextlib.redirect_stdout(io.StringIO()):
+        config = benchmark_config(server.url, timeout)
+        config.pool_size = max(workers, config.pool_size)
+        for index, mode in enumerate(modes):
+            device_ids = [str(index * devices + number + 1) for number in range(devices)]
+            results.append(run_mode(mode, config, device_ids, output_dir, workers, batch_size))
+    return results
+
+
+@click.command()
+@click.option("-m", "--mode", "modes", type=click.Choice(MODES), multiple=True, help="Mode to run, default all.")
+@click.option("-n", "--devices", type=int, default=50, help="Number of devices per mode.")
+@click.option("-w", "--workers", type=int, default=8, help="Threads of the concurrent mode.")
+@click.option("-b", "--batch-size", type=int, default=50, help="Devices per request of the batch mode.")
+@click.option("--generation-latency", type=float, default=0.0, help="Seconds until Secure Objects are generated.")
+@click.option("--request-latency", type=float, default=0.0, help="Seconds added to every API request.")
+@click.option("--error-rate", type=float, default=0.0, help="Probability of an API request failing with 500.")
+@click.option("--payload-size", type=int, default=1024, help="Bytes of Secure Objects per device.")
+@click.option("-j", "--json", "use_json", is_flag=True, default=False, help="Print the results as JSON.")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="JSON results of an earlier run, the run fails when a mode got worse.")
+@click.option("--margin", type=float, default=DEFAULT_MARGIN, show_default=True,
+              help="Fraction by which throughput and p99 latency may be worse than the baseline.")
+def main(modes: List[str], devices: int, workers: int, batch_size: int, generation_latency: float,
+         request_latency: float, error_rate: float, payload_size: int, use_json: bool,
+         baseline: str, margin: float) -> None:
+    """Measure the EL2GO API flow against a local mock backend."""
+    backend = MockBackend(generation_latency=generation_latency, request_latency=request_latency,
+                          error_rate=error_rate, payload_size=payload_size, api_key="benchmark")
+    results = run_benchmark(list(modes) or MODES, devices, backend, workers, batch_size)
+    if use_json:
+        click.echo(json.dumps([result.to_dict() for result in results], indent=4))
+    else:
+        for result in results:
+            click.echo(str(result))
+    if baseline:
+        with open(baseline, "r") as f:
+            regressions = find_regressions(results, json.load(f), margin)
+        for regression in regressions:
+            click.echo(f"REGRESSION: {regression}", err=True)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
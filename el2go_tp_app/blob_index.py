@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Sidecar index of Secure Object blobs.
+
+A blob stays the plain concatenation of the createApdu buffers the provisioning firmware
+loads. Next to it, ``<blob>.idx.json`` records the offset, length, object ID and SHA-256 of
+every Secure Object, so a truncated or damaged blob is rejected on the host before it is
+written to a board.
+"""
+
+import hashlib
+import json
+import os
+from typing import List, Optional, Union
+
+from .store import AtomicWriter
+
+INDEX_SUFFIX = ".idx.json"
+INDEX_VERSION = 1
+
+
+def index_path(blob_path: str) -> str:
+    return blob_path + INDEX_SUFFIX
+
+
+# Identifier of a downloaded Secure Object, its position in the download when the answer carries none
+def object_id(rtp_provisioning: dict, position: int) -> str:
+    secure_object = rtp_provisioning.get("secureObject") or {}
+    return str(secure_object.get("id", rtp_provisioning.get("provisioningId", position)))
+
+
+class BlobIndex:
+    """Layout of one blob, built object by object while the blob is written."""
+
+    def __init__(self) -> None:
+        self.objects: List[dict] = []
+        self.size = 0
+
+    def add(self, identifier: str, data: Union[bytes, bytearray, memoryview]) -> None:
+        self.objects.append({
+            "offset": self.size,
+            "length": len(data),
+            "object_id": identifier,
+            "sha256": hashlib.sha256(data).hexdigest(),
+        })
+        self.size += len(data)
+
+    def to_dict(self) -> dict:
+        return {"version": INDEX_VERSION, "size": self.size, "objects": self.objects}
+
+    def write(self, blob_path: str) -> None:
+        with AtomicWriter(index_path(blob_path)) as writer:
+            writer.write(json.dumps(self.to_dict(), separators=(",", ":")).encode("utf-8"))
+
+
+# Index of a blob, None for blobs written without one
+def load_index(blob_path: str) -> Optional[dict]:
+    try:
+        with open(index_path(blob_path), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Return the reason the blob doesn't match its index, None if it matches
+def validate_blob(data: Union[bytes, bytearray, memoryview], index: dict) -> Optional[str]:
+    view = memoryview(data).cast("B")
+    if index.get("version") != INDEX_VERSION:
+        return f"Unsupported index version {index.get('version')}"
+    if len(view) != index["size"]:
+        return f"Blob has {len(view)} bytes, {index['size']} expected"
+    end = 0
+    for entry in index["objects"]:
+        if entry["offset"] != end:
+            return f"Secure Object {entry['object_id']} starts at {entry['offset']} instead of {end}"
+        end = entry["offset"] + entry["length"]
+        if end > len(view):
+            return f"Secure Object {entry['object_id']} is truncated"
+        if hashlib.sha256(view[entry["offset"]:end]).hexdigest() != entry["sha256"]:
+            return f"Secure Object {entry['object_id']} at offset {entry['offset']} is damaged"
+    if end != len(view):
+        return f"{len(view) - end} bytes after the last Secure Object"
+    return None
+
+
+def check_blob_file(blob_path: str, data: Optional[Union[bytes, bytearray]] = None,
+                    required: bool = False) -> Optional[str]:
+    """Validate a blob file, or its content already read into data, against its sidecar index.
+
+    Returns the reason the blob is invalid, None if it is valid. A blob without an index is
+    valid unless the index is required, e.g. for store entries recorded with one.
+    """
+    try:
+        index = load_index(blob_path)
+    except (OSError, ValueError) as e:
+        return f"Index {index_path(blob_path)} is unreadable: {e}"
+    if index is None:
+        return f"Index {index_path(blob_path)} is missing" if required else None
+    if data is None:
+        with open(blob_path, "rb") as f:
+            data = f.read()
+    try:
+        return validate_blob(data, index)
+    except (KeyError, TypeError) as e:
+        return f"Index {index_path(blob_path)} is malformed: {e}"
+
+
+# Copy the index of a blob along with it, a stale index of the destination is removed
+def copy_index(source_blob: str, destination_blob: str) -> None:
+    try:
+        with open(index_path(source_blob), "rb") as f:
+            content = f.read()
+    except FileNotFoundError:
+        remove_index(destination_blob)
+        return
+    with AtomicWriter(index_path(destination_blob)) as writer:
+        writer.write(content)
+
+
+def remove_index(blob_path: str) -> None:
+    try:
+        os.remove(index_path(blob_path))
+    except FileNotFoundError:
+        pass
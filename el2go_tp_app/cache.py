@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Local cache of downloaded provisionings."""
+
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+from .blob_index import copy_index, remove_index
+from .parameters import DEFAULT_CACHE_MAX_AGE, DEFAULT_CACHE_MAX_SIZE, ConfigParameters, app_data_dir
+from .store import AtomicWriter
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks used when copying cached blobs
+COPY_BLOCK_SIZE = 64 * 1024
+
+
+# Copy a blob together with its sidecar index
+def copy_file(source: str, destination: str) -> None:
+    # the index goes first, a blob is never left next to a missing or stale index
+    copy_index(source, destination)
+    with open(source, "rb") as f, AtomicWriter(destination) as writer:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b""):
+            writer.write(block)
+
+
+# Remove a blob and its index which may already have been removed by another process sharing the cache
+def remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    remove_index(path)
+
+
+class ProvisioningCache:
+    """Downloaded APDU payloads keyed by device-group and device UUID.
+
+    A board failing after the download (e.g. in close_device) gets its Secure Objects from
+    the cache on the next run instead of the EL2GO API. Entries older than ``max_age`` seconds
+    are not used; when the cache grows over ``max_size`` bytes the least recently used entries
+    are evicted.
+    """
+
+    def __init__(self, root: Optional[str] = None, max_age: int = DEFAULT_CACHE_MAX_AGE,
+                 max_size: int = DEFAULT_CACHE_MAX_SIZE) -> None:
+        self.root = root or os.path.join(app_data_dir(), "cache")
+        self.max_age = max_age
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, config: ConfigParameters) -> "ProvisioningCache":
+        return cls(max_age=config.cache_max_age, max_size=config.cache_max_size)
+
+    def entry_path(self, device_group_id: str, device_id: str) -> str:
+        return os.path.join(self.root, str(device_group_id), f"{device_id}.bin")
+
+    def _is_fresh(self, path: str) -> bool:
+        return os.path.isfile(path) and time.time() - os.path.getmtime(path) <= self.max_age
+
+    # Copy the cached payload to output, returns False on a cache miss. Nothing is copied when
+    # output is the entry itself.
+    def get(self, device_group_id: str, device_id: str, output: str) -> bool:
+        path = self.entry_path(device_group_id, device_id)
+        if not self._is_fresh(path):
+            return False
+        try:
+            if os.path.abspath(output) != os.path.abspath(path):
+                copy_file(path, output)
+            # access time drives the size based eviction, the modification time the age
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except FileNotFoundError:
+            return False
+        return True
+
+    # Record source as the entry of the device, source may already be written to entry_path
+    def put(self, device_group_id: str, device_id: str, source: str) -> None:
+        path = self.entry_path(device_group_id, device_id)
+        if os.path.abspath(source) != os.path.abspath(path):
+            copy_file(source, path)
+        # same clock as the access time set by get, the new entry is the most recently used one
+        now = time.time()
+        os.utime(path, (now, now))
+        self.evict()
+
+    def invalidate(self, device_group_id: str, device_id: str) -> None:
+        remove_file(self.entry_path(device_group_id, device_id))
+
+    def _entries(self) -> List[Tuple[str, os.stat_result]]:
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".bin"):
+                    path = os.path.join(directory, name)
+                    try:
+                        entries.append((path, os.stat(path)))
+                    except FileNotFoundError:
+                        pass
+        return entries
+
+    # Remove entries older than max_age, then the least recently used ones until the cache fits max_size
+    def evict(self) -> None:
+        now = time.time()
+        entries = []
+        for path, stat in self._entries():
+            if now - stat.st_mtime > self.max_age:
+                logger.debug(f"Evicting expired cache entry {path}")
+                remove_file(path)
+            else:
+                entries.append((path, stat))
+
+        total_size = sum(stat.st_size for _, stat in entries)
+        for path, stat in sorted(entries, key=lambda entry: entry[1].st_atime):
+            if total_size <= self.max_size:
+                break
+            logger.debug(f"Evicting cache entry {path} to fit the cache size")
+            remove_file(path)
+            total_size -= stat.st_size
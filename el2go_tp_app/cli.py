@@ -6,8 +6,10 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 """Console script for el2go_tp_app."""
+import json
 import logging
 import sys
+from typing import List, Optional
 
 import click
 
@@ -24,10 +26,15 @@ from spsdk.apps.utils.common_cli_options import (
     is_click_help
 )
 
-from .el2go_tp_app import EL2GOMboot, EL2GOStatus
-from spsdk.mboot.mcuboot import McuBoot
-from spsdk.mboot.scanner import get_mboot_interface
-from .api_utils import *
+# The mboot stack, requests and the EL2GO flow are imported inside the subcommands using them,
+# so --help and the light subcommands don't pay for the whole dependency graph at startup
+from .metrics import get_metrics
+from .parameters import DEFAULT_PROBE_TIMEOUT, ConfigParameters
+from .session import PersistentInterface, available_commands, open_server, serve_lines, serve_socket
+
+
+# Subcommands which open their own interfaces instead of the one selected on the group
+COMMANDS_WITHOUT_INTERFACE = ["provision-batch", "watch", "probe", "prestage", "refresh-index", "journal", "scheduler", "verify"]
 
 
 # This is pretty much a carbon copy of blhost
@@ -38,6 +45,35 @@ from .api_utils import *
 @isp_interfaces(uart=True, usb=True, lpcusbsio=True)
 # this one is for simple --verbose/--debug/--help/--version options
 @spsdk_apps_common_options
+@click.option("--metrics-file", type=str, default=None, help="Append the timing of every stage to this JSONL file.")
+@click.option(
+    "--prometheus-file", type=str, default=None, help="Write stage timings to this Prometheus textfile."
+)
+@click.option(
+    "--journal",
+    "journal_file",
+    type=str,
+    default=None,
+    help="Journal of the provisioning stages used to resume interrupted runs, default in the application data directory.",
+)
+@click.option(
+    "--sim",
+    type=str,
+    default=None,
+    help="Use a simulated board instead of a real interface, PARAMS e.g. 'uuid=0x1234,provision_latency=2'.",
+)
+@click.option(
+    "--version-timeout",
+    type=int,
+    default=None,
+    help="Milliseconds to wait for the firmware version, default 1000 or the --timeout of the interface if shorter.",
+)
+@click.option(
+    "--provision-timeout",
+    type=int,
+    default=None,
+    help="Milliseconds to wait for the end of provisioning, at most the --timeout of the interface.",
+)
 @click.pass_context
 def main(
     ctx: click.Context,
@@ -47,6 +83,12 @@ def main(
     use_json: bool,
     log_level: int,
     timeout: int,
+    metrics_file: Optional[str],
+    prometheus_file: Optional[str],
+    journal_file: Optional[str],
+    sim: Optional[str],
+    version_timeout: Optional[int],
+    provision_timeout: Optional[int],
 ) -> int:
     """Use EdgeLock 2GO service to provision a device."""
     log_level = log_level or logging.WARNING
@@ -55,17 +97,43 @@ def main(
 
     # no need to scan for interfaces if we only want to show a help message
     # anything stored in `ctx.obj` can be later retrieved via `click.pass_obj` decorator
-    if not is_click_help(ctx, sys.argv):
+    if not is_click_help(ctx, sys.argv) and ctx.invoked_subcommand not in COMMANDS_WITHOUT_INTERFACE:
+        from spsdk.mboot.scanner import get_mboot_interface
+
+        plugin = None
+        if sim is not None:
+            from .simulator import sim_plugin
+
+            plugin = sim_plugin(sim)
         ctx.obj = {
             "interface": get_mboot_interface(
             port=port,
             usb=usb,
             timeout=timeout,
             lpcusbsio=lpcusbsio,
+            plugin=plugin,
         ),
         "use_json": use_json,
         "suppress_progress_bar": use_json or log_level < logging.WARNING,
     }
+    else:
+        ctx.obj = {
+            "interface": None,
+            "use_json": use_json,
+            "suppress_progress_bar": use_json or log_level < logging.WARNING,
+        }
+    ctx.obj["timeout"] = timeout
+    # timeouts of the EL2GO commands, passed to every EL2GOMboot opened by the subcommand
+    ctx.obj["command_timeouts"] = {}
+    if version_timeout is not None or provision_timeout is not None:
+        from .el2go_tp_app import EL2GO_TP_GET_FW_VERSION_CMD, EL2GO_TP_PROVISIONING_CMD
+
+        if version_timeout is not None:
+            ctx.obj["command_timeouts"][EL2GO_TP_GET_FW_VERSION_CMD] = version_timeout
+        if provision_timeout is not None:
+            ctx.obj["command_timeouts"][EL2GO_TP_PROVISIONING_CMD] = provision_timeout
+    ctx.obj["journal"] = journal_file
+    ctx.call_on_close(lambda: report_metrics(use_json, metrics_file, prometheus_file))
 
 
 @main.command(name="get-fw-version")
@@ -73,7 +141,9 @@ def main(
 # The subcommand name doesn't necessarily has to match the function name
 def get_version(ctx: click.Context) -> None:
     """ Return EL2GO NXP Provisioning Firmware's version. """
-    with EL2GOMboot(ctx.obj["interface"]) as el2go_mboot:
+    from .el2go_tp_app import EL2GOMboot, EL2GOStatus
+
+    with EL2GOMboot(ctx.obj["interface"], command_timeouts=ctx.obj["command_timeouts"]) as el2go_mboot:
         version = el2go_mboot.el2go_get_version()
     display_output(el2go_mboot.status_code)
     if el2go_mboot.status_code == EL2GOStatus.SUCCESS:
@@ -100,8 +170,9 @@ def close_device(
     dry_run: bool,
 ) -> None:
     """Launch EL2GO NXP Provisioning Firmware."""
+    from .el2go_tp_app import EL2GOMboot, EL2GOStatus
 
-    with EL2GOMboot(ctx.obj["interface"]) as mboot:
+    with EL2GOMboot(ctx.obj["interface"], command_timeouts=ctx.obj["command_timeouts"]) as mboot:
         response = mboot.close_device(address, dry_run)
         display_output(mboot.status_code)
         if mboot.status_code == EL2GOStatus.SUCCESS:
@@ -114,35 +185,537 @@ def close_device(
 
 @main.command()
 @click.argument("file", type=str, required=True)
+@click.option("-o", "--output", type=str, default="Secure_Objects.bin", help="File the Secure Objects are written to.")
+@click.option(
+    "-s",
+    "--store",
+    type=str,
+    default=None,
+    help="Directory of a Secure Object store; devices already in the store are not downloaded again.",
+)
+@click.option(
+    "-r",
+    "--refresh",
+    is_flag=True,
+    default=False,
+    help="Download the Secure Objects again even if they are in the local cache.",
+)
+@click.option("--profile", type=str, default=None, help="Profile of the configuration file to use.")
 @click.pass_context
 def get_secure_objects(
     ctx: click.Context,
     file: str,
+    output: str,
+    store: Optional[str],
+    refresh: bool,
+    profile: Optional[str],
 ) -> None:
     """Download Secure Objects."""
-    response = ""
+    from .api_utils import get_device_secure_objects
+    from .blob_index import check_blob_file
+    from .cache import ProvisioningCache
+    from .el2go_tp_app import EL2GOMboot, read_device_id
+    from .journal import ProvisioningJournal
+    from .store import get_store
 
     config = ConfigParameters()
 
-    if config.parse_config_file(file) == -1:
+    if config.parse_config_file(file, profile) == -1:
         click.echo(f"ERROR: Parsing config file failed")
         exit()
 
-    with McuBoot(ctx.obj["interface"]) as mboot:
-        for x in range(config.uuid_fuse_start, config.uuid_fuse_end + 1):
-            response += str_little_endian(mboot.efuse_read_once(x))
-    response = int(response, 16)
-    config.device_id = str(response)
+    with EL2GOMboot(ctx.obj["interface"], command_timeouts=ctx.obj["command_timeouts"]) as mboot:
+        config.device_id = read_device_id(mboot, config)
+    journal = ProvisioningJournal(ctx.obj["journal"])
+    if journal.last_stage(config.device_id) is None:
+        journal.record(config.device_id, "uuid_read", interface=str(ctx.obj["interface"]))
+
+    object_store = None
+    if store:
+        object_store = get_store(store, config.hardware_family_type)
+        output = object_store.blob_path(config.device_id)
+        entry = object_store.lookup(config.device_id)
+        error = check_blob_file(output, required=entry.get("indexed", False)) if entry else None
+        if entry and error is None:
+            click.echo(f"Secure Objects of device {config.device_id} found in store: {output}")
+            return
+        if error:
+            click.echo(f"Secure Objects of device {config.device_id} in store are invalid, downloading again: {error}")
+            refresh = True
 
-    assign_device_to_devicegroup(config)
-    status = download_secure_objects(config)
+    status = get_device_secure_objects(config, output, ProvisioningCache.from_config(config), refresh,
+                                       journal=journal)
 
     if status == "GENERATION_TRIGGERED":
         click.echo(f"Secure Objects generation timeout")
+    elif status == "GENERATION_COMPLETED" and object_store:
+        object_store.add(config.device_id)
+        click.echo(f"Secure Objects of device {config.device_id} stored to {output}")
+
+
+@main.command()
+@click.argument("file", type=str, required=True)
+@click.argument("address", type=INT(), required=True)
+@click.option("-s", "--store", type=str, default=None, help="Directory of a Secure Object store.")
+@click.option(
+    "-r",
+    "--refresh",
+    is_flag=True,
+    default=False,
+    help="Download the Secure Objects again even if they are in the local cache.",
+)
+@click.option(
+    "-d",
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help=(
+        "Enable Provisioning Firmware dry run, meaning that no fuses will be burned "
+    ),
+)
+@click.option("--profile", type=str, default=None, help="Profile of the configuration file to use.")
+@click.pass_context
+def provision(
+    ctx: click.Context,
+    file: str,
+    address: int,
+    store: Optional[str],
+    refresh: bool,
+    dry_run: bool,
+    profile: Optional[str],
+) -> None:
+    """Download Secure Objects, write them to ADDRESS and launch EL2GO NXP Provisioning Firmware."""
+    from . import pipeline
+    from .el2go_tp_app import EL2GOMboot
+    from .journal import ProvisioningJournal
+
+    config = ConfigParameters()
+
+    if config.parse_config_file(file, profile) == -1:
+        click.echo("ERROR: Parsing config file failed")
+        exit()
+
+    with EL2GOMboot(ctx.obj["interface"], command_timeouts=ctx.obj["command_timeouts"]) as mboot:
+        result = pipeline.provision(mboot, config, address, dry_run, str(ctx.obj["interface"]), store, refresh,
+                                    ProvisioningJournal(ctx.obj["journal"]))
+    if ctx.obj["use_json"]:
+        click.echo(json.dumps(result.to_dict(), indent=4))
+    else:
+        click.echo(str(result))
+
+
+@main.command(name="provision-batch")
+@click.argument("file", type=str, required=True)
+@click.argument("address", type=INT(), required=True)
+@click.option("-p", "--port", "ports", multiple=True, help="Serial port of a board (name[,speed]), can be repeated.")
+@click.option("-u", "--usb", "usbs", multiple=True, help="USB identifier of a board (VID,PID), can be repeated.")
+@click.option(
+    "-l", "--lpcusbsio", "lpcusbsios", multiple=True, help="LPCUSBSIO configuration of a board, can be repeated."
+)
+@click.option("--sim", "sims", multiple=True, help="Parameters of a simulated board (e.g. uuid=0x1234), can be repeated.")
+@click.option("-w", "--workers", type=int, default=None, help="Number of boards provisioned at the same time.")
+@click.option("-s", "--store", type=str, default=None, help="Directory of a Secure Object store shared by the boards.")
+@click.option(
+    "-d",
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help=(
+        "Enable Provisioning Firmware dry run, meaning that no fuses will be burned "
+    ),
+)
+@click.option(
+    "--probe-timeout",
+    type=int,
+    default=DEFAULT_PROBE_TIMEOUT,
+    help="Milliseconds a board has to answer the pre-flight probe in, 0 disables the probe.",
+)
+@click.option("--fw-version", type=INT(), default=None, help="Reject boards running another provisioning firmware.")
+@click.option("--profile", type=str, default=None, help="Profile of the configuration file to use.")
+@click.pass_context
+def provision_batch(
+    ctx: click.Context,
+    file: str,
+    address: int,
+    ports: List[str],
+    usbs: List[str],
+    lpcusbsios: List[str],
+    sims: List[str],
+    workers: Optional[int],
+    store: Optional[str],
+    dry_run: bool,
+    profile: Optional[str],
+    probe_timeout: int,
+    fw_version: Optional[int],
+) -> None:
+    """Download Secure Objects and provision several boards in parallel.
+
+    Every board is probed first with the short --probe-timeout, boards without a responsive
+    provisioning firmware are rejected before any EL2GO API call.
+    """
+    from .batch import provision_devices
+    from .journal import ProvisioningJournal
+
+    config = ConfigParameters()
+
+    if config.parse_config_file(file, profile) == -1:
+        click.echo("ERROR: Parsing config file failed")
+        exit()
+
+    interfaces = board_interfaces(ports, usbs, lpcusbsios, sims)
+
+    results = []
+    journal = ProvisioningJournal(ctx.obj["journal"])
+    for result in provision_devices(interfaces, config, address, dry_run, ctx.obj["timeout"], workers, store, journal,
+                                    probe_timeout, fw_version, ctx.obj["command_timeouts"]):
+        results.append(result)
+        if not ctx.obj["use_json"]:
+            click.echo(str(result))
+
+    if ctx.obj["use_json"]:
+        click.echo(json.dumps([result.to_dict() for result in results], indent=4))
+    passed = len([result for result in results if result.success])
+    click.echo(f"Provisioned {passed} of {len(results)} devices.", err=ctx.obj["use_json"])
+
+
+@main.command()
+@click.argument("file", type=str, required=True)
+@click.argument("address", type=INT(), required=True)
+@click.option("--usb/--no-usb", "scan_usb", default=True, help="Watch for boards attached over USB.")
+@click.option(
+    "--uart", "uart_patterns", multiple=True, help="Watch serial ports matching the pattern (e.g. '/dev/ttyACM*'), can be repeated."
+)
+@click.option("--baudrate", type=int, default=None, help="Speed of the watched serial ports.")
+@click.option("--sim", "sims", multiple=True, help="Parameters of a simulated board (e.g. uuid=0x1234), can be repeated.")
+@click.option("-w", "--workers", type=int, default=4, help="Number of boards provisioned at the same time.")
+@click.option("-i", "--interval", type=float, default=1.0, help="Seconds between two scans of the interfaces.")
+@click.option("-n", "--max-boards", type=int, default=None, help="Stop after provisioning this many boards.")
+@click.option("-s", "--store", type=str, default=None, help="Directory of a Secure Object store shared by the boards.")
+@click.option(
+    "-d",
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help=(
+        "Enable Provisioning Firmware dry run, meaning that no fuses will be burned "
+    ),
+)
+@click.option(
+    "--probe-timeout",
+    type=int,
+    default=DEFAULT_PROBE_TIMEOUT,
+    help="Milliseconds a board has to answer the pre-flight probe in, 0 disables the probe.",
+)
+@click.option("--fw-version", type=INT(), default=None, help="Reject boards running another provisioning firmware.")
+@click.option("--profile", type=str, default=None, help="Profile of the configuration file to use.")
+@click.pass_context
+def watch(
+    ctx: click.Context,
+    file: str,
+    address: int,
+    scan_usb: bool,
+    uart_patterns: List[str],
+    baudrate: Optional[int],
+    sims: List[str],
+    workers: int,
+    interval: float,
+    max_boards: Optional[int],
+    store: Optional[str],
+    dry_run: bool,
+    probe_timeout: int,
+    fw_version: Optional[int],
+    profile: Optional[str],
+) -> None:
+    """Provision every board attached to the station until stopped with Ctrl+C.
+
+    A board is provisioned once per attachment; with --json every result is printed as one
+    JSON line as soon as the board is done.
+    """
+    from . import watcher
+    from .batch import provision_device
+    from .journal import ProvisioningJournal
+
+    config = ConfigParameters()
+
+    if config.parse_config_file(file, profile) == -1:
+        click.echo("ERROR: Parsing config file failed")
+        exit()
+
+    simulated = []
+    if sims:
+        from .simulator import sim_plugin
+
+        simulated = [{"plugin": sim_plugin(sim)} for sim in sims]
+
+    def scan() -> List[dict]:
+        interfaces = watcher.scan_usb(ctx.obj["timeout"]) if scan_usb else []
+        if uart_patterns:
+            interfaces += watcher.scan_uart(list(uart_patterns), baudrate)
+        return interfaces + simulated
+
+    journal = ProvisioningJournal(ctx.obj["journal"])
+    board_watcher = watcher.BoardWatcher(
+        scan,
+        lambda interface_args: provision_device(interface_args, config, address, dry_run, ctx.obj["timeout"], store,
+                                                journal, probe_timeout, fw_version, ctx.obj["command_timeouts"]),
+        workers,
+        interval,
+    )
+
+    def report(result) -> None:
+        click.echo(json.dumps(result.to_dict()) if ctx.obj["use_json"] else str(result))
+
+    click.echo("Watching for boards, press Ctrl+C to stop.", err=ctx.obj["use_json"])
+    try:
+        count = board_watcher.run(report, max_boards)
+    except KeyboardInterrupt:
+        board_watcher.stop()
+        return
+    click.echo(f"Processed {count} boards.", err=ctx.obj["use_json"])
+
+
+@main.command()
+@click.option("-p", "--port", "ports", multiple=True, help="Serial port of a board (name[,speed]), can be repeated.")
+@click.option("-u", "--usb", "usbs", multiple=True, help="USB identifier of a board (VID,PID), can be repeated.")
+@click.option(
+    "-l", "--lpcusbsio", "lpcusbsios", multiple=True, help="LPCUSBSIO configuration of a board, can be repeated."
+)
+@click.option("--sim", "sims", multiple=True, help="Parameters of a simulated board (e.g. uuid=0x1234), can be repeated.")
+@click.option(
+    "--probe-timeout",
+    type=int,
+    default=DEFAULT_PROBE_TIMEOUT,
+    help="Milliseconds a board has to answer each command in, independent of --timeout.",
+)
+@click.option("--fw-version", type=INT(), default=None, help="Reject boards running another provisioning firmware.")
+@click.pass_context
+def probe(
+    ctx: click.Context,
+    ports: List[str],
+    usbs: List[str],
+    lpcusbsios: List[str],
+    sims: List[str],
+    probe_timeout: int,
+    fw_version: Optional[int],
+) -> None:
+    """Check all given boards in parallel for a responsive EL2GO NXP Provisioning Firmware."""
+    from .batch import probe_interfaces
+
+    results = probe_interfaces(board_interfaces(ports, usbs, lpcusbsios, sims), probe_timeout, fw_version,
+                               command_timeouts=ctx.obj["command_timeouts"])
+    if ctx.obj["use_json"]:
+        click.echo(json.dumps([result.to_dict() for result in results], indent=4))
+    else:
+        for result in results:
+            click.echo(str(result))
+    ready = len([result for result in results if result.ready])
+    click.echo(f"{ready} of {len(results)} boards are ready.", err=ctx.obj["use_json"])
+
+
+@main.command()
+@click.argument("file", type=str, required=True)
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False), required=True)
+@click.option("-s", "--store", type=str, required=True, help="Directory of the Secure Object store to fill.")
+@click.option("-b", "--batch-size", type=int, default=50, help="Devices assigned and downloaded with one request.")
+@click.option(
+    "-r",
+    "--refresh",
+    is_flag=True,
+    default=False,
+    help="Download the Secure Objects again even if they are already in the store.",
+)
+@click.option("--profile", type=str, default=None, help="Profile of the configuration file to use.")
+@click.pass_context
+def prestage(
+    ctx: click.Context,
+    file: str,
+    manifest: str,
+    store: str,
+    batch_size: int,
+    refresh: bool,
+    profile: Optional[str],
+) -> None:
+    """Download the Secure Objects of the UUIDs listed in MANIFEST (CSV or JSON) into a store.
+
+    Boards are then served from the store by get-secure-objects and provision with the same
+    --store, without waiting for EL2GO.
+    """
+    from .journal import ProvisioningJournal
+    from .prestage import prestage_devices, read_manifest
+
+    config = ConfigParameters()
+
+    if config.parse_config_file(file, profile) == -1:
+        click.echo("ERROR: Parsing config file failed")
+        exit()
+
+    try:
+        device_ids = read_manifest(manifest)
+    except ValueError as e:
+        click.echo(f"ERROR: {e}")
+        exit()
+
+    statuses = prestage_devices(config, device_ids, store, batch_size, refresh, ProvisioningJournal(ctx.obj["journal"]))
+    if ctx.obj["use_json"]:
+        click.echo(json.dumps(statuses, indent=4))
+    else:
+        for device_id, status in statuses.items():
+            click.echo(f"{device_id}: {status}")
+    ready = len([status for status in statuses.values() if status in ("GENERATION_COMPLETED", "ALREADY_STORED")])
+    click.echo(f"Secure Objects of {ready} of {len(statuses)} devices are in the store.", err=ctx.obj["use_json"])
+
+
+@main.command(name="refresh-index")
+@click.argument("file", type=str, required=True)
+@click.option(
+    "-i",
+    "--interval",
+    type=int,
+    default=0,
+    help="Keep running and rebuild the device-group index every INTERVAL seconds.",
+)
+@click.option("--profile", type=str, default=None, help="Profile of the configuration file to use.")
+def refresh_index(file: str, interval: int, profile: Optional[str]) -> None:
+    """Rebuild the local index of device-group membership."""
+    from .api_utils import get_client
+    from .device_index import get_device_index
+
+    config = ConfigParameters()
+
+    if config.parse_config_file(file, profile) == -1:
+        click.echo("ERROR: Parsing config file failed")
+        exit()
+
+    device_index = get_device_index(config)
+    if not interval:
+        device_index.refresh(get_client(config))
+        click.echo(f"Device index contains {len(device_index.devices)} devices.")
+        return
+
+    thread = device_index.start_background_refresh(get_client(config), interval)
+    click.echo(f"Refreshing device index every {interval} seconds, press Ctrl+C to stop.")
+    try:
+        while thread.is_alive():
+            thread.join(1)
+    except KeyboardInterrupt:
+        device_index.stop_background_refresh()
+
+
+@main.command()
+@click.argument("blob", type=click.Path(exists=True, dir_okay=False), required=True)
+@click.pass_context
+def verify(ctx: click.Context, blob: str) -> None:
+    """Check a Secure Objects file against its index before writing it to a device."""
+    from .blob_index import check_blob_file, index_path, load_index
+
+    error = check_blob_file(blob)
+    index = None if error else load_index(blob)
+    if ctx.obj["use_json"]:
+        click.echo(json.dumps({"valid": error is None, "error": error, "index": index}, indent=4))
+    elif error:
+        click.echo(f"ERROR: {blob} is invalid: {error}")
+    elif index is None:
+        click.echo(f"{blob} has no index {index_path(blob)}, it cannot be verified.")
+    else:
+        click.echo(f"{blob} is valid: {len(index['objects'])} Secure Objects, {index['size']} bytes.")
+    if error:
+        # scripts writing the blob with blhost stop here
+        sys.exit(1)
+
+
+@main.command(name="journal")
+@click.option("-c", "--compact", is_flag=True, default=False, help="Drop records superseded by later ones.")
+@click.pass_context
+def journal_report(ctx: click.Context, compact: bool) -> None:
+    """Summarize how far every device got according to the provisioning journal."""
+    from .journal import STAGES, ProvisioningJournal
+
+    journal = ProvisioningJournal(ctx.obj["journal"])
+    if compact:
+        journal.compact()
+    summary = journal.summary()
+    if ctx.obj["use_json"]:
+        click.echo(json.dumps(summary, indent=4))
+        return
+
+    click.echo(f"Journal {journal.path}: {summary['devices']} devices")
+    for stage in STAGES:
+        click.echo(f"  {stage:<12} {summary['stages'][stage]}")
+    for device in summary["unfinished"]:
+        error = f": {device['error']}" if device["error"] else ""
+        click.echo(f"[{device['stage'] or 'none'}] {device['device_id']}{error}")
+
+
+@main.command()
+@click.option("-s", "--socket", "unix_socket", type=str, required=True, help="Unix socket the stations connect to.")
+@click.option("-r", "--rate", type=float, default=0, help="Maximum EL2GO API requests per second of all stations.")
+@click.option("-b", "--burst", type=int, default=1, help="Requests which may be sent at once after an idle period.")
+def scheduler(unix_socket: str, rate: float, burst: int) -> None:
+    """Share one EL2GO API request budget between the stations of this host."""
+    from .scheduler import SchedulerBroker
+
+    with SchedulerBroker(unix_socket, rate, burst) as broker:
+        click.echo(f"Scheduler listening on {unix_socket}, {rate or 'unlimited'} requests per second, "
+                   f"press Ctrl+C to stop.")
+        try:
+            while broker.thread.is_alive():
+                broker.thread.join(1)
+        except KeyboardInterrupt:
+            pass
+
+
+@main.command()
+@click.option("-s", "--socket", "unix_socket", type=str, default=None, help="Read commands from this Unix socket.")
+@click.option("-t", "--tcp-port", type=int, default=None, help="Read commands from this TCP port on localhost.")
+@click.pass_context
+def session(ctx: click.Context, unix_socket: Optional[str], tcp_port: Optional[int]) -> None:
+    """Keep the interface open and execute commands read from stdin or a local socket."""
+    interface = PersistentInterface(ctx.obj["interface"])
+    obj = dict(ctx.obj, interface=interface)
+    try:
+        server = open_server(unix_socket, tcp_port)
+        if server is None:
+            click.echo(f"Session started, commands: {', '.join(available_commands(main))}, exit")
+            serve_lines(main, obj, sys.stdin, sys.stdout, prompt="el2go> " if sys.stdin.isatty() else None)
+        else:
+            with server:
+                click.echo(f"Session listening on {unix_socket or f'127.0.0.1:{tcp_port}'}")
+                serve_socket(main, obj, server)
+    finally:
+        interface.shutdown()
+
+
+# Interface arguments of every board given by the repeatable --port/--usb/--lpcusbsio/--sim options
+def board_interfaces(ports: List[str], usbs: List[str], lpcusbsios: List[str], sims: List[str]) -> List[dict]:
+    interfaces = [{"port": port} for port in ports]
+    interfaces += [{"usb": usb} for usb in usbs]
+    interfaces += [{"lpcusbsio": lpcusbsio} for lpcusbsio in lpcusbsios]
+    if sims:
+        from .simulator import sim_plugin
+
+        interfaces += [{"plugin": sim_plugin(sim)} for sim in sims]
+    if not interfaces:
+        click.echo("ERROR: At least one --port, --usb, --lpcusbsio or --sim has to be specified")
+        exit()
+    return interfaces
+
+
+# Report the collected stage timings once the subcommand has finished
+def report_metrics(use_json: bool, metrics_file: Optional[str], prometheus_file: Optional[str]) -> None:
+    metrics = get_metrics()
+    if use_json:
+        # stdout carries the command's own JSON output
+        click.echo(json.dumps({"metrics": metrics.summary()}, indent=4), err=True)
+    if metrics_file:
+        metrics.write_jsonl(metrics_file)
+    if prometheus_file:
+        metrics.write_prometheus(prometheus_file)
 
 
 # just a little thing to get a nicer-looking status code string
 def display_output(status_code: int) -> None:
+    from .el2go_tp_app import EL2GOStatus
+
     click.echo(
         f"Response status = {status_code} ({status_code:#x}) "
         f"{EL2GOStatus.desc(status_code, f'Unknown error code ({status_code})')}."
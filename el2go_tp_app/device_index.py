@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Local index of the device-group each device is registered in."""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from .parameters import ConfigParameters, app_data_dir
+
+logger = logging.getLogger(__name__)
+
+# Number of entries requested per page when the index is (re)built
+PAGE_SIZE = 1000
+# Minimum age in seconds of the index before a device missing from it triggers a rebuild
+MISS_REFRESH_INTERVAL = 60
+
+
+class DeviceGroupIndex:
+    """Device UUID -> device-group id mapping of one product, cached on disk.
+
+    The index is built with paginated bulk requests over all device-groups and is kept
+    in a JSON file next to the other application data. Entries older than ``ttl`` seconds
+    are refreshed on the next lookup. Assign and unclaim operations update the index in memory
+    only, the file is written by rebuilds, so stations sharing it never overwrite each other's
+    updates with a stale copy and a board costs no rewrite of the whole index. Entries may be
+    stale, the ``*_confirmed`` lookups check them with the live device list of their group.
+    A rebuild costs a request per page of every device-group, so concurrent lookups share one
+    rebuild and devices missing from the index rebuild it at most once per ``miss_interval``.
+    The ``*_async`` methods page the device-groups with an AsyncEL2GOClient instead.
+    """
+
+    def __init__(self, config: ConfigParameters, path: Optional[str] = None, ttl: Optional[int] = None,
+                 miss_interval: int = MISS_REFRESH_INTERVAL) -> None:
+        self.config = config
+        self.path = path or os.path.join(app_data_dir(), index_file_name(config))
+        self.ttl = config.index_ttl if ttl is None else ttl
+        self.miss_interval = min(miss_interval, self.ttl)
+        self.devices: Dict[str, str] = {}
+        self.updated = 0.0
+        self._lock = threading.RLock()
+        # held for the whole rebuild, callers waiting on it find the index rebuilt
+        self._refresh_lock = threading.RLock()
+        # rebuild running on an event loop, awaited by every coroutine needing one meanwhile
+        self._async_refresh: Optional[asyncio.Task] = None
+        self._stop_refresh = threading.Event()
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            self.devices = data.get("devices", {})
+            self.updated = data.get("updated", 0.0)
+
+    def save(self) -> None:
+        with self._lock:
+            data = {"updated": self.updated, "devices": self.devices}
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+    def is_expired(self) -> bool:
+        return time.time() > self.updated + self.ttl
+
+    def age(self) -> float:
+        return time.time() - self.updated
+
+    # Content of one page and whether it is the last one
+    @staticmethod
+    def _read_page(response, page: int) -> Tuple[list, bool]:
+        if response.status_code < 200 or response.status_code > 299:
+            raise RuntimeError(f"API call {response.url} failed with {response.status_code}")
+        response_json = response.json()
+        # responses without paging information are a single page
+        last = response_json.get("last")
+        if last is None:
+            last = page + 1 >= response_json.get("totalPages", page + 1)
+        return response_json["content"], last
+
+    def _get_pages(self, client, url: str):
+        page = 0
+        while True:
+            content, last = self._read_page(client.get(url, params={"page": page, "size": PAGE_SIZE}), page)
+            yield from content
+            if last:
+                break
+            page += 1
+
+    async def _get_pages_async(self, client, url: str) -> List[dict]:
+        items: List[dict] = []
+        page = 0
+        while True:
+            content, last = self._read_page(await client.get(url, params={"page": page, "size": PAGE_SIZE}), page)
+            items.extend(content)
+            if last:
+                return items
+            page += 1
+
+    def _set_devices(self, devices: Dict[str, str]) -> None:
+        logger.info(f"Device index of {self.config.nc12} refreshed, {len(devices)} devices")
+        with self._lock:
+            self.devices = devices
+            self.updated = time.time()
+            self.save()
+
+    # Rebuild the whole index with paginated bulk requests
+    def refresh(self, client) -> None:
+        with self._refresh_lock:
+            base_url = f"{self.config.el2go_api_url}/products/{self.config.nc12}/device-groups"
+            devices = {}
+            for device_group in self._get_pages(client, base_url):
+                group_id = str(device_group["id"])
+                for device_json in self._get_pages(client, f"{base_url}/{group_id}/devices"):
+                    devices[str(device_json["device"]["id"])] = group_id
+            self._set_devices(devices)
+
+    async def _rebuild_async(self, client) -> None:
+        base_url = f"{self.config.el2go_api_url}/products/{self.config.nc12}/device-groups"
+        devices = {}
+        for device_group in await self._get_pages_async(client, base_url):
+            group_id = str(device_group["id"])
+            for device_json in await self._get_pages_async(client, f"{base_url}/{group_id}/devices"):
+                devices[str(device_json["device"]["id"])] = group_id
+        self._set_devices(devices)
+
+    # Rebuild the whole index with an AsyncEL2GOClient, coroutines of one event loop share a rebuild
+    async def refresh_async(self, client) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._async_refresh
+            if task is None or task.done() or task.get_loop() is not loop:
+                task = self._async_refresh = loop.create_task(self._rebuild_async(client))
+        # a cancelled caller leaves the rebuild running for the others
+        await asyncio.shield(task)
+
+    # Rebuild the index unless it is younger than max_age seconds, returns True if it was rebuilt
+    def _refresh_older_than(self, client, max_age: float) -> bool:
+        with self._refresh_lock:
+            if self.age() < max_age:
+                return False
+            self.refresh(client)
+            return True
+
+    def _groups(self, device_ids: List[str]) -> Dict[str, str]:
+        with self._lock:
+            return {device_id: self.devices.get(device_id, "") for device_id in device_ids}
+
+    # Return the device-group of every device, "" for devices which are not registered
+    def lookup_many(self, client, device_ids: List[str]) -> Dict[str, str]:
+        self._refresh_older_than(client, self.ttl)
+        groups = self._groups(device_ids)
+        # the devices may have been registered since the index was built, one rebuild for all of them
+        if not all(groups.values()) and self._refresh_older_than(client, self.miss_interval):
+            groups = self._groups(device_ids)
+        return groups
+
+    # lookup_many with an AsyncEL2GOClient
+    async def lookup_many_async(self, client, device_ids: List[str]) -> Dict[str, str]:
+        if self.age() >= self.ttl:
+            await self.refresh_async(client)
+        groups = self._groups(device_ids)
+        if not all(groups.values()) and self.age() >= self.miss_interval:
+            await self.refresh_async(client)
+            groups = self._groups(device_ids)
+        return groups
+
+    # Return the device-group of a device, "" if the device is not registered
+    def lookup(self, client, device_id: str) -> str:
+        return self.lookup_many(client, [device_id])[device_id]
+
+    # Replace the entries of one device-group by its current devices
+    def _set_members(self, device_group_id: str, members: Set[str]) -> None:
+        with self._lock:
+            self.devices = {
+                device_id: group_id for device_id, group_id in self.devices.items()
+                if group_id != device_group_id or device_id in members
+            }
+            for device_id in members:
+                self.devices[device_id] = device_group_id
+
+    def _group_url(self, device_group_id: str) -> str:
+        return f"{self.config.el2go_api_url}/products/{self.config.nc12}/device-groups/{device_group_id}/devices"
+
+    # Page the devices of one device-group and update their entries, returns the devices
+    def refresh_group(self, client, device_group_id: str) -> Set[str]:
+        members = {str(device_json["device"]["id"])
+                   for device_json in self._get_pages(client, self._group_url(device_group_id))}
+        self._set_members(str(device_group_id), members)
+        return members
+
+    async def refresh_group_async(self, client, device_group_id: str) -> Set[str]:
+        members = {str(device_json["device"]["id"])
+                   for device_json in await self._get_pages_async(client, self._group_url(device_group_id))}
+        self._set_members(str(device_group_id), members)
+        return members
+
+    # lookup_many with every device-group found checked live, e.g. before it is unclaimed. A device
+    # which has left its indexed group since makes the index rebuilt.
+    def lookup_many_confirmed(self, client, device_ids: List[str]) -> Dict[str, str]:
+        groups = self.lookup_many(client, device_ids)
+        for device_group_id in set(filter(None, groups.values())):
+            members = self.refresh_group(client, device_group_id)
+            if any(group == device_group_id and device_id not in members for device_id, group in groups.items()):
+                self.refresh(client)
+                return self._groups(device_ids)
+        return groups
+
+    async def lookup_many_confirmed_async(self, client, device_ids: List[str]) -> Dict[str, str]:
+        groups = await self.lookup_many_async(client, device_ids)
+        for device_group_id in set(filter(None, groups.values())):
+            members = await self.refresh_group_async(client, device_group_id)
+            if any(group == device_group_id and device_id not in members for device_id, group in groups.items()):
+                await self.refresh_async(client)
+                return self._groups(device_ids)
+        return groups
+
+    def set_group(self, device_ids: List[str], device_group_id: str) -> None:
+        with self._lock:
+            for device_id in device_ids:
+                self.devices[device_id] = str(device_group_id)
+
+    def remove_group(self, device_group_id: str) -> None:
+        with self._lock:
+            self.devices = {
+                device_id: group_id for device_id, group_id in self.devices.items()
+                if group_id != str(device_group_id)
+            }
+
+    # Keep the index fresh from a daemon thread, returns the thread
+    def start_background_refresh(self, client, interval: Optional[int] = None) -> threading.Thread:
+        interval = interval or self.ttl
+
+        def refresh_loop() -> None:
+            while not self._stop_refresh.is_set():
+                try:
+                    self.refresh(client)
+                except Exception as e:
+                    logger.warning(f"Background refresh of device index failed: {e}")
+                self._stop_refresh.wait(interval)
+
+        self._stop_refresh.clear()
+        thread = threading.Thread(target=refresh_loop, name="device-index-refresh", daemon=True)
+        thread.start()
+        return thread
+
+    def stop_background_refresh(self) -> None:
+        self._stop_refresh.set()
+
+
+# Index file of the product, the API URL is part of the name like it is part of the key of _indexes
+def index_file_name(config: ConfigParameters) -> str:
+    url_hash = hashlib.sha1(config.el2go_api_url.encode("utf-8")).hexdigest()[:12]
+    return f"device_index_{config.nc12}_{url_hash}.json"
+
+
+_indexes: Dict[Tuple[str, str], DeviceGroupIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+# Return the process-wide index of the product of the given configuration
+def get_device_index(config: ConfigParameters) -> DeviceGroupIndex:
+    with _indexes_lock:
+        key = (config.el2go_api_url, config.nc12)
+        index = _indexes.get(key)
+        if index is None:
+            index = DeviceGroupIndex(config)
+            _indexes[key] = index
+        return index
@@ -6,13 +6,21 @@
 # SPDX-License-Identifier: BSD-3-Clause
 """Main module."""
 
+import contextlib
+import dataclasses
 import logging
+import struct
 
-from spsdk.mboot.commands import CmdPacket, TrustProvisioningResponse
+from spsdk.exceptions import SPSDKConnectionError, SPSDKError
+from spsdk.mboot.commands import CmdPacket, CmdResponse, TrustProvisioningResponse
 from spsdk.mboot.error_codes import StatusCode
+from spsdk.mboot.exceptions import McuBootCommandError, McuBootConnectionError
 from spsdk.mboot.mcuboot import McuBoot
 from typing_extensions import Self
-from typing import Optional, List
+from typing import Dict, Iterable, Iterator, Optional, List, Union
+
+from .metrics import get_metrics
+from .parameters import ConfigParameters
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +28,44 @@ EL2GO_TP_COMMAND_GROUP = 0x20
 EL2GO_TP_GET_FW_VERSION_CMD = 0x01
 EL2GO_TP_PROVISIONING_CMD = 0x02
 
+# Statuses after which the command may or may not have run, only idempotent commands are sent again:
+# a damaged packet or CRC may as well be the answer of a command the firmware has already executed
+RETRYABLE_STATUS_CODES = [
+    StatusCode.NO_RESPONSE,
+    StatusCode.TIMEOUT,
+    StatusCode.PACKETIZER_NO_COMMAND_RESPONSE,
+    StatusCode.PACKETIZER_INVALID_CRC,
+    StatusCode.PACKETIZER_INVALID_PACKET_TYPE,
+    StatusCode.TP_PACKET_ERROR,
+    StatusCode.TP_PACKET_DATA_ERROR,
+]
+
+
+@dataclasses.dataclass(frozen=True)
+class CommandPolicy:
+    """How a command of the EL2GO group is sent.
+
+    ``timeout`` is the read timeout in milliseconds while waiting for the answer, None keeps the
+    one of the interface (--timeout). A failed command is sent up to ``retries`` more times, but
+    only if that is safe: commands which are not ``idempotent`` are never repeated. A failed
+    send proves nothing either, on UART the whole frame is written before its ACK is awaited.
+    """
+
+    timeout: Optional[int] = None
+    retries: int = 0
+    idempotent: bool = False
+
+    def should_retry(self, status_code: int) -> bool:
+        return self.idempotent and status_code in RETRYABLE_STATUS_CODES
+
+
+# Default policy of every EL2GO command, an EL2GOMboot takes its own copy
+DEFAULT_COMMAND_POLICIES: Dict[int, CommandPolicy] = {
+    EL2GO_TP_GET_FW_VERSION_CMD: CommandPolicy(timeout=1000, retries=2, idempotent=True),
+    # provisioning burns fuses and takes a while, the retries only apply to dry runs
+    EL2GO_TP_PROVISIONING_CMD: CommandPolicy(retries=2),
+}
+
 
 # You don't have to use CmdPacket directly as Mboot does. Here's a helper class
 class EL2GoProvisionCMD(CmdPacket):
@@ -30,18 +76,113 @@ class EL2GoProvisionCMD(CmdPacket):
 
 
 class EL2GOMboot(McuBoot):
+    def __init__(self, interface, cmd_exception: bool = False,
+                 command_timeouts: Optional[Dict[int, Optional[int]]] = None) -> None:
+        super().__init__(interface, cmd_exception)
+        # command_timeouts (ms) replace the timeouts of DEFAULT_COMMAND_POLICIES for this instance only
+        self.command_policies = dict(DEFAULT_COMMAND_POLICIES)
+        for command, timeout in (command_timeouts or {}).items():
+            self.set_command_timeout(command, timeout)
+        # Number of times the last EL2GO command was sent
+        self.attempts = 0
+
+    def open(self) -> None:
+        with get_metrics().span("interface_open", interface=str(self._interface)):
+            super().open()
+
+    def set_command_timeout(self, command: int, timeout: Optional[int]) -> None:
+        self.command_policies[command] = dataclasses.replace(self.command_policies[command], timeout=timeout)
+
+    # Use a shorter read timeout (ms) of the interface while the block runs, if the interface has one.
+    # The timeout is never raised above the one the interface was opened with, e.g. --probe-timeout.
+    @contextlib.contextmanager
+    def _interface_timeout(self, timeout: Optional[int]) -> Iterator[None]:
+        device = getattr(self._interface, "device", None)
+        if timeout is None or device is None or not getattr(device, "timeout", None):
+            yield
+            return
+        previous = device.timeout
+        device.timeout = min(timeout, previous)
+        try:
+            yield
+        finally:
+            device.timeout = previous
+
+    # Send one command of the EL2GO group, returns its response or None if there is none.
+    # This is McuBoot._process_cmd without the exception handling of the whole command.
+    def _send_el2go_cmd(self, cmd_packet: CmdPacket) -> Optional[CmdResponse]:
+        if not self.is_opened:
+            raise McuBootConnectionError("Device not opened")
+        logger.debug(f"TX-PACKET: {str(cmd_packet)}")
+        try:
+            self._interface.write_command(cmd_packet)
+            response = self._interface.read()
+        except (TimeoutError, SPSDKConnectionError, McuBootConnectionError):
+            # a write failing on a lost ACK has reached the firmware, it may or may not have run
+            logger.debug("RX-PACKET: No Response", exc_info=True)
+            self._status_code = StatusCode.NO_RESPONSE
+            return None
+        logger.debug(f"RX-PACKET: {str(response)}")
+        self._status_code = response.status
+        return response
+
+    # Send a command of the EL2GO group according to its policy, see CommandPolicy
+    def _process_el2go_cmd(self, cmd_packet: CmdPacket, policy: CommandPolicy) -> Optional[CmdResponse]:
+        command = cmd_packet.params[0]
+        cmd_response = None
+        for attempt in range(policy.retries + 1):
+            self.attempts = attempt + 1
+            with self._interface_timeout(policy.timeout):
+                cmd_response = self._send_el2go_cmd(cmd_packet)
+            if self.status_code == StatusCode.SUCCESS or attempt == policy.retries or \
+                    not policy.should_retry(self.status_code):
+                break
+            logger.warning(f"EL2GO command {command:#x} failed with {self.status_string}, "
+                           f"sending it again ({attempt + 1}/{policy.retries})")
+            get_metrics().add("el2go_command_retries_total", command=command, status=self.status_code)
+        if self._cmd_exception and self.status_code != StatusCode.SUCCESS:
+            raise McuBootCommandError(f"EL2GO command {command:#x}", self.status_code)
+        return cmd_response
+
     def el2go_get_version(self) -> Optional[List[int]]:
         logger.info("Getting FW version")
         cmd_packet = CmdPacket(EL2GO_TP_COMMAND_GROUP, 0, EL2GO_TP_GET_FW_VERSION_CMD)
-        cmd_response = self._process_cmd(cmd_packet=cmd_packet)
+        cmd_response = self._process_el2go_cmd(cmd_packet, self.command_policies[EL2GO_TP_GET_FW_VERSION_CMD])
         if isinstance(cmd_response, TrustProvisioningResponse):
             return cmd_response.values
         return None
 
+    # Write the APDU buffers to address with a single write-memory command, the chunks are
+    # copied once into one preallocated buffer instead of being joined or staged in a file
+    def write_secure_objects(self, address: int, chunks: Iterable[Union[bytes, bytearray, memoryview]]) -> bool:
+        views = [memoryview(chunk).cast("B") for chunk in chunks]
+        buffer = bytearray(sum(len(view) for view in views))
+        offset = 0
+        for view in views:
+            buffer[offset:offset + len(view)] = view
+            offset += len(view)
+        logger.info(f"CMD: Write {len(buffer)} bytes of Secure Objects from {len(views)} chunks")
+        return self.write_memory(address, buffer)
+
+    # Write the APDU buffers to address and launch the provisioning firmware on them,
+    # returns None when the write fails
+    def provision_secure_objects(self, address: int, chunks: Iterable[Union[bytes, bytearray, memoryview]],
+                                 dry_run: bool = False) -> Optional[List[int]]:
+        if not self.write_secure_objects(address, chunks):
+            return None
+        return self.close_device(address, dry_run)
+
     def close_device(self, address: int, dry_run: bool = False) -> Optional[List[int]]:
         logger.info(f"CMD: Close device")
         cmd_packet = CmdPacket(EL2GO_TP_COMMAND_GROUP, 0, EL2GO_TP_PROVISIONING_CMD, address, dry_run)
-        cmd_response = self._process_cmd(cmd_packet=cmd_packet)
+        policy = self.command_policies[EL2GO_TP_PROVISIONING_CMD]
+        if dry_run:
+            # no fuses are burned, running it twice is harmless
+            policy = dataclasses.replace(policy, idempotent=True)
+        with get_metrics().span("close_device", address=address, dry_run=dry_run) as labels:
+            cmd_response = self._process_el2go_cmd(cmd_packet, policy)
+            labels["status"] = self.status_code
+            labels["attempts"] = self.attempts
         if isinstance(cmd_response, TrustProvisioningResponse):
             return cmd_response.values
         return None
@@ -51,6 +192,30 @@ class EL2GOMboot(McuBoot):
         return super().__enter__()
 
 
+# Read the device UUID from the fuses described in the configuration.
+# With uuidMemoryAddress configured the fuse words are fetched by a single read-memory command,
+# otherwise with one flash-read-once per word. The fuse words are stored little endian one after
+# another and the resulting buffer is read as one big endian number. The UUID is not cached, a
+# session keeps the interface opened while the board behind it may be swapped.
+def read_device_id(mboot: McuBoot, config: ConfigParameters) -> str:
+    metrics = get_metrics()
+    word_count = config.uuid_fuse_end - config.uuid_fuse_start + 1
+    if config.uuid_memory_address is not None:
+        with metrics.span("uuid_memory_read", address=config.uuid_memory_address):
+            buffer = mboot.read_memory(config.uuid_memory_address, 4 * word_count)
+        if not buffer or len(buffer) != 4 * word_count:
+            raise SPSDKError(f"Reading UUID from {config.uuid_memory_address:#x} failed: {mboot.status_string}")
+    else:
+        buffer = bytearray(4 * word_count)
+        for offset, index in enumerate(range(config.uuid_fuse_start, config.uuid_fuse_end + 1)):
+            with metrics.span("fuse_read", index=index):
+                value = mboot.efuse_read_once(index)
+            if value is None:
+                raise SPSDKError(f"Reading UUID fuse {index} failed: {mboot.status_string}")
+            struct.pack_into("<I", buffer, 4 * offset, value)
+    return str(int.from_bytes(buffer, "big"))
+
+
 class EL2GOStatus(StatusCode):
     EL2GO_PROV_SUCCESS = (
         "0x5a5a5a5a",
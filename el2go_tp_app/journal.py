@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Append-only journal of the provisioning stages every device went through."""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows, records and compaction are then only serialized within the process
+    fcntl = None
+
+from .parameters import app_data_dir
+from .store import AtomicWriter
+
+# Stages of the provisioning flow in the order they are completed
+STAGES = ["uuid_read", "assigned", "generated", "downloaded", "written", "provisioned"]
+
+
+class ProvisioningJournal:
+    """Per-device stage transitions kept in a JSON lines file.
+
+    Every record is one line appended with O_APPEND and synced to disk, a crash leaves at most
+    one truncated line which is skipped on load. Replaying the file gives the last completed
+    stage of each device, so an interrupted run continues where it stopped instead of
+    assigning, polling and downloading again. Completing a stage invalidates the later ones,
+    e.g. a device assigned to another device-group has to be generated and downloaded again.
+    ``is_done`` may be limited to records younger than ``max_age``. Several stations
+    may share the file: records take a shared lock on ``<path>.lock``, compaction an exclusive one.
+    """
+
+    FILE_NAME = "journal.jsonl"
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or os.path.join(app_data_dir(), self.FILE_NAME)
+        self.devices: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        devices: Dict[str, dict] = {}
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash
+                        continue
+                    self._apply(devices, entry)
+        except OSError:
+            pass
+        with self._lock:
+            self.devices = devices
+
+    @staticmethod
+    def _apply(devices: Dict[str, dict], entry: dict) -> None:
+        state = devices.setdefault(entry["device_id"], {"stages": {}, "error": None, "time": 0.0})
+        state["time"] = entry.get("time", 0.0)
+        if "error" in entry:
+            state["error"] = entry["error"]
+            return
+        stage = entry["stage"]
+        if stage in STAGES:
+            for later in STAGES[STAGES.index(stage) + 1:]:
+                state["stages"].pop(later, None)
+        state["stages"][stage] = entry
+        state["error"] = None
+
+    # Hold the lock file of the journal, appends share it and compaction takes it exclusively
+    @contextlib.contextmanager
+    def _file_lock(self, exclusive: bool) -> Iterator[None]:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(self.path + ".lock", os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)
+
+    def _append(self, entry: dict) -> None:
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        with self._file_lock(exclusive=False), self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._apply(self.devices, entry)
+
+    def record(self, device_id: str, stage: str, **details) -> None:
+        self._append(dict(details, device_id=device_id, stage=stage, time=time.time()))
+
+    # Record a failure, the device stays at its last completed stage
+    def record_error(self, device_id: str, message: str) -> None:
+        self._append({"device_id": device_id, "error": message, "time": time.time()})
+
+    # True if the device completed the stage with the given details, e.g. device_group_id, at most
+    # max_age seconds ago when given. Assignments and generations are trusted only as long as the
+    # device index (config.index_ttl), the device may have been moved to another device-group since.
+    def is_done(self, device_id: str, stage: str, max_age: Optional[float] = None, **details) -> bool:
+        with self._lock:
+            entry = self.devices.get(device_id, {}).get("stages", {}).get(stage)
+        if entry is None:
+            return False
+        if max_age is not None and time.time() > entry.get("time", 0.0) + max_age:
+            return False
+        return all(entry.get(key) == value for key, value in details.items())
+
+    def last_stage(self, device_id: str) -> Optional[str]:
+        with self._lock:
+            stages = self.devices.get(device_id, {}).get("stages", {})
+            completed = [stage for stage in STAGES if stage in stages]
+        return completed[-1] if completed else None
+
+    # Number of devices per last completed stage and the devices not provisioned yet
+    def summary(self) -> dict:
+        with self._lock:
+            device_ids = sorted(self.devices)
+            errors = {device_id: state["error"] for device_id, state in self.devices.items()}
+        counts = {stage: 0 for stage in STAGES}
+        unfinished: List[dict] = []
+        for device_id in device_ids:
+            last = self.last_stage(device_id)
+            if last:
+                counts[last] += 1
+            if last != "provisioned":
+                unfinished.append({"device_id": device_id, "stage": last, "error": errors[device_id]})
+        return {"devices": len(device_ids), "stages": counts, "unfinished": unfinished}
+
+    # Rewrite the journal with only the records still describing the state of each device, records
+    # appended by other stations until the lock is taken are kept
+    def compact(self) -> None:
+        with self._file_lock(exclusive=True):
+            self.load()
+            with self._lock, AtomicWriter(self.path) as writer:
+                for device_id, state in self.devices.items():
+                    entries = sorted(state["stages"].values(), key=lambda entry: entry["time"])
+                    if state["error"] is not None:
+                        entries.append({"device_id": device_id, "error": state["error"], "time": state["time"]})
+                    for entry in entries:
+                        writer.write((json.dumps(entry) + "\n").encode("utf-8"))
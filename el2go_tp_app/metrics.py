@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Per-stage timing and counters of the provisioning flow."""
+
+import bisect
+import collections
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Deque, Dict, Iterator, Tuple
+
+# Prefix of every metric name in the Prometheus textfile
+PROMETHEUS_PREFIX = "el2go_tp_app"
+# Upper bounds in seconds of the stage duration histogram buckets
+STAGE_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0]
+# Spans kept for the JSONL export, older ones are dropped when nothing writes them out
+MAX_PENDING_SPANS = 10000
+
+
+class Metrics:
+    """Thread-safe collector of timed spans and counters.
+
+    A span records the wall time of one stage (interface open, fuse read, HTTP call, generation
+    wait, close_device) together with its labels; counters accumulate values such as the number
+    of downloaded bytes. Every span is aggregated into the histogram of its stage right away,
+    the spans themselves are only kept until write_jsonl takes them, at most MAX_PENDING_SPANS of
+    them, so long-running session and watch commands use bounded memory.
+    """
+
+    def __init__(self) -> None:
+        self.spans: Deque[dict] = collections.deque(maxlen=MAX_PENDING_SPANS)
+        self.stages: Dict[str, dict] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **labels) -> Iterator[dict]:
+        """Time the body of the with statement, labels may be added to the yielded dict."""
+        record = {"name": name, "start": time.time(), "labels": dict(labels)}
+        start = time.perf_counter()
+        try:
+            yield record["labels"]
+        except BaseException as e:
+            record["labels"].setdefault("error", type(e).__name__)
+            raise
+        finally:
+            record["duration"] = time.perf_counter() - start
+            with self._lock:
+                self.spans.append(record)
+                self._aggregate(name, record["duration"])
+
+    def _aggregate(self, name: str, duration: float) -> None:
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * len(STAGE_BUCKETS)}
+        stage["count"] += 1
+        stage["total"] += duration
+        stage["max"] = max(stage["max"], duration)
+        bucket = bisect.bisect_left(STAGE_BUCKETS, duration)
+        if bucket < len(STAGE_BUCKETS):
+            stage["buckets"][bucket] += 1
+
+    def add(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted((str(k), str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans.clear()
+            self.stages = {}
+            self.counters = {}
+
+    # Count, total and maximum duration of every stage
+    def summary(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                name: {"count": stage["count"], "total": stage["total"], "max": stage["max"]}
+                for name, stage in self.stages.items()
+            }
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self.counters.items()
+            ]
+        return {"spans": spans, "counters": counters, "summary": self.summary()}
+
+    # Append every pending span and the counters as one JSON line each, the written spans are dropped
+    def write_jsonl(self, path: str) -> None:
+        with self._lock:
+            spans = list(self.spans)
+            self.spans.clear()
+        data = self.to_dict()
+        with open(path, "a") as f:
+            for span in spans:
+                f.write(json.dumps(dict(span, type="span")) + "\n")
+            for counter in data["counters"]:
+                f.write(json.dumps(dict(counter, type="counter", time=time.time())) + "\n")
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            stages = {name: dict(stage, buckets=list(stage["buckets"])) for name, stage in self.stages.items()}
+        histogram = f"{PROMETHEUS_PREFIX}_stage_duration_seconds"
+        lines.append(f"# TYPE {histogram} histogram")
+        for stage, values in sorted(stages.items()):
+            cumulative = 0
+            for bound, count in zip(STAGE_BUCKETS, values["buckets"]):
+                cumulative += count
+                lines.append(f'{histogram}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{histogram}_bucket{{stage="{stage}",le="+Inf"}} {values["count"]}')
+            lines.append(f'{histogram}_sum{{stage="{stage}"}} {values["total"]:.6f}')
+            lines.append(f'{histogram}_count{{stage="{stage}"}} {values["count"]}')
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_duration_seconds_max gauge")
+        for stage, values in sorted(stages.items()):
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_duration_seconds_max{{stage="{stage}"}} {values["max"]:.6f}')
+        with self._lock:
+            counters = sorted(self.counters.items())
+        for (name, labels), value in counters:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    # Replace the textfile read by the node exporter atomically
+    def write_prometheus(self, path: str) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+_metrics = Metrics()
+
+
+# Return the process-wide metrics collector
+def get_metrics() -> Metrics:
+    return _metrics
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Local stand-in for the EL2GO API, used by the tests and the benchmark.
+
+Only the endpoints called by api_utils are implemented: listing device-groups and their
+devices, assigning devices to a device-group, unclaiming a device-group, the generation
+status of Secure Objects and the download of provisionings.
+"""
+
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+# Path prefix of the API, the server URL is http://127.0.0.1:<port>/api/v1
+API_PREFIX = "/api/v1"
+# Page size used when the client doesn't ask for one
+DEFAULT_PAGE_SIZE = 20
+
+
+class MockBackend:
+    """State and behaviour of the simulated EL2GO service.
+
+    Secure Objects of a device are generated ``generation_latency`` seconds after it has been
+    assigned to a device-group. Every request is delayed by ``request_latency`` seconds and
+    fails with 500 with the probability ``error_rate``. A device gets ``objects_per_device``
+    Secure Objects of ``payload_size`` bytes in total.
+    """
+
+    def __init__(self, generation_latency: float = 0.0, request_latency: float = 0.0, error_rate: float = 0.0,
+                 payload_size: int = 1024, objects_per_device: int = 2, api_key: str = "",
+                 seed: Optional[int] = None) -> None:
+        self.generation_latency = generation_latency
+        self.request_latency = request_latency
+        self.error_rate = error_rate
+        self.payload_size = payload_size
+        self.objects_per_device = objects_per_device
+        self.api_key = api_key
+        self.random = random.Random(seed)
+        self.groups: Dict[str, List[str]] = {}
+        self.registered: Dict[str, str] = {}
+        self.generation_started: Dict[str, float] = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    # Deterministic APDUs of a device, split into objects_per_device Secure Objects
+    def apdus(self, device_id: str) -> List[bytes]:
+        seed = hashlib.sha256(device_id.encode("utf-8")).digest()
+        payload = (seed * (self.payload_size // len(seed) + 1))[:self.payload_size]
+        count = max(1, self.objects_per_device)
+        size = -(-len(payload) // count)
+        return [payload[offset:offset + size] for offset in range(0, len(payload), size)] or [b""]
+
+    def payload(self, device_id: str) -> bytes:
+        return b"".join(self.apdus(device_id))
+
+    def add_group(self, device_group_id: str) -> None:
+        with self.lock:
+            self.groups.setdefault(str(device_group_id), [])
+
+    def register(self, device_group_id: str, device_ids: List[str]) -> None:
+        with self.lock:
+            self._register(str(device_group_id), device_ids)
+
+    def _register(self, device_group_id: str, device_ids: List[str]) -> None:
+        group = self.groups.setdefault(device_group_id, [])
+        now = time.time()
+        for device_id in device_ids:
+            if self.registered.get(device_id) != device_group_id:
+                group.append(device_id)
+                self.registered[device_id] = device_group_id
+                self.generation_started[device_id] = now
+
+    def _is_generated(self, device_id: str) -> bool:
+        started = self.generation_started.get(device_id)
+        return started is not None and time.time() - started >= self.generation_latency
+
+    def handle(self, method: str, path: str, query: Dict[str, List[str]], body) -> tuple:
+        """Return (status code, JSON answer) of one API request."""
+        with self.lock:
+            self.requests += 1
+            fail = self.random.random() < self.error_rate
+        if self.request_latency:
+            time.sleep(self.request_latency)
+        if fail:
+            return 500, {"details": "Injected error"}
+
+        routes = [
+            ("GET", r"/products/(?P<nc12>[^/]+)/device-groups", self.get_device_groups),
+            ("GET", r"/products/(?P<nc12>[^/]+)/device-groups/(?P<group>[^/]+)/devices", self.get_devices),
+            ("POST", r"/products/(?P<nc12>[^/]+)/device-groups/(?P<group>[^/]+)/devices", self.assign_devices),
+            ("POST", r"/products/(?P<nc12>[^/]+)/device-groups/(?P<group>[^/]+)/unclaim", self.unclaim),
+            ("GET", r"/rtp/devices/(?P<device>[^/]+)/secure-object-provisionings", self.get_provisionings),
+            ("POST", r"/rtp/device-groups/(?P<group>[^/]+)/devices/download-provisionings", self.download),
+        ]
+        for route_method, pattern, handler in routes:
+            match = re.fullmatch(API_PREFIX + pattern, path)
+            if match and route_method == method:
+                return handler(query=query, body=body, **match.groupdict())
+        return 404, {"details": f"Unknown endpoint {method} {path}"}
+
+    @staticmethod
+    def _page(items: list, query: Dict[str, List[str]]) -> dict:
+        page = int(query.get("page", ["0"])[0])
+        size = int(query.get("size", [str(DEFAULT_PAGE_SIZE)])[0])
+        total_pages = max(1, -(-len(items) // size))
+        return {
+            "content": items[page * size:(page + 1) * size],
+            "totalPages": total_pages,
+            "last": page >= total_pages - 1,
+        }
+
+    def get_device_groups(self, query, body, nc12: str) -> tuple:
+        with self.lock:
+            groups = [{"id": int(group) if group.isdigit() else group} for group in self.groups]
+        return 200, self._page(groups, query)
+
+    def get_devices(self, query, body, nc12: str, group: str) -> tuple:
+        with self.lock:
+            devices = [{"device": {"id": device_id}} for device_id in self.groups.get(group, [])]
+        return 200, self._page(devices, query)
+
+    def assign_devices(self, query, body, nc12: str, group: str) -> tuple:
+        device_ids = [str(device_id) for device_id in body.get("deviceIds", [])]
+        with self.lock:
+            registered = [device_id for device_id in device_ids
+                          if self.registered.get(device_id) not in (None, group)]
+            if registered:
+                return 422, {"details": f"{len(registered)} of {len(device_ids)} devices are already registered."}
+            self._register(group, device_ids)
+        return 200, {"deviceIds": device_ids}
+
+    def unclaim(self, query, body, nc12: str, group: str) -> tuple:
+        with self.lock:
+            for device_id in self.groups.pop(group, []):
+                self.registered.pop(device_id, None)
+                self.generation_started.pop(device_id, None)
+        return 200, {}
+
+    def get_provisionings(self, query, body, device: str) -> tuple:
+        with self.lock:
+            if device not in self.registered:
+                return 200, {"content": []}
+            state = "GENERATION_COMPLETED" if self._is_generated(device) else "GENERATION_TRIGGERED"
+        return 200, {"content": [{"provisioningState": state} for _ in range(max(1, self.objects_per_device))]}
+
+    def download(self, query, body, group: str) -> tuple:
+        device_ids = [str(device_id) for device_id in body.get("deviceIds", [])]
+        with self.lock:
+            device_ids = [device_id for device_id in device_ids
+                          if self.registered.get(device_id) == group and self._is_generated(device_id)]
+        return 200, [
+            {"deviceId": device_id, "rtpProvisionings": [
+                {"apdus": {"createApdu": {"apdu": base64.b64encode(apdu).decode("ascii")}}}
+                for apdu in self.apdus(device_id)
+            ]}
+            for device_id in device_ids
+        ]
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _serve(self, method: str) -> None:
+        backend = self.server.backend
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+
+        if backend.api_key and self.headers.get("EL2G-API-Key") != backend.api_key:
+            status, answer = 401, {"details": "Invalid API key"}
+        else:
+            status, answer = backend.handle(method, url.path, parse_qs(url.query), body)
+
+        content = json.dumps(answer).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self) -> None:
+        self._serve("GET")
+
+    def do_POST(self) -> None:
+        self._serve("POST")
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class MockEL2GOServer(ThreadingHTTPServer):
+    """HTTP server of a MockBackend on localhost, running in a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, backend: Optional[MockBackend] = None, port: int = 0) -> None:
+        super().__init__(("127.0.0.1", port), MockRequestHandler)
+        self.backend = backend or MockBackend()
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}{API_PREFIX}"
+
+    def start(self) -> "MockEL2GOServer":
+        self.thread = threading.Thread(target=self.serve_forever, name="mock-el2go", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "MockEL2GOServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
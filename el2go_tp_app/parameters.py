@@ -5,8 +5,25 @@
 #
 # SPDX-License-Identifier: BSD-3-Clause
 from dataclasses import dataclass
+from typing import Dict, Optional, Tuple, Union
 import os
-import xml.etree.ElementTree as eT
+import threading
+
+# Number of keep-alive connections kept open to the EL2GO backend
+DEFAULT_POOL_SIZE = 10
+# Seconds after which the local device-group index is rebuilt
+DEFAULT_INDEX_TTL = 3600
+# Seconds a downloaded provisioning stays in the local cache
+DEFAULT_CACHE_MAX_AGE = 24 * 3600
+# Bytes of downloaded provisionings kept in the local cache
+DEFAULT_CACHE_MAX_SIZE = 100 * 1024 * 1024
+# Milliseconds a board has to answer each command of the pre-flight probe in
+DEFAULT_PROBE_TIMEOUT = 1000
+
+
+# Directory holding the application data (device index, caches), EL2GO_TP_APP_HOME overrides the default
+def app_data_dir() -> str:
+    return os.environ.get("EL2GO_TP_APP_HOME", os.path.join(os.path.expanduser("~"), ".el2go_tp_app"))
 
 
 def str_little_endian(val):
@@ -24,79 +41,43 @@ class ConfigParameters:
     hardware_family_type: str
     uuid_fuse_start: int
     uuid_fuse_end: int
+    uuid_memory_address: Optional[int]
     delay: int
     timeout: int
-
-    def parse_config_file(self, config_file_path) -> int:
+    pool_size: int
+    index_ttl: int
+    max_requests_per_second: float
+    cache_max_age: int
+    cache_max_size: int
+    scheduler_socket: str
+    profile: Optional[str]
+
+    def parse_config_file(self, config_file_path, profile: Optional[str] = None) -> int:
+        """Load the configuration, optionally with the settings of a named profile applied.
+
+        The file is parsed and validated once, every profile included; later calls are served
+        from the compiled configuration until the modification time of the file changes.
+        """
         if not os.path.exists(config_file_path):
             print("ERROR: Config file path " + config_file_path + " not found")
             return -1
 
-        config_file_path = os.path.abspath(config_file_path)
-        print("Location of config file: " + config_file_path)
-
-        try:
-            tree = eT.parse(config_file_path)
-        except:
-            print("ERROR: Could not parse " + config_file_path + " as a .xml file")
-            return -1
-
-        root = tree.getroot()
-
-        # Parse device id
-        self.device_group_id = root.find("deviceGroupId").text
-        if self.device_group_id is None:
-            print("ERROR: deviceGroupId cannot be empty")
-            return -1
-
-        try:
-            self.nc12 = root.find("nc12").text
-        except:
-            print("12NC not present in the configuration file; this is needed just in case tests are done on RW61x")
-
-        # Parse hardware family type
-        self.hardware_family_type = root.find("hardwareFamilyType").text
-        if self.hardware_family_type is None:
-            print("ERROR: hardwareFamilyType cannot be empty")
-            return -1
-
-        # Parse UUID first and last fuse address
-        self.uuid_fuse_start = int(root.find("firstFuseAddress").text)
-        if self.uuid_fuse_start <= 0:
-            print("ERROR: firstFuseAddress cannot be empty or negative")
-            return -1
-
-        self.uuid_fuse_end = int(root.find("lastFuseAddress").text)
-        if self.uuid_fuse_end <= 0:
-            print("ERROR: lastFuseAddress cannot be empty or negative")
-            return -1
-
-        # Parse delay and timeout values
-        self.delay = int(root.find("delay").text)
-        if self.delay < 0:
-            print("ERROR: delay cannot be negative")
+        compiled = compile_config_file(config_file_path)
+        if isinstance(compiled, str):
+            print(compiled)
             return -1
-
-        self.timeout = int(root.find("timeout").text)
-        if self.timeout < 0:
-            print("ERROR: timeout cannot be negative")
-            return -1
-
-        # Parse EL2GO backend settings
-        el2go_settings_node = root.find("el2goSettings")
-        self.el2go_api_hostname = el2go_settings_node.find("edgelock2goHostname").text
-        if self.el2go_api_hostname is None:
-            print("ERROR: edgelock2goHostname cannot be empty")
+        settings = compiled.get(profile)
+        if settings is None:
+            print(f"ERROR: Profile {profile} not found in {config_file_path}, "
+                  f"available: {', '.join(name for name in compiled if name) or 'none'}")
             return -1
-        self.el2go_api_key = el2go_settings_node.find("edgelock2goApiKey").text
-        if self.el2go_api_key is None:
-            print("ERROR: edgelock2goApiKey cannot be empty")
-            return -1
-        self.el2go_api_url = el2go_settings_node.find("edgelock2goApiUrl").text
-        if self.el2go_api_url is None:
-            print("ERROR: edgelock2goApiUrl cannot be empty")
+        if isinstance(settings, str):
+            print(settings)
             return -1
 
+        for name, value in settings.items():
+            setattr(self, name, value)
+        self.profile = profile
         return 0
 
     def __init__(self) -> None:
@@ -109,6 +90,142 @@ class ConfigParameters:
         self.hardware_family_type = ""
         self.uuid_fuse_start = 0
         self.uuid_fuse_end = 0
+        self.uuid_memory_address = None
         self.delay = 0
         self.timeout = 0
-
+        self.pool_size = DEFAULT_POOL_SIZE
+        self.index_ttl = DEFAULT_INDEX_TTL
+        self.max_requests_per_second = 0
+        self.cache_max_age = DEFAULT_CACHE_MAX_AGE
+        self.cache_max_size = DEFAULT_CACHE_MAX_SIZE
+        self.scheduler_socket = ""
+        self.profile = None
+
+
+# XML elements of the configuration and the ConfigParameters attributes they are parsed to
+CONFIG_ELEMENTS = {
+    "deviceGroupId": ("device_group_id", str),
+    "nc12": ("nc12", str),
+    "hardwareFamilyType": ("hardware_family_type", str),
+    "firstFuseAddress": ("uuid_fuse_start", int),
+    "lastFuseAddress": ("uuid_fuse_end", int),
+    "uuidMemoryAddress": ("uuid_memory_address", lambda text: int(text, 0)),
+    "delay": ("delay", int),
+    "timeout": ("timeout", int),
+    "deviceIndexTtl": ("index_ttl", int),
+    "cacheMaxAge": ("cache_max_age", int),
+    "cacheMaxSize": ("cache_max_size", int),
+}
+EL2GO_SETTINGS_ELEMENTS = {
+    "edgelock2goHostname": ("el2go_api_hostname", str),
+    "edgelock2goApiKey": ("el2go_api_key", str),
+    "edgelock2goApiUrl": ("el2go_api_url", str),
+    "connectionPoolSize": ("pool_size", int),
+    "maxRequestsPerSecond": ("max_requests_per_second", float),
+    "schedulerSocket": ("scheduler_socket", str),
+}
+
+# Compiled configuration of every file: stat signature and the settings (or error message) per profile,
+# the settings without a profile are stored under None
+_compiled_configs: Dict[str, Tuple[tuple, Union[str, Dict[Optional[str], Union[str, dict]]]]] = {}
+_compiled_configs_lock = threading.Lock()
+
+
+def _read_elements(node, elements: dict) -> dict:
+    settings = {}
+    for tag, (name, convert) in elements.items():
+        element = node.find(tag)
+        if element is None or element.text is None or not element.text.strip():
+            continue
+        try:
+            settings[name] = convert(element.text.strip())
+        except ValueError:
+            raise ValueError(f"ERROR: Invalid value of {tag}: {element.text.strip()}")
+    return settings
+
+
+# Settings given directly in the node (the root or a profile), el2goSettings included
+def _read_settings(node) -> dict:
+    settings = _read_elements(node, CONFIG_ELEMENTS)
+    el2go_settings_node = node.find("el2goSettings")
+    if el2go_settings_node is not None:
+        settings.update(_read_elements(el2go_settings_node, EL2GO_SETTINGS_ELEMENTS))
+    return settings
+
+
+# Return the error message of invalid settings, None if they are complete and valid
+def _validate_settings(settings: dict) -> Optional[str]:
+    for tag, name in [("deviceGroupId", "device_group_id"), ("hardwareFamilyType", "hardware_family_type"),
+                      ("delay", "delay"), ("timeout", "timeout"), ("edgelock2goHostname", "el2go_api_hostname"),
+                      ("edgelock2goApiKey", "el2go_api_key"), ("edgelock2goApiUrl", "el2go_api_url")]:
+        if settings.get(name) in (None, ""):
+            return f"ERROR: {tag} cannot be empty"
+    for tag, name in [("firstFuseAddress", "uuid_fuse_start"), ("lastFuseAddress", "uuid_fuse_end")]:
+        if settings.get(name, 0) <= 0:
+            return f"ERROR: {tag} cannot be empty or negative"
+    for tag, name in [("delay", "delay"), ("timeout", "timeout"), ("deviceIndexTtl", "index_ttl"),
+                      ("cacheMaxAge", "cache_max_age"), ("cacheMaxSize", "cache_max_size"),
+                      ("maxRequestsPerSecond", "max_requests_per_second")]:
+        if settings.get(name, 0) < 0:
+            return f"ERROR: {tag} cannot be negative"
+    if settings.get("pool_size", DEFAULT_POOL_SIZE) <= 0:
+        return "ERROR: connectionPoolSize must be positive"
+    return None
+
+
+def _parse_config_file(config_file_path: str) -> Union[str, Dict[Optional[str], Union[str, dict]]]:
+    import xml.etree.ElementTree as eT
+
+    print("Location of config file: " + config_file_path)
+    try:
+        root = eT.parse(config_file_path).getroot()
+    except (eT.ParseError, OSError):
+        return "ERROR: Could not parse " + config_file_path + " as a .xml file"
+
+    try:
+        defaults = _read_settings(root)
+        profiles = {None: defaults}
+        profiles_node = root.find("profiles")
+        for profile_node in profiles_node.findall("profile") if profiles_node is not None else []:
+            name = profile_node.get("name")
+            if not name:
+                return "ERROR: Every profile needs a name attribute"
+            profiles[name] = dict(defaults, **_read_settings(profile_node))
+    except ValueError as e:
+        return str(e)
+
+    if "nc12" not in defaults:
+        print("12NC not present in the configuration file; this is needed just in case tests are done on RW61x")
+    compiled: Dict[Optional[str], Union[str, dict]] = {}
+    for name, settings in profiles.items():
+        error = _validate_settings(settings)
+        if error and name is None and len(profiles) > 1:
+            error += f" (or select one of the profiles: {', '.join(profile for profile in profiles if profile)})"
+        compiled[name] = error or settings
+    return compiled
+
+
+def compile_config_file(config_file_path: str) -> Union[str, Dict[Optional[str], Union[str, dict]]]:
+    """Return the validated settings of every profile of the configuration file, or an error message.
+
+    The result is cached until the modification time or size of the file changes, so a long
+    running process serving many boards parses every configuration only once.
+    """
+    config_file_path = os.path.abspath(config_file_path)
+    stat = os.stat(config_file_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _compiled_configs_lock:
+        cached = _compiled_configs.get(config_file_path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    compiled = _parse_config_file(config_file_path)
+    with _compiled_configs_lock:
+        _compiled_configs[config_file_path] = (signature, compiled)
+    return compiled
+
+
+# Names of the profiles defined in the configuration file
+def config_profiles(config_file_path: str) -> list:
+    compiled = compile_config_file(config_file_path)
+    return [] if isinstance(compiled, str) else [name for name in compiled if name]
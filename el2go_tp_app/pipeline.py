@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Pipelined provisioning of one board."""
+
+import copy
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Tuple
+
+from .api_utils import get_device_secure_objects
+from .blob_index import check_blob_file
+from .cache import ProvisioningCache
+from .el2go_tp_app import EL2GOMboot, EL2GOStatus, read_device_id
+from .journal import ProvisioningJournal
+from .parameters import ConfigParameters
+from .store import get_store
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DeviceResult:
+    interface: str
+    device_id: str = ""
+    success: bool = False
+    message: str = ""
+    elapsed: float = 0.0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def __str__(self) -> str:
+        result = "PASS" if self.success else "FAIL"
+        device_id = self.device_id or "unknown UUID"
+        return f"[{result}] {self.interface} ({device_id}) in {self.elapsed:.1f}s: {self.message}"
+
+
+# Read a blob into one buffer of its final size
+def read_blob(path: str) -> bytearray:
+    with open(path, "rb") as f:
+        buffer = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(buffer)
+    return buffer
+
+
+# Assign, wait for and download the Secure Objects of config.device_id, returns the status and the
+# APDU buffers. Freshly downloaded APDUs are handed over as decoded, the blob file written next to
+# them only serves the store and the cache; without a store it is written straight into the cache
+# and nowhere else. Blobs reused from there are read back from disk and checked against their
+# sidecar index, a damaged blob is downloaded again. Setting cancel stops the generation polling,
+# the status is then CANCELLED.
+def fetch_secure_objects(config: ConfigParameters, store_dir: Optional[str] = None, refresh: bool = False,
+                         journal: Optional[ProvisioningJournal] = None,
+                         cancel: Optional[threading.Event] = None) -> Tuple[str, List[bytes]]:
+    store = get_store(store_dir, config.hardware_family_type) if store_dir else None
+    cache = ProvisioningCache.from_config(config)
+    if store:
+        output = store.blob_path(config.device_id)
+    else:
+        output = cache.entry_path(config.device_group_id, config.device_id)
+
+    # a blob completed by an earlier run is reused without any API call
+    entry = store.lookup(config.device_id) if store is not None and not refresh else None
+    if entry is not None:
+        blob = read_blob(output)
+        error = check_blob_file(output, blob, required=entry.get("indexed", False))
+        if error is None:
+            return "GENERATION_COMPLETED", [blob]
+        logger.warning(f"Stored Secure Objects of {config.device_id} are invalid, downloading again: {error}")
+        refresh = True
+
+    apdus: List[bytes] = []
+    status = get_device_secure_objects(config, output, cache, refresh, apdus=apdus, journal=journal, cancel=cancel)
+    if status == "GENERATION_COMPLETED" and not apdus:
+        # taken from the cache, another station sharing it may have evicted the entry meanwhile
+        try:
+            blob = read_blob(output)
+            error = check_blob_file(output, blob)
+        except FileNotFoundError as e:
+            error = str(e)
+        if error is None:
+            apdus = [blob]
+        else:
+            logger.warning(f"Cached Secure Objects of {config.device_id} are invalid, downloading again: {error}")
+            cache.invalidate(config.device_group_id, config.device_id)
+            status = get_device_secure_objects(config, output, cache, True, apdus=apdus, journal=journal,
+                                               cancel=cancel)
+    if status == "GENERATION_COMPLETED" and store:
+        # the blob file holds exactly the APDUs, hashing them saves reading it back
+        blob_hash = hashlib.sha256()
+        for apdu in apdus:
+            blob_hash.update(apdu)
+        store.add(config.device_id, blob_hash.hexdigest(), sum(len(apdu) for apdu in apdus))
+    return status, apdus
+
+
+def provision(mboot: EL2GOMboot, config: ConfigParameters, address: int, dry_run: bool, interface: str = "",
+              store_dir: Optional[str] = None, refresh: bool = False,
+              journal: Optional[ProvisioningJournal] = None) -> DeviceResult:
+    """Provision the board behind an opened EL2GOMboot.
+
+    The EL2GO generation is started right after the UUID has been read and runs in a background
+    thread while the board is checked for a responsive provisioning firmware; the blob is written
+    and the device closed as soon as the download has finished. With a journal every completed
+    stage is recorded and a device already provisioned by an earlier run is not touched again.
+    """
+    result = DeviceResult(interface=interface)
+    start_time = time.time()
+    # device_id is set per board, the caller's configuration stays untouched
+    config = copy.copy(config)
+    try:
+        config.device_id = read_device_id(mboot, config)
+        result.device_id = config.device_id
+        if journal is not None:
+            if not refresh and journal.is_done(config.device_id, "provisioned", dry_run=False):
+                result.success = True
+                result.message = "Device has already been provisioned"
+                return result
+            if journal.last_stage(config.device_id) is None:
+                journal.record(config.device_id, "uuid_read", interface=interface)
+
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="el2go-api")
+        cancel = threading.Event()
+        try:
+            download = executor.submit(fetch_secure_objects, config, store_dir, refresh, journal, cancel)
+
+            # host and device side work overlapping the EL2GO generation
+            version = mboot.el2go_get_version()
+            if mboot.status_code != EL2GOStatus.SUCCESS or version is None:
+                result.message = "EL2GO NXP Provisioning Firmware is not responding: " + \
+                    EL2GOStatus.desc(mboot.status_code, f"Unknown error code ({mboot.status_code})")
+                return result
+            logger.info(f"Firmware version of {config.device_id}: {', '.join(hex(x) for x in version)}")
+
+            status, apdus = download.result()
+        finally:
+            # on an early return the worker stops at its next status poll instead of keeping the
+            # process alive until config.timeout, the assignment is kept for the next attempt
+            cancel.set()
+            executor.shutdown(wait=False)
+        if status != "GENERATION_COMPLETED":
+            result.message = f"Secure Objects are not available, generation status: {status}"
+            return result
+
+        if not mboot.write_secure_objects(address, apdus):
+            result.message = f"Writing Secure Objects to {address:#x} failed: {mboot.status_string}"
+            return result
+        if journal is not None:
+            journal.record(config.device_id, "written", address=address)
+
+        response = mboot.close_device(address, dry_run)
+        if mboot.status_code != EL2GOStatus.SUCCESS:
+            result.message = EL2GOStatus.desc(mboot.status_code, f"Unknown error code ({mboot.status_code})")
+            if getattr(mboot, "attempts", 1) > 1:
+                result.message += f" after {mboot.attempts} attempts"
+            return result
+        hex_response = '{}'.format(', '.join(hex(x) for x in response))
+        if hex_response != EL2GOStatus.EL2GO_PROV_SUCCESS:
+            result.message = f"Provision of device has failed with error code :{hex_response}"
+            return result
+
+        result.success = True
+        result.message = "Device has been successfully provisioned"
+        if journal is not None:
+            journal.record(config.device_id, "provisioned", dry_run=dry_run)
+    except Exception as e:
+        logger.debug(f"Provisioning of {result.interface} failed", exc_info=True)
+        result.message = str(e)
+    finally:
+        result.elapsed = time.time() - start_time
+        if journal is not None and result.device_id and not result.success:
+            journal.record_error(result.device_id, result.message)
+    return result
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Polling and rate limit answer helpers for the EL2GO API calls."""
+
+import email.utils
+import random
+import time
+from typing import Optional
+
+# Delay in seconds before the first status poll is repeated
+DEFAULT_FIRST_DELAY = 0.5
+# Number of times a request answered with 429 is sent again
+MAX_RATE_LIMIT_RETRIES = 5
+
+
+class Backoff:
+    """Exponential backoff with jitter.
+
+    The first retry comes after ``initial`` seconds, every next one waits ``factor`` times
+    longer up to ``maximum``. Each delay is randomly shortened by up to ``jitter`` of its
+    value so devices started together do not poll in lockstep.
+    """
+
+    def __init__(self, initial: float = DEFAULT_FIRST_DELAY, maximum: float = 5.0,
+                 factor: float = 2.0, jitter: float = 0.5) -> None:
+        self.initial = min(initial, maximum)
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return random.uniform(delay * (1 - self.jitter), delay)
+
+    def reset(self) -> None:
+        self.attempt = 0
+
+
+# Backoff of the generation status polls, delay (config.delay) is the longest wait between two polls.
+# A delay of 0 would poll in a busy loop, the waits never get shorter than DEFAULT_FIRST_DELAY.
+def polling_backoff(delay: float) -> Backoff:
+    return Backoff(maximum=max(delay, DEFAULT_FIRST_DELAY))
+
+
+# Seconds to wait as requested by the Retry-After header, None if there is no usable header
+def retry_after(response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_time.timestamp() - time.time())
+
+
+# Whether the backend asks the client to slow down
+def is_rate_limited(response) -> bool:
+    return response.status_code == 429 or (response.status_code == 503 and retry_after(response) is not None)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Download of Secure Objects ahead of provisioning, for UUIDs known from an earlier test step."""
+
+import csv
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from .api_utils import assign_devices_to_devicegroup, download_secure_objects_batch
+from .journal import ProvisioningJournal
+from .parameters import ConfigParameters
+from .store import get_store
+
+# Devices assigned and downloaded with one request
+DEFAULT_BATCH_SIZE = 50
+# Column names (CSV) or keys (JSON) of the UUID in a manifest
+MANIFEST_KEYS = ["uuid", "device_id", "deviceid", "id"]
+
+
+# Device id the way read_device_id returns it: the UUID as a decimal number, 0x-prefixed values are hex
+def normalize_device_id(value) -> str:
+    text = str(value).strip()
+    try:
+        return str(int(text, 16) if text.lower().startswith("0x") else int(text))
+    except ValueError:
+        raise ValueError(f"Invalid UUID in manifest: {text}")
+
+
+def _json_device_ids(data) -> list:
+    if isinstance(data, dict):
+        data = data.get("devices", [])
+    values = []
+    for item in data:
+        if isinstance(item, dict):
+            keys = {key.lower(): value for key, value in item.items()}
+            item = next((keys[key] for key in MANIFEST_KEYS if key in keys), None)
+            if item is None:
+                raise ValueError(f"No UUID in manifest entry, expected one of: {', '.join(MANIFEST_KEYS)}")
+        values.append(item)
+    return values
+
+
+def _csv_device_ids(lines: List[str]) -> list:
+    rows = [row for row in csv.reader(lines) if row and row[0].strip() and not row[0].startswith("#")]
+    if not rows:
+        return []
+    header = [cell.strip().lower() for cell in rows[0]]
+    column = next((header.index(key) for key in MANIFEST_KEYS if key in header), None)
+    if column is None:
+        return [row[0] for row in rows]
+    return [row[column] for row in rows[1:] if len(row) > column]
+
+
+def read_manifest(path: str) -> List[str]:
+    """Return the device ids listed in a CSV or JSON manifest, without duplicates.
+
+    A JSON manifest is a list of UUIDs or of objects with a ``uuid`` key, optionally wrapped
+    in ``{"devices": [...]}``. A CSV manifest takes the ``uuid`` column, or the first column
+    if there is no header.
+    """
+    with open(path, "r", newline="") as f:
+        content = f.read()
+    if path.lower().endswith(".json") or content.lstrip()[:1] in ("[", "{"):
+        values = _json_device_ids(json.loads(content))
+    else:
+        values = _csv_device_ids(content.splitlines())
+    return list(dict.fromkeys(normalize_device_id(value) for value in values))
+
+
+def prestage_devices(config: ConfigParameters, device_ids: List[str], store_dir: str,
+                     batch_size: int = DEFAULT_BATCH_SIZE, refresh: bool = False,
+                     journal: Optional[ProvisioningJournal] = None) -> Dict[str, str]:
+    """Assign the devices to the device-group and download their Secure Objects into the store.
+
+    Every lot is assigned before the first download is waited for, so EL2GO generates the
+    Secure Objects of all devices at the same time. Devices already in the store are skipped
+    unless refresh is set. Returns the status of every device.
+    """
+    store = get_store(store_dir, config.hardware_family_type)
+    statuses: Dict[str, str] = {}
+    pending = []
+    for device_id in device_ids:
+        if not refresh and store.lookup(device_id) is not None:
+            statuses[device_id] = "ALREADY_STORED"
+        else:
+            pending.append(device_id)
+
+    lots = []
+    for offset in range(0, len(pending), max(1, batch_size)):
+        lot = pending[offset:offset + max(1, batch_size)]
+        to_assign = [device_id for device_id in lot if refresh or journal is None or
+                     not journal.is_done(device_id, "assigned", max_age=config.index_ttl,
+                                         device_group_id=config.device_group_id)]
+        if to_assign and assign_devices_to_devicegroup(config, to_assign) == -1:
+            statuses.update({device_id: "ASSIGN_FAILED" for device_id in to_assign})
+            lot = [device_id for device_id in lot if device_id not in to_assign]
+        elif journal is not None:
+            for device_id in to_assign:
+                journal.record(device_id, "assigned", device_group_id=config.device_group_id)
+        lots.append(lot)
+
+    for lot in filter(None, lots):
+        digests: Dict[str, Tuple[str, int]] = {}
+        lot_statuses = download_secure_objects_batch(config, lot, output_path=store.blob_path, digests=digests)
+        for device_id, status in lot_statuses.items():
+            # devices missing from the download are DOWNLOAD_FAILED and have no file to store
+            if status != "GENERATION_COMPLETED" or not os.path.exists(store.blob_path(device_id)):
+                continue
+            entry = store.add(device_id, *digests.get(store.blob_path(device_id), (None, None)))
+            if journal is not None:
+                journal.record(device_id, "generated", device_group_id=config.device_group_id)
+                journal.record(device_id, "downloaded", device_group_id=config.device_group_id,
+                               bytes=entry["size"])
+        statuses.update(lot_statuses)
+    return statuses
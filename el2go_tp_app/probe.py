@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Pre-flight check of a board before any EL2GO API call is spent on it."""
+
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from spsdk.mboot.properties import PropertyTag, Version
+
+from .el2go_tp_app import EL2GOMboot, EL2GOStatus
+from .metrics import get_metrics
+
+
+@dataclass
+class ProbeResult:
+    interface: str
+    ready: bool = False
+    bootloader_version: str = ""
+    fw_version: str = ""
+    message: str = ""
+    elapsed: float = 0.0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def __str__(self) -> str:
+        state = "READY" if self.ready else "REJECTED"
+        return f"[{state}] {self.interface} in {self.elapsed * 1000:.0f} ms: {self.message}"
+
+
+def probe(mboot: EL2GOMboot, interface: str = "", fw_version: Optional[int] = None) -> ProbeResult:
+    """Check that the board behind an opened EL2GOMboot answers and runs the provisioning firmware.
+
+    The bootloader version is read with get-property, the firmware version with the EL2GO command
+    group; with fw_version given any other firmware version rejects the board.
+    """
+    result = ProbeResult(interface=interface)
+    start_time = time.time()
+    with get_metrics().span("probe", interface=interface) as labels:
+        try:
+            current_version = mboot.get_property(PropertyTag.CURRENT_VERSION)
+            if current_version is None:
+                result.message = f"No answer to get-property: {mboot.status_string}"
+                return result
+            result.bootloader_version = str(Version(current_version[0]))
+
+            version = mboot.el2go_get_version()
+            if mboot.status_code != EL2GOStatus.SUCCESS or not version:
+                result.message = "EL2GO NXP Provisioning Firmware is not responding: " + \
+                    EL2GOStatus.desc(mboot.status_code, f"Unknown error code ({mboot.status_code})")
+                return result
+            result.fw_version = ", ".join(hex(x) for x in version)
+            if fw_version is not None and version[0] != fw_version:
+                result.message = f"Unexpected firmware version {result.fw_version}, {fw_version:#x} expected"
+                return result
+
+            result.ready = True
+            result.message = "EL2GO NXP Provisioning Firmware is responding"
+            return result
+        finally:
+            result.elapsed = time.time() - start_time
+            labels["ready"] = result.ready
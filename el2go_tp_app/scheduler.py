@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Request scheduling shared by all stations using one EL2GO tenant.
+
+Every EL2GO API request takes a token of the scheduler first. The scheduler caps the request
+rate of the whole fleet and hands free tokens to downloads before assignments and status polls,
+so a board whose Secure Objects are ready is not kept waiting by boards which are still polling.
+Stations on one host share a scheduler by connecting to the broker started with the
+``scheduler`` command (``schedulerSocket`` in the configuration), otherwise every process
+schedules its own requests.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Priorities of the requests, lower values are served first
+PRIORITY_DOWNLOAD = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_POLL = 2
+
+
+class RequestScheduler:
+    """Token bucket handing its tokens out by priority.
+
+    The bucket holds up to ``burst`` tokens and is refilled with ``rate`` tokens per second.
+    Waiting callers are served in the order of their priority, callers with the same priority
+    in the order they came. A rate of 0 disables the limit, ``block`` pauses all callers, e.g.
+    after the backend answered with 429 Too Many Requests.
+    """
+
+    def __init__(self, rate: float = 0, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiting: List[Tuple[int, int]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # Seconds until the first waiting caller may go, 0 if it can go right away
+    def _wait_time(self, now: float) -> float:
+        wait = self._blocked_until - now
+        if self.rate and self._tokens < 1:
+            wait = max(wait, (1 - self._tokens) / self.rate)
+        return max(0.0, wait)
+
+    def acquire(self, priority: int = PRIORITY_DEFAULT) -> None:
+        with self._condition:
+            if not self.rate and not self._waiting and self._blocked_until <= time.monotonic():
+                return
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiting[0] != ticket:
+                        # woken up again once a caller before this one has got its token
+                        self._condition.wait()
+                        continue
+                    wait = self._wait_time(now)
+                    if wait <= 0:
+                        if self.rate:
+                            self._tokens -= 1
+                        return
+                    self._condition.wait(wait)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+    def block(self, seconds: float) -> None:
+        with self._condition:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._condition.notify_all()
+
+
+class BrokerScheduler:
+    """Client of the scheduler broker listening on a Unix socket.
+
+    Every thread keeps its own connection, so the priority of each waiting request reaches the
+    broker. When the broker cannot be reached the requests are scheduled by ``fallback`` in this
+    process and the broker is tried again on the next request.
+    """
+
+    def __init__(self, path: str, fallback: Optional[RequestScheduler] = None) -> None:
+        self.path = path
+        self.fallback = fallback or RequestScheduler()
+        self._local = threading.local()
+
+    def _call(self, line: str) -> bool:
+        try:
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+                connection = self._local.connection = (sock, sock.makefile("rw"))
+            _, stream = connection
+            stream.write(line + "\n")
+            stream.flush()
+            if stream.readline().strip() == "OK":
+                return True
+            raise OSError("unexpected answer of the scheduler broker")
+        except OSError as e:
+            logger.warning(f"Scheduler broker {self.path} not available ({e}), scheduling locally")
+            self.close()
+            return False
+
+    def acquire(self, priority: int = PRIORITY_DEFAULT) -> None:
+        if not self._call(f"ACQUIRE {priority}"):
+            self.fallback.acquire(priority)
+
+    def block(self, seconds: float) -> None:
+        if not self._call(f"BLOCK {seconds}"):
+            self.fallback.block(seconds)
+
+    # Close the connection of the calling thread
+    def close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            for part in reversed(connection):
+                try:
+                    part.close()
+                except OSError:
+                    pass
+
+
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+    # One connection per station thread, every line is answered with OK once it is served
+    def handle(self) -> None:
+        scheduler = self.server.scheduler
+        for line in self.rfile:
+            command, _, value = line.decode("utf-8").strip().partition(" ")
+            try:
+                if command == "ACQUIRE":
+                    scheduler.acquire(int(value or PRIORITY_DEFAULT))
+                elif command == "BLOCK":
+                    scheduler.block(float(value))
+                else:
+                    raise ValueError(f"unknown command '{command}'")
+            except ValueError as e:
+                self.wfile.write(f"ERROR {e}\n".encode("utf-8"))
+                continue
+            self.wfile.write(b"OK\n")
+
+
+class SchedulerBroker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server sharing one RequestScheduler between the stations of a host."""
+
+    daemon_threads = True
+
+    def __init__(self, path: str, rate: float = 0, burst: int = 1) -> None:
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, BrokerRequestHandler)
+        self.path = path
+        self.scheduler = RequestScheduler(rate, burst)
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SchedulerBroker":
+        self.thread = threading.Thread(target=self.serve_forever, name="scheduler-broker", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self) -> "SchedulerBroker":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+class SingleFlight:
+    """Coalesce identical calls running at the same time.
+
+    The first caller of a key runs the function, callers with the same key arriving before it
+    has finished wait for it and get the same result (or exception) instead of calling again.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, dict] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = function()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+        return call["result"]
+
+
+_schedulers: Dict[Tuple[str, str], object] = {}
+_schedulers_lock = threading.Lock()
+
+
+# Return the process-wide scheduler of an API key, the broker at socket_path if one is configured
+def get_scheduler(el2go_api_key: str, rate: float = 0, socket_path: str = ""):
+    with _schedulers_lock:
+        scheduler = _schedulers.get((el2go_api_key, socket_path))
+        if scheduler is None:
+            local = RequestScheduler(rate, burst=max(1, int(rate)))
+            scheduler = BrokerScheduler(socket_path, local) if socket_path else local
+            _schedulers[(el2go_api_key, socket_path)] = scheduler
+        return scheduler
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Long-running session serving several commands over one opened interface."""
+
+import contextlib
+import logging
+import os
+import shlex
+import socket
+from typing import Iterable, List, Optional, TextIO
+
+import click
+
+logger = logging.getLogger(__name__)
+
+# Input lines ending the session
+EXIT_COMMANDS = ["exit", "quit"]
+# Subcommands not available inside a session
+SESSION_EXCLUDED_COMMANDS = ["session", "scheduler", "watch"]
+# Line written after the output of every command so clients know when it is complete
+RESPONSE_END = "END"
+
+
+class PersistentInterface:
+    """Mboot interface which stays open when McuBoot closes it.
+
+    Every subcommand opens and closes its ``EL2GOMboot``/``McuBoot``; wrapped in this proxy
+    only the first open reaches the device and the connection is closed by ``shutdown``.
+    """
+
+    def __init__(self, interface) -> None:
+        object.__setattr__(self, "_interface", interface)
+
+    def __getattr__(self, name: str):
+        return getattr(self._interface, name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self._interface, name, value)
+
+    def __str__(self) -> str:
+        return str(self._interface)
+
+    def open(self) -> None:
+        if not self._interface.is_opened:
+            self._interface.open()
+
+    def close(self) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        if self._interface.is_opened:
+            self._interface.close()
+
+
+# Run one session command line, returns False when the session should end
+def run_command(group: click.Group, obj: dict, line: str) -> bool:
+    try:
+        args = shlex.split(line)
+    except ValueError as e:
+        click.echo(f"ERROR: {e}")
+        return True
+    if not args:
+        return True
+    if args[0] in EXIT_COMMANDS:
+        return False
+
+    command = group.commands.get(args[0])
+    if command is None or args[0] in SESSION_EXCLUDED_COMMANDS:
+        click.echo(f"ERROR: Unknown command '{args[0]}', available: {', '.join(available_commands(group))}")
+        return True
+    try:
+        command.main(args[1:], prog_name=args[0], obj=obj, standalone_mode=False)
+    except click.ClickException as e:
+        e.show()
+    except SystemExit:
+        # commands call exit() on configuration errors, the session goes on
+        pass
+    except Exception as e:
+        logger.debug(f"Command '{line}' failed", exc_info=True)
+        click.echo(f"ERROR: {e}")
+    return True
+
+
+def serve_lines(group: click.Group, obj: dict, lines: Iterable[str], output: TextIO,
+                prompt: Optional[str] = None) -> bool:
+    """Execute commands from lines until the input ends or an exit command is received.
+
+    Returns False if the session was ended by an exit command.
+    """
+    with contextlib.redirect_stdout(output):
+        if prompt:
+            click.echo(prompt, nl=False)
+        for line in lines:
+            if not run_command(group, obj, line.strip()):
+                return False
+            click.echo(RESPONSE_END)
+            if prompt:
+                click.echo(prompt, nl=False)
+            output.flush()
+    return True
+
+
+# Accept clients on a local socket one after another, each connection sends command lines
+def serve_socket(group: click.Group, obj: dict, server: socket.socket) -> None:
+    while True:
+        connection, _ = server.accept()
+        try:
+            with connection, connection.makefile("r") as reader, connection.makefile("w") as writer:
+                if not serve_lines(group, obj, reader, writer):
+                    return
+        except OSError as e:
+            # a client gone in the middle of an answer ends its connection, not the session
+            logger.warning(f"Session client disconnected: {e}")
+
+
+def open_server(unix_socket: Optional[str], tcp_port: Optional[int]) -> Optional[socket.socket]:
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(unix_socket)
+    elif tcp_port is not None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # only local clients, the session drives real hardware
+        server.bind(("127.0.0.1", tcp_port))
+    else:
+        return None
+    server.listen(1)
+    return server
+
+
+def available_commands(group: click.Group) -> List[str]:
+    return [name for name in group.commands if name not in SESSION_EXCLUDED_COMMANDS]
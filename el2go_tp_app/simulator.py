@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Simulated board running the EL2GO NXP Provisioning Firmware.
+
+The simulator is an mboot interface plugin: once this module is imported it is selected by
+``get_mboot_interface(plugin="identifier=el2go_sim,...")`` like any real interface, which is
+what the ``--sim`` options of the CLI do. It answers flash-read-once, read-memory,
+write-memory, get-property and the EL2GO command group 0x20 (firmware version, provisioning).
+"""
+
+import collections
+import random
+import struct
+import time
+from typing import Deque, Dict, List, Optional, Union
+
+from spsdk.exceptions import SPSDKError
+from spsdk.mboot.commands import CmdPacket, CmdResponse, CommandTag, ResponseTag, parse_cmd_response
+from spsdk.mboot.error_codes import StatusCode
+from spsdk.mboot.protocol.base import MbootProtocolBase
+
+from .el2go_tp_app import EL2GO_TP_COMMAND_GROUP, EL2GO_TP_GET_FW_VERSION_CMD, EL2GO_TP_PROVISIONING_CMD
+
+SIM_IDENTIFIER = "el2go_sim"
+# Values answered by the simulated firmware
+SIM_FW_VERSION = 0x01000000
+SIM_PROV_SUCCESS = 0x5A5A5A5A
+SIM_PROV_FAILURE = 0x1
+# Bootloader version answered to get-property CurrentVersion (K3.1.0)
+SIM_CURRENT_VERSION = 0x4B030100
+PROPERTY_CURRENT_VERSION = 1
+
+# Names of the command kinds latencies and failures can be configured for
+SIM_COMMANDS = ["version", "provision", "fuse", "read", "write", "property"]
+SIM_SETTINGS = ["latency", "fail_rate", "timeout_rate", "timeouts"]
+
+
+def _response(tag: int, *params: int) -> CmdResponse:
+    return parse_cmd_response(struct.pack(f"<4B{len(params)}I", tag, 0, 0, len(params), *params))
+
+
+class SimulatedInterface(MbootProtocolBase):
+    """Mboot interface of a simulated board.
+
+    ``uuid`` is stored in the fuses ``fuse_start`` .. ``fuse_start + fuse_count - 1`` the way
+    ``read_device_id`` expects it; with ``fuse_address`` set the same words can also be read by
+    read-memory. Every command waits ``latency`` seconds, ``<command>_latency`` overrides it for
+    one kind of command (see SIM_COMMANDS). A command fails with the probability ``fail_rate``
+    (``<command>_fail_rate`` per kind) and gets no answer at all with ``timeout_rate``; the first
+    ``timeouts`` commands (``<command>_timeouts`` per kind) are never answered.
+    """
+
+    identifier = SIM_IDENTIFIER
+    need_data_split = False
+
+    def __init__(self, uuid: int = 1, fuse_start: int = 46, fuse_count: int = 4,
+                 fuse_address: Optional[int] = None, latency: float = 0.0, fail_rate: float = 0.0,
+                 timeout_rate: float = 0.0, timeouts: int = 0, fw_version: int = SIM_FW_VERSION,
+                 seed: Optional[int] = None, **overrides: float) -> None:
+        super().__init__(device=None)
+        allowed = [f"{command}_{name}" for command in SIM_COMMANDS for name in SIM_SETTINGS]
+        unknown = [name for name in overrides if name not in allowed]
+        if unknown:
+            raise SPSDKError(f"Unknown simulator parameters: {', '.join(unknown)}")
+        self.uuid = uuid
+        self.fuse_start = fuse_start
+        self.fuse_count = fuse_count
+        self.fuse_address = fuse_address
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.timeout_rate = timeout_rate
+        self.timeouts = timeouts
+        self.fw_version = fw_version
+        self.overrides = overrides
+        self.random = random.Random(seed)
+
+        self.memory: Dict[int, bytes] = {}
+        self.commands: List[str] = []
+        self.opened = False
+        self._responses: Deque[Union[CmdResponse, bytes, None]] = collections.deque()
+        self._pending_write: Optional[tuple] = None
+
+    def __str__(self) -> str:
+        return f"identifier='{self.identifier}', uuid={self.uuid}"
+
+    # Fuse words holding the UUID, little endian words of the big endian UUID
+    def fuse_words(self) -> List[int]:
+        buffer = self.uuid.to_bytes(4 * self.fuse_count, "big")
+        return [int.from_bytes(buffer[4 * index:4 * index + 4], "little") for index in range(self.fuse_count)]
+
+    def open(self) -> None:
+        self.opened = True
+
+    def close(self) -> None:
+        self.opened = False
+
+    @property
+    def is_opened(self) -> bool:
+        return self.opened
+
+    @classmethod
+    def scan_from_args(cls, params: str, timeout: int, extra_params: Optional[str] = None) -> List["SimulatedInterface"]:
+        return [cls(**parse_sim_params(params))]
+
+    def _setting(self, command: str, name: str) -> float:
+        return self.overrides.get(f"{command}_{name}", getattr(self, name))
+
+    def write_command(self, packet: CmdPacket) -> None:
+        # answers not read by the host (e.g. after an error) are dropped like a real board does
+        self._responses.clear()
+        self._pending_write = None
+        tag = packet.header.tag
+        params = list(packet.params)
+        if tag == EL2GO_TP_COMMAND_GROUP:
+            command = {
+                EL2GO_TP_GET_FW_VERSION_CMD: "version",
+                EL2GO_TP_PROVISIONING_CMD: "provision",
+            }.get(params[0] if params else None, "unknown")
+        else:
+            command = {
+                CommandTag.FLASH_READ_ONCE: "fuse",
+                CommandTag.READ_MEMORY: "read",
+                CommandTag.WRITE_MEMORY: "write",
+                CommandTag.GET_PROPERTY: "property",
+            }.get(tag, "unknown")
+        self.commands.append(command)
+
+        latency = self._setting(command, "latency") if command in SIM_COMMANDS else self.latency
+        if latency:
+            time.sleep(latency)
+        if self.commands.count(command) <= self._setting(command, "timeouts") or \
+                self.random.random() < self._setting(command, "timeout_rate"):
+            self._responses.append(None)
+            return
+        failed = self.random.random() < self._setting(command, "fail_rate")
+        status = StatusCode.FAIL if failed else StatusCode.SUCCESS
+
+        if command == "version":
+            self._responses.append(_response(ResponseTag.TRUST_PROVISIONING_RESPONSE, status, self.fw_version))
+        elif command == "provision":
+            address = params[1] if len(params) > 1 else 0
+            result = SIM_PROV_SUCCESS if self.memory.get(address) else SIM_PROV_FAILURE
+            self._responses.append(_response(ResponseTag.TRUST_PROVISIONING_RESPONSE, status, result))
+        elif command == "fuse":
+            index = params[0]
+            offset = index - self.fuse_start
+            value = self.fuse_words()[offset] if 0 <= offset < self.fuse_count else 0
+            self._responses.append(_response(ResponseTag.FLASH_READ_ONCE, status, 4, value))
+        elif command == "read":
+            address, length = params[0], params[1]
+            self._responses.append(_response(ResponseTag.READ_MEMORY, status, length))
+            if not failed:
+                self._responses.append(self._read(address, length))
+                self._responses.append(_response(ResponseTag.GENERIC, status, tag))
+        elif command == "write":
+            self._responses.append(_response(ResponseTag.GENERIC, status, tag))
+            if not failed:
+                self._pending_write = (params[0], params[1], bytearray())
+        elif command == "property":
+            value = SIM_CURRENT_VERSION if params and params[0] == PROPERTY_CURRENT_VERSION else 0
+            self._responses.append(_response(ResponseTag.GET_PROPERTY, status, value))
+        else:
+            self._responses.append(_response(ResponseTag.GENERIC, StatusCode.UNKNOWN_COMMAND, tag))
+
+    def write_data(self, data: bytes) -> None:
+        if self._pending_write is None:
+            raise SPSDKError("Simulated board received data without a write-memory command")
+        address, length, buffer = self._pending_write
+        buffer += data
+        if len(buffer) >= length:
+            self.memory[address] = bytes(buffer[:length])
+            self._pending_write = None
+            self._responses.append(_response(ResponseTag.GENERIC, StatusCode.SUCCESS, CommandTag.WRITE_MEMORY))
+
+    def read(self, length: Optional[int] = None) -> Union[CmdResponse, bytes]:
+        if not self._responses:
+            raise TimeoutError("Simulated board has nothing to send")
+        response = self._responses.popleft()
+        if response is None:
+            raise TimeoutError("Simulated board did not answer")
+        return response
+
+    # Memory content, the UUID fuse words are mirrored at fuse_address
+    def _read(self, address: int, length: int) -> bytes:
+        data = bytearray(length)
+        regions = list(self.memory.items())
+        if self.fuse_address is not None:
+            regions.append((self.fuse_address, struct.pack(f"<{self.fuse_count}I", *self.fuse_words())))
+        for start, content in regions:
+            begin, end = max(address, start), min(address + length, start + len(content))
+            if begin < end:
+                data[begin - address:end - address] = content[begin - start:end - start]
+        return bytes(data)
+
+
+# Parse "uuid=0x1234,latency=0.01,provision_latency=2" into keyword arguments of SimulatedInterface
+def parse_sim_params(params: str) -> dict:
+    kwargs: dict = {}
+    for item in filter(None, (part.strip() for part in (params or "").split(","))):
+        name, _, value = item.partition("=")
+        if name in ("uuid", "fuse_start", "fuse_count", "fuse_address", "fw_version", "seed"):
+            kwargs[name] = int(value, 0)
+        else:
+            kwargs[name] = float(value)
+    return kwargs
+
+
+# Value of the "plugin" argument of get_mboot_interface selecting a simulated board
+def sim_plugin(params: str = "") -> str:
+    return ",".join(filter(None, [f"identifier={SIM_IDENTIFIER}", params]))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Per-device store of downloaded Secure Objects."""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Size of the blocks used when hashing stored blobs
+HASH_BLOCK_SIZE = 64 * 1024
+# Seconds a blob must be unmodified before its verified hash is trusted while its size and
+# modification time stay the same
+RACY_MTIME_WINDOW = 2.0
+
+
+class AtomicWriter:
+    """File written under a temporary name and renamed to its final path on commit.
+
+    Readers never see a partially written file, the SHA-256 and size of the content are
+    computed while writing.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=".part")
+        self.file = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def commit(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self) -> "AtomicWriter":
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback) -> None:
+        if exception_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def file_sha256(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class SecureObjectStore:
+    """Directory of Secure Object blobs keyed by hardware family and device UUID.
+
+    Blobs are stored as ``<root>/<hardware family>/<device id>.bin``. Every completed blob is
+    recorded with its SHA-256 in ``<root>/index.jsonl``; each record is a single line appended
+    with O_APPEND, so several stations can share one directory. The index is kept in memory and
+    read again only when the size or modification time of the file changes; a blob whose hash
+    has been checked once is not hashed again while its size and modification time are unchanged.
+    """
+
+    INDEX_FILE = "index.jsonl"
+
+    def __init__(self, root: str, hardware_family_type: str) -> None:
+        self.root = root
+        self.hardware_family_type = hardware_family_type
+        self.index_path = os.path.join(root, self.INDEX_FILE)
+        self.entries: Dict[str, dict] = {}
+        self._index_stat: Optional[Tuple[int, int]] = None
+        # device id -> size, mtime and recorded SHA-256 of the blob when its hash matched the index
+        self._verified: Dict[str, Tuple[int, int, str]] = {}
+        self._lock = threading.Lock()
+
+    def blob_path(self, device_id: str) -> str:
+        return os.path.join(self.root, self.hardware_family_type, f"{device_id}.bin")
+
+    def _read_index(self) -> Dict[str, dict]:
+        with self._lock:
+            try:
+                stat = os.stat(self.index_path)
+            except OSError:
+                self.entries, self._index_stat = {}, None
+                return self.entries
+            if (stat.st_size, stat.st_mtime_ns) == self._index_stat:
+                return self.entries
+            entries: Dict[str, dict] = {}
+            try:
+                with open(self.index_path, "r") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # a line cut short by a crash of another writer
+                            continue
+                        if entry.get("hardware_family_type") == self.hardware_family_type:
+                            entries[entry["device_id"]] = entry
+            except OSError:
+                pass
+            self.entries, self._index_stat = entries, (stat.st_size, stat.st_mtime_ns)
+            return entries
+
+    # Record the blob of a device already written to blob_path, "indexed" tells whether it was
+    # written with a sidecar index, such a blob is invalid once its index is gone. The SHA-256 and
+    # size computed while writing the blob are taken as they are, the file is hashed without them.
+    def add(self, device_id: str, sha256: Optional[str] = None, size: Optional[int] = None) -> dict:
+        # blob_index builds on the AtomicWriter of this module
+        from .blob_index import index_path
+
+        path = self.blob_path(device_id)
+        entry = {
+            "device_id": device_id,
+            "hardware_family_type": self.hardware_family_type,
+            "path": os.path.relpath(path, self.root),
+            "sha256": sha256 or file_sha256(path),
+            "size": os.path.getsize(path) if size is None else size,
+            "indexed": os.path.exists(index_path(path)),
+            "time": time.time(),
+        }
+        os.makedirs(self.root, exist_ok=True)
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        return entry
+
+    # Store blob data of a device atomically and record it
+    def put(self, device_id: str, data: bytes) -> dict:
+        with AtomicWriter(self.blob_path(device_id)) as writer:
+            writer.write(data)
+        return self.add(device_id, writer.hash.hexdigest(), writer.size)
+
+    # Return the index entry of a device if its blob is complete and unchanged, None otherwise
+    def lookup(self, device_id: str) -> Optional[dict]:
+        entry = self._read_index().get(device_id)
+        if entry is None:
+            return None
+        path = os.path.join(self.root, entry["path"])
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if stat.st_size != entry["size"]:
+            return None
+        blob_stat = (stat.st_size, stat.st_mtime_ns, entry["sha256"])
+        with self._lock:
+            verified = self._verified.get(device_id) == blob_stat
+        if not verified:
+            if file_sha256(path) != entry["sha256"]:
+                return None
+            # a blob modified within the timestamp granularity could change again unnoticed,
+            # it is hashed on every lookup until its modification time is safely in the past
+            if time.time() - stat.st_mtime > RACY_MTIME_WINDOW:
+                with self._lock:
+                    self._verified[device_id] = blob_stat
+        return entry
+
+    # All devices of the hardware family with a recorded blob
+    def completed_devices(self) -> Dict[str, dict]:
+        return dict(self._read_index())
+
+
+_stores: Dict[Tuple[str, str], SecureObjectStore] = {}
+_stores_lock = threading.Lock()
+
+
+# Return the process-wide store of the given directory and hardware family
+def get_store(root: str, hardware_family_type: str) -> SecureObjectStore:
+    with _stores_lock:
+        key = (os.path.abspath(root), hardware_family_type)
+        store = _stores.get(key)
+        if store is None:
+            store = SecureObjectStore(root, hardware_family_type)
+            _stores[key] = store
+        return store
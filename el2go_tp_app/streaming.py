@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Streaming decode of downloaded provisionings."""
+
+import base64
+import codecs
+import json
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .blob_index import BlobIndex, object_id
+from .store import AtomicWriter
+
+# Size of the chunks read from the download response
+CHUNK_SIZE = 64 * 1024
+
+
+# Characters which matter while looking for the end of an element, outside and inside of strings
+_STRUCTURE = re.compile(r'["\[\]{},]')
+_STRING = re.compile(r'["\\]')
+
+
+class _ElementScanner:
+    """Find the comma or bracket ending the current element of a JSON array, chunk by chunk.
+
+    Only brackets, braces, commas and quotes are looked at, so every received character is
+    scanned once and the element is decoded once it is complete.
+    """
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    # Offset in text of the character ending the element, None if the element goes on after text
+    def scan(self, text: str) -> Optional[int]:
+        position = 0
+        if self.escaped and text:
+            self.escaped = False
+            position = 1
+        while True:
+            if self.in_string:
+                match = _STRING.search(text, position)
+                if match is None:
+                    return None
+                if match.group() == "\\":
+                    if match.end() == len(text):
+                        self.escaped = True
+                        return None
+                    position = match.end() + 1
+                else:
+                    self.in_string = False
+                    position = match.end()
+                continue
+            match = _STRUCTURE.search(text, position)
+            if match is None:
+                return None
+            position = match.end()
+            char = match.group()
+            if char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.depth += 1
+            elif self.depth == 0:
+                return match.start()
+            elif char != ",":
+                self.depth -= 1
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """Yield the elements of a JSON array as soon as each of them has been received.
+
+    Only the not yet consumed part of the document is kept, so the memory needed is bounded by
+    the size of one element (the provisionings of one device) instead of the whole answer.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    eof = False
+
+    # Next piece of decoded text, None at the end of the document
+    def read_more() -> Optional[str]:
+        nonlocal eof
+        while not eof:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+                text = text_decoder.decode(b"", final=True)
+            else:
+                text = text_decoder.decode(chunk)
+            if text:
+                return text
+        return None
+
+    def skip_whitespace(text: str) -> str:
+        text = text.lstrip()
+        while not text:
+            more = read_more()
+            if more is None:
+                return ""
+            text = more.lstrip()
+        return text
+
+    rest = skip_whitespace("")
+    if not rest.startswith("["):
+        raise ValueError("Downloaded provisionings are not a JSON array")
+    rest = skip_whitespace(rest[1:])
+    if rest.startswith("]"):
+        return
+
+    while True:
+        rest = skip_whitespace(rest)
+        scanner = _ElementScanner()
+        pieces: List[str] = []
+        end = scanner.scan(rest)
+        while end is None:
+            pieces.append(rest)
+            rest = read_more()
+            if rest is None:
+                raise ValueError("Downloaded provisionings end in the middle of an element")
+            end = scanner.scan(rest)
+        pieces.append(rest[:end])
+        element = "".join(pieces)
+        item, item_end = decoder.raw_decode(element)
+        if element[item_end:].strip():
+            raise ValueError("Downloaded provisionings are not a valid JSON array")
+        yield item
+
+        rest = rest[end:]
+        if rest.startswith(","):
+            rest = rest[1:]
+        elif rest.startswith("]"):
+            return
+        else:
+            raise ValueError("Downloaded provisionings are not a valid JSON array")
+
+
+# Yield (device id, object id, decoded createApdu) of every Secure Object in a streamed download response.
+# A device listed without any Secure Object is yielded once as (device id, None, b"") so it still gets
+# its (empty) file.
+def stream_secure_objects(response) -> Iterator[Tuple[str, Optional[str], bytes]]:
+    for device_provisioning in iter_json_array(response.iter_content(chunk_size=CHUNK_SIZE)):
+        device_id = str(device_provisioning.get("deviceId", ""))
+        if not device_provisioning["rtpProvisionings"]:
+            yield device_id, None, b""
+        for position, rtp_provisioning in enumerate(device_provisioning["rtpProvisionings"]):
+            yield device_id, object_id(rtp_provisioning, position), \
+                base64.b64decode(rtp_provisioning["apdus"]["createApdu"]["apdu"])
+
+
+# Yield (device id, decoded createApdu) of every Secure Object in a streamed download response
+def stream_apdus(response) -> Iterator[Tuple[str, bytes]]:
+    for device_id, identifier, apdu in stream_secure_objects(response):
+        if identifier is not None:
+            yield device_id, apdu
+
+
+# Pass the Secure Objects through unchanged, keeping the decoded buffers in collected
+def collect_apdus(secure_objects: Iterable[Tuple[str, Optional[str], bytes]],
+                  collected: List[bytes]) -> Iterator[Tuple[str, Optional[str], bytes]]:
+    for device_id, identifier, apdu in secure_objects:
+        if identifier is not None:
+            collected.append(apdu)
+        yield device_id, identifier, apdu
+
+
+# Write every Secure Object to the file returned by output_path for its device, returns bytes written
+# per device. Files are written atomically, a download failing half way leaves the previous file
+# untouched. The sidecar index of a file is written right before the file is committed: a crash in
+# between leaves the new index next to the old file, which then fails validation. The SHA-256 and
+# size of every committed file are put into digests, keyed by its path.
+def write_apdus(secure_objects: Iterable[Tuple[str, Optional[str], bytes]],
+                output_path: Callable[[str], str],
+                digests: Optional[Dict[str, Tuple[str, int]]] = None) -> Dict[str, int]:
+    written: Dict[str, int] = {}
+    writer = None
+    index = BlobIndex()
+
+    def commit() -> None:
+        index.write(writer.path)
+        writer.commit()
+        if digests is not None:
+            digests[writer.path] = (writer.hash.hexdigest(), writer.size)
+
+    try:
+        for device_id, identifier, apdu in secure_objects:
+            if writer is None or output_path(device_id) != writer.path:
+                if writer is not None:
+                    commit()
+                writer = AtomicWriter(output_path(device_id))
+                index = BlobIndex()
+            if identifier is not None:
+                writer.write(apdu)
+                index.add(identifier, apdu)
+            written[device_id] = written.get(device_id, 0) + len(apdu)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    if writer is not None:
+        commit()
+    return written
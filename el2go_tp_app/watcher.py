@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright 2023 NXP
+#
+# SPDX-License-Identifier: BSD-3-Clause
+"""Continuous provisioning of the boards attached to the station."""
+
+import fnmatch
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from .batch import interface_name
+from .pipeline import DeviceResult
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two scans of the attached interfaces
+DEFAULT_SCAN_INTERVAL = 1.0
+
+
+# USB devices answering as an mboot bootloader, keyed by their device path
+def scan_usb(timeout: Optional[int] = None) -> List[Dict[str, str]]:
+    from spsdk.mboot.interfaces.usb import MbootUSBInterface
+    from spsdk.utils.interfaces.device.usb_device import UsbDevice
+
+    devices = UsbDevice.scan(usb_devices_filter=MbootUSBInterface.usb_devices, timeout=timeout)
+    return [{"usb": device.path.decode("utf-8", errors="replace")} for device in devices if device.path]
+
+
+# Serial ports whose name matches one of the patterns, e.g. /dev/ttyACM*; a port is not opened
+# here, the pre-flight probe finds out whether a board answers on it
+def scan_uart(patterns: List[str], baudrate: Optional[int] = None) -> List[Dict[str, str]]:
+    from serial.tools.list_ports import comports
+
+    ports = sorted(port.device for port in comports())
+    ports = [port for port in ports if any(fnmatch.fnmatch(port, pattern) for pattern in patterns)]
+    return [{"port": f"{port},{baudrate}" if baudrate else port} for port in ports]
+
+
+class BoardWatcher:
+    """Provision every board showing up in the scans, at most ``workers`` boards at a time.
+
+    ``scan`` returns the interface arguments of the attached boards, ``provision`` runs the
+    flow on one of them. A board is provisioned once per attachment: it has to disappear from
+    the scans before it is provisioned again, so a board left on the fixture is not touched
+    twice.
+    """
+
+    def __init__(self, scan: Callable[[], List[Dict[str, str]]], provision: Callable[[Dict[str, str]], DeviceResult],
+                 workers: int = 1, interval: float = DEFAULT_SCAN_INTERVAL) -> None:
+        self.scan = scan
+        self.provision = provision
+        self.workers = max(1, workers)
+        self.interval = interval
+        self.attached: Dict[str, Dict[str, str]] = {}
+        self.running: Dict[str, Future] = {}
+        self._stop = threading.Event()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _scan(self) -> Dict[str, Dict[str, str]]:
+        try:
+            return {interface_name(interface_args): interface_args for interface_args in self.scan()}
+        except Exception as e:
+            # e.g. a port disappearing while it is listed, the next scan goes on
+            logger.warning(f"Scanning interfaces failed: {e}")
+            return dict(self.attached)
+
+    # Boards attached since the previous scan
+    def poll(self) -> List[Dict[str, str]]:
+        present = self._scan()
+        new = [interface_args for name, interface_args in present.items() if name not in self.attached]
+        for name in self.attached:
+            if name not in present:
+                logger.info(f"Board detached from {name}")
+        self.attached = present
+        return new
+
+    def run(self, on_result: Callable[[DeviceResult], None], max_boards: Optional[int] = None) -> int:
+        """Watch for boards until stop is called or max_boards boards were provisioned.
+
+        Returns the number of provisioned boards, every result is passed to on_result.
+        """
+        finished = 0
+        submitted = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="el2go-board") as executor:
+            while not self._stop.is_set():
+                for interface_args in self.poll():
+                    if max_boards is not None and submitted >= max_boards:
+                        break
+                    name = interface_name(interface_args)
+                    logger.info(f"Board attached to {name}")
+                    self.running[name] = executor.submit(self.provision, interface_args)
+                    submitted += 1
+
+                for name, future in list(self.running.items()):
+                    if future.done():
+                        del self.running[name]
+                        on_result(future.result())
+                        finished += 1
+                if max_boards is not None and finished >= max_boards:
+                    break
+                self._stop.wait(self.interval)
+            for name, future in self.running.items():
+                on_result(future.result())
+                finished += 1
+            self.running.clear()
+        return finished
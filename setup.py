@@ -17,6 +17,10 @@ with open("HISTORY.rst") as history_file:
 
 requirements = ["Click>=8.0", "spsdk<2.1"]
 
+extras_requirements = {
+    "async": ["httpx>=0.23"],
+}
+
 test_requirements = [
     "pytest>=3",
 ]
@@ -43,6 +47,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="BSD license",
     long_description=readme + "\n\n" + history,
     include_package_data=True,
@@ -7,10 +7,992 @@
 
 """Tests for `el2go_tp_app` package."""
 
+import asyncio
+import base64
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
 import pytest
 
+import click
 from click.testing import CliRunner
 
 from el2go_tp_app import el2go_tp_app
 from el2go_tp_app import cli
+from el2go_tp_app import api_utils
+from el2go_tp_app import async_api_utils
+from el2go_tp_app import batch
+from el2go_tp_app import benchmark
+from el2go_tp_app import blob_index
+from el2go_tp_app import pipeline
+from el2go_tp_app import prestage
+from el2go_tp_app import session
+from el2go_tp_app import simulator
+from el2go_tp_app import watcher
+from el2go_tp_app.cache import ProvisioningCache
+from el2go_tp_app.device_index import DeviceGroupIndex
+from el2go_tp_app.journal import ProvisioningJournal
+from el2go_tp_app.metrics import get_metrics
+from el2go_tp_app.mock_backend import MockBackend, MockEL2GOServer
+from el2go_tp_app import parameters
+from el2go_tp_app.parameters import ConfigParameters, str_little_endian
+from el2go_tp_app.polling import DEFAULT_FIRST_DELAY, Backoff, polling_backoff
+from el2go_tp_app.scheduler import (
+    PRIORITY_DOWNLOAD, PRIORITY_POLL, BrokerScheduler, RequestScheduler, SchedulerBroker, SingleFlight
+)
+from el2go_tp_app import store as store_module
+from el2go_tp_app.store import SecureObjectStore
+from el2go_tp_app.streaming import iter_json_array, stream_apdus, stream_secure_objects, write_apdus
+
+
+@pytest.fixture(autouse=True)
+def app_home(tmp_path, monkeypatch):
+    monkeypatch.setenv("EL2GO_TP_APP_HOME", str(tmp_path / "home"))
+
+
+def test_client_is_shared_per_api_key():
+    config = ConfigParameters()
+    config.el2go_api_key = "test-key"
+    client = api_utils.get_client(config)
+    assert api_utils.get_client(config) is client
+    assert client.session.headers["EL2G-API-Key"] == "test-key"
+
+
+CONFIG_XML = """<config>
+    <deviceGroupId>49</deviceGroupId>
+    <nc12>935123456789</nc12>
+    <hardwareFamilyType>RW61x</hardwareFamilyType>
+    <firstFuseAddress>46</firstFuseAddress>
+    <lastFuseAddress>49</lastFuseAddress>
+    <delay>0</delay>
+    <timeout>5</timeout>
+    <el2goSettings>
+        <edgelock2goHostname>localhost</edgelock2goHostname>
+        <edgelock2goApiKey>test-key</edgelock2goApiKey>
+        <edgelock2goApiUrl>http://127.0.0.1:1/api/v1</edgelock2goApiUrl>
+    </el2goSettings>
+</config>
+"""
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = tmp_path / "config.xml"
+    path.write_text(CONFIG_XML)
+    return str(path)
+
+
+PROFILES_XML = CONFIG_XML.replace("</config>", """    <profiles>
+        <profile name="sku-a">
+            <deviceGroupId>50</deviceGroupId>
+        </profile>
+        <profile name="sku-b">
+            <nc12>935000000001</nc12>
+            <firstFuseAddress>100</firstFuseAddress>
+            <lastFuseAddress>101</lastFuseAddress>
+        </profile>
+        <profile name="broken">
+            <timeout>-1</timeout>
+        </profile>
+    </profiles>
+</config>""")
+
+
+def test_config_profiles_are_compiled_once(tmp_path, monkeypatch):
+    path = tmp_path / "profiles.xml"
+    path.write_text(PROFILES_XML)
+    parses = []
+    parse = parameters._parse_config_file
+    monkeypatch.setattr(parameters, "_parse_config_file", lambda file: parses.append(file) or parse(file))
+
+    config = ConfigParameters()
+    assert config.parse_config_file(str(path), "sku-b") == 0
+    assert (config.device_group_id, config.nc12, config.uuid_fuse_start, config.uuid_fuse_end) == \
+        ("49", "935000000001", 100, 101)
+    assert config.parse_config_file(str(path), "sku-a") == 0
+    assert (config.device_group_id, config.nc12, config.profile) == ("50", "935123456789", "sku-a")
+    assert ConfigParameters().parse_config_file(str(path)) == 0
+    assert ConfigParameters().parse_config_file(str(path), "broken") == -1
+    assert ConfigParameters().parse_config_file(str(path), "unknown") == -1
+    assert parameters.config_profiles(str(path)) == ["sku-a", "sku-b", "broken"]
+    assert len(parses) == 1
+
+    path.write_text(PROFILES_XML.replace("<deviceGroupId>50<", "<deviceGroupId>51<"))
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    assert config.parse_config_file(str(path), "sku-a") == 0
+    assert config.device_group_id == "51"
+    assert len(parses) == 2
+
+
+def test_provision_batch_reports_every_device(config_file):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.main, ["provision-batch", config_file, "0x20000000", "--port", "/dev/el2go-none-1",
+                   "--port", "/dev/el2go-none-2"]
+    )
+    assert result.exit_code == 0
+    assert result.output.count("[FAIL]") == 2
+    assert "Provisioned 0 of 2 devices." in result.output
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200, url="http://el2go"):
+        self.content = json.dumps(body).encode("utf-8")
+        self.status_code = status_code
+        self.url = url
+        self.headers = {}
+        self.closed = False
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        for offset in range(0, len(self.content), 7):
+            yield self.content[offset:offset + 7]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    """Answers the generation status and download requests for a set of devices."""
+
+    def __init__(self, provisionings):
+        self.provisionings = provisionings
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(("GET", url))
+        return FakeResponse({"content": [{"provisioningState": "GENERATION_COMPLETED"}]})
+
+    def post(self, url, json=None, **kwargs):
+        self.requests.append(("POST", url))
+        return FakeResponse([
+            {"deviceId": device_id, "rtpProvisionings": [
+                {"apdus": {"createApdu": {"apdu": base64.b64encode(apdu).decode()}}} for apdu in apdus
+            ]}
+            for device_id, apdus in self.provisionings.items() if device_id in json["deviceIds"]
+        ])
+
+
+def test_download_secure_objects_batch_writes_per_device(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_utils.time, "sleep", lambda _: None)
+    config = ConfigParameters()
+    config.timeout = 5
+    client = FakeClient({"1": [b"\x01\x02", b"\x03"], "2": [b"\x04"]})
+    statuses = api_utils.download_secure_objects_batch(config, ["1", "2"], str(tmp_path), client)
+    assert statuses == {"1": "GENERATION_COMPLETED", "2": "GENERATION_COMPLETED"}
+    assert len([request for request in client.requests if request[0] == "POST"]) == 1
+    assert (tmp_path / "Secure_Objects_1.bin").read_bytes() == b"\x01\x02\x03"
+    assert (tmp_path / "Secure_Objects_2.bin").read_bytes() == b"\x04"
+
+    # a device whose status request fails is reported alone, the others are still downloaded
+    get = client.get
+    client.get = lambda url, **kwargs: FakeResponse({}, status_code=500) if "/3/" in url else get(url, **kwargs)
+    statuses = api_utils.download_secure_objects_batch(config, ["2", "3"], str(tmp_path), client)
+    assert statuses == {"2": "GENERATION_COMPLETED", "3": "STATUS_FAILED"}
+
+
+def test_blob_index_catches_damaged_secure_objects(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_utils.time, "sleep", lambda _: None)
+    config = ConfigParameters()
+    config.timeout = 5
+    api_utils.download_secure_objects_batch(config, ["1"], str(tmp_path), FakeClient({"1": [b"\x01\x02", b"\x03"]}))
+    blob = str(tmp_path / "Secure_Objects_1.bin")
+    index = blob_index.load_index(blob)
+    assert [(entry["offset"], entry["length"], entry["object_id"]) for entry in index["objects"]] == \
+        [(0, 2, "0"), (2, 1, "1")]
+    assert blob_index.check_blob_file(blob) is None
+    assert "damaged" in blob_index.check_blob_file(blob, b"\x01\x02\x04")
+    assert "expected" in blob_index.check_blob_file(blob, b"\x01\x02")
+    # a blob written with an index is invalid once the index is gone
+    os.rename(blob_index.index_path(blob), blob + ".moved")
+    assert blob_index.check_blob_file(blob) is None
+    assert "missing" in blob_index.check_blob_file(blob, required=True)
+    os.rename(blob + ".moved", blob_index.index_path(blob))
+
+    # the index travels with the blob through the cache, a damaged cache entry is downloaded again
+    cache = ProvisioningCache(str(tmp_path / "cache"))
+    cache.put("7", "1", blob)
+    with open(cache.entry_path("7", "1"), "r+b") as f:
+        f.write(b"\xff")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline.ProvisioningCache, "from_config", classmethod(lambda cls, config: cache))
+    monkeypatch.setattr(api_utils, "get_client", lambda config: FakeClient({"1": [b"\x01\x02", b"\x03"]}))
+    config.device_group_id = "7"
+    config.device_id = "1"
+    assert pipeline.fetch_secure_objects(config) == ("GENERATION_COMPLETED", [b"\x01\x02", b"\x03"])
+
+    result = CliRunner().invoke(cli.main, ["verify", blob])
+    assert result.exit_code == 0 and "2 Secure Objects" in result.output
+    open(blob, "ab").write(b"\x00")
+    assert CliRunner().invoke(cli.main, ["verify", blob]).exit_code == 1
+
+
+def test_stage_metrics_are_collected_and_exported(tmp_path, monkeypatch):
+    metrics = get_metrics()
+    metrics.reset()
+    config = ConfigParameters()
+    config.device_id = "1"
+    config.timeout = 5
+    client = FakeClient({"1": [b"\x01\x02", b"\x03"]})
+    output = str(tmp_path / "Secure_Objects.bin")
+    assert api_utils.download_secure_objects(config, client, output) == "GENERATION_COMPLETED"
+
+    http_client = api_utils.EL2GOClient("metrics-key")
+    monkeypatch.setattr(http_client.session, "request", lambda *args, **kwargs: FakeResponse({}, status_code=404))
+    http_client.get("http://el2go/devices")
+
+    summary = metrics.summary()
+    assert summary["generation_wait"]["count"] == 1
+    assert summary["download"]["count"] == 1
+    assert [span["labels"]["status"] for span in metrics.spans if span["name"] == "http_request"] == [404]
+    prometheus = metrics.to_prometheus()
+    assert 'el2go_tp_app_download_bytes_total{} 3' in prometheus
+    assert 'el2go_tp_app_http_requests_total{method="GET",status="404"} 1' in prometheus
+
+    metrics_file = tmp_path / "metrics.jsonl"
+    metrics.write_jsonl(str(metrics_file))
+    lines = [json.loads(line) for line in metrics_file.read_text().splitlines()]
+    assert {line["name"] for line in lines if line["type"] == "span"} == {"generation_wait", "download", "http_request"}
+    # written spans are dropped, the stage histograms keep the whole history
+    assert not metrics.spans and metrics.summary() == summary
+    assert 'el2go_tp_app_stage_duration_seconds_bucket{stage="download",le="+Inf"} 1' in metrics.to_prometheus()
+    metrics.reset()
+
+
+def test_flow_against_mock_backend(tmp_path):
+    backend = MockBackend(generation_latency=0.2, payload_size=100, objects_per_device=3)
+    backend.register("7", ["42"])
+    with MockEL2GOServer(backend) as server:
+        config = benchmark.benchmark_config(server.url, timeout=10)
+        config.device_id = "43"
+        output = str(tmp_path / "Secure_Objects.bin")
+        assert api_utils.get_device_secure_objects(config, output) == "GENERATION_COMPLETED"
+        assert open(output, "rb").read() == backend.payload("43")
+        assert api_utils.find_device_group(config, "42") == "7"
+
+    results = benchmark.run_benchmark(["batch", "concurrent"], 3, MockBackend(), workers=2)
+    assert [(result.mode, result.succeeded) for result in results] == [("batch", 3), ("concurrent", 3)]
+    assert all(result.devices_per_minute > 0 and result.p99_latency >= result.p50_latency for result in results)
+
+    # a run getting worse than its baseline beyond the margin fails
+    baseline = [dict(results[0].to_dict(), devices_per_minute=results[0].devices_per_minute * 2)]
+    assert benchmark.find_regressions(results, baseline) and not benchmark.find_regressions(results, baseline, 0.6)
+    baseline = [dict(results[1].to_dict(), p99_latency=results[1].p99_latency / 2)]
+    assert "p99" in benchmark.find_regressions(results, baseline)[0]
+    baseline_file = tmp_path / "baseline.json"
+    baseline_file.write_text(json.dumps([dict(results[0].to_dict(), devices_per_minute=1e9)]))
+    result = CliRunner().invoke(benchmark.main, ["-m", "batch", "-n", "2", "--baseline", str(baseline_file)])
+    assert result.exit_code == 1 and "REGRESSION: batch" in result.output
+
+
+def test_prestage_fills_store_from_manifest(tmp_path):
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("station,uuid\nA,0x2A\nB,43\nC,42\n")
+    assert prestage.read_manifest(str(manifest)) == ["42", "43"]
+    (tmp_path / "manifest.json").write_text(json.dumps({"devices": [{"UUID": "0x2a"}, 44]}))
+    assert prestage.read_manifest(str(tmp_path / "manifest.json")) == ["42", "44"]
+
+    backend = MockBackend(generation_latency=0.2, payload_size=64)
+    journal = ProvisioningJournal(str(tmp_path / "journal.jsonl"))
+    store_dir = str(tmp_path / "store")
+    with MockEL2GOServer(backend) as server:
+        config = benchmark.benchmark_config(server.url, timeout=10)
+        statuses = prestage.prestage_devices(config, ["42", "43", "44"], store_dir, batch_size=2, journal=journal)
+        assert statuses == dict.fromkeys(["42", "43", "44"], "GENERATION_COMPLETED")
+        requests = backend.requests
+
+        # the boards are then served from the store without any API call
+        store = SecureObjectStore(store_dir, config.hardware_family_type)
+        assert open(store.blob_path("43"), "rb").read() == backend.payload("43")
+        config.device_id = "43"
+        assert pipeline.fetch_secure_objects(config, store_dir) == ("GENERATION_COMPLETED", [backend.payload("43")])
+        assert prestage.prestage_devices(config, ["42"], store_dir) == {"42": "ALREADY_STORED"}
+        assert backend.requests == requests
+        assert journal.last_stage("44") == "downloaded"
+
+        # a device missing from the download answer fails alone, the other lots are still stored
+        download = backend.download
+        backend.download = lambda **kwargs: (lambda status, answer: (
+            status, [item for item in answer if item["deviceId"] != "46"]))(*download(**kwargs))
+        statuses = prestage.prestage_devices(config, ["45", "46", "47"], store_dir, batch_size=2)
+        assert statuses == {"45": "GENERATION_COMPLETED", "46": "DOWNLOAD_FAILED", "47": "GENERATION_COMPLETED"}
+        assert store.lookup("47") and store.lookup("46") is None
+
+
+class PagedClient:
+    """Serves two device-groups with two pages of devices each."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, url, params=None):
+        self.calls += 1
+        page = params["page"]
+        if url.endswith("/device-groups"):
+            return FakeResponse({"content": [{"id": 1}, {"id": 2}], "last": True})
+        group_id = url.split("/")[-2]
+        devices = [{"device": {"id": f"{group_id}-{page}"}}]
+        return FakeResponse({"content": devices, "last": page == 1})
+
+
+def test_device_index_is_paginated_and_cached(tmp_path):
+    config = ConfigParameters()
+    config.nc12 = "935123456789"
+    client = PagedClient()
+    index = DeviceGroupIndex(config, path=str(tmp_path / "index.json"))
+    assert index.lookup(client, "2-1") == "2"
+    assert client.calls == 5
+
+    # a second index is loaded from disk without any request
+    cached = DeviceGroupIndex(config, path=str(tmp_path / "index.json"))
+    assert cached.lookup(client, "1-0") == "1"
+    assert client.calls == 5
+
+    # assignments only change the index in memory, a stale entry is caught before its group is unclaimed
+    cached.remove_group("1")
+    cached.set_group(["1-0"], "3")
+    assert cached.devices == {"1-0": "3", "2-0": "2", "2-1": "2"}
+    assert DeviceGroupIndex(config, path=str(tmp_path / "index.json")).devices["1-0"] == "1"
+    cached.set_group(["1-1"], "2")
+    assert cached.lookup_many_confirmed(client, ["1-1", "2-0"]) == {"1-1": "1", "2-0": "2"}
+    assert client.calls == 12
+
+    # unknown devices don't rebuild a fresh index, concurrent lookups of a stale one share a rebuild
+    assert cached.lookup_many(client, ["9-0", "9-1", "2-0"]) == {"9-0": "", "9-1": "", "2-0": "2"}
+    assert client.calls == 12
+    stale = DeviceGroupIndex(config, path=str(tmp_path / "stale.json"))
+    threads = [threading.Thread(target=stale.lookup, args=(client, f"9-{index}")) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.calls == 17
+
+
+class FakeAsyncClient(FakeClient):
+    """Device "slow" never leaves the triggered state, device "broken" answers with 500."""
+
+    download_status = 200
+
+    async def get(self, url, **kwargs):
+        if "/slow/" in url:
+            return FakeResponse({"content": [{"provisioningState": "GENERATION_TRIGGERED"}]})
+        if "/broken/" in url:
+            return FakeResponse({"error": "internal"}, status_code=500)
+        return super().get(url, **kwargs)
+
+    async def post(self, url, json=None, **kwargs):
+        if self.download_status != 200:
+            return FakeResponse("unavailable", status_code=self.download_status)
+        return super().post(url, json=json, **kwargs)
+
+
+def test_async_download_polls_devices_concurrently(tmp_path):
+    config = ConfigParameters()
+    config.delay = 0.01
+    config.timeout = 0.2
+    client = FakeAsyncClient({"1": [b"\x01"], "2": [b"\x02"]})
+    statuses = asyncio.run(
+        async_api_utils.download_secure_objects_many(config, ["1", "slow", "broken", "2"], str(tmp_path), client)
+    )
+    assert statuses == {"1": "GENERATION_COMPLETED", "slow": "GENERATION_TRIGGERED", "broken": "STATUS_FAILED",
+                        "2": "GENERATION_COMPLETED"}
+    assert (tmp_path / "Secure_Objects_2.bin").read_bytes() == b"\x02"
+    assert not (tmp_path / "Secure_Objects_slow.bin").exists()
+
+    # the single device download gets its sidecar index too
+    config.device_id = "1"
+    output = str(tmp_path / "Secure_Objects.bin")
+    assert asyncio.run(async_api_utils.download_secure_objects(config, client, output)) == "GENERATION_COMPLETED"
+    assert blob_index.check_blob_file(output, required=True) is None
+
+    client.download_status = 503
+    assert asyncio.run(async_api_utils.download_secure_objects_many(config, ["1"], str(tmp_path), client)) == \
+        {"1": "DOWNLOAD_FAILED"}
+
+
+class AsyncPagedClient(PagedClient):
+    async def get(self, url, params=None):
+        await asyncio.sleep(0)
+        return super().get(url, params)
+
+
+def test_async_requests_share_scheduler_and_device_index_rebuild(tmp_path, monkeypatch):
+    config = ConfigParameters()
+    config.nc12 = "935123456789"
+    client = AsyncPagedClient()
+    index = DeviceGroupIndex(config, path=str(tmp_path / "index.json"))
+
+    async def lookups():
+        return await asyncio.gather(*[index.lookup_many_async(client, ["2-1", f"9-{n}"]) for n in range(8)])
+
+    assert all(groups["2-1"] == "2" for groups in asyncio.run(lookups()))
+    assert client.calls == 5
+
+    # a 429 answer pauses the scheduler shared with the blocking client
+    async_client = async_api_utils.AsyncEL2GOClient("async-scheduler-key")
+    responses = [FakeResponse({}, status_code=429), FakeResponse({"content": []})]
+    responses[0].headers = {"Retry-After": "0.01"}
+    priorities, blocked = [], []
+    monkeypatch.setattr(async_client.scheduler, "acquire", priorities.append)
+    monkeypatch.setattr(async_client.scheduler, "block", blocked.append)
+
+    async def send(method, url, **kwargs):
+        return responses.pop(0)
+
+    monkeypatch.setattr(async_client, "_send", send)
+    assert asyncio.run(async_client.get("http://el2go", priority=PRIORITY_POLL)).status_code == 200
+    assert priorities == [PRIORITY_POLL, PRIORITY_POLL] and blocked == [0.01]
+    assert async_client.scheduler is api_utils.EL2GOClient("async-scheduler-key").scheduler
+    asyncio.run(async_client.close())
+
+
+def test_scheduler_serves_downloads_first_and_coalesces_polls(tmp_path):
+    scheduler = RequestScheduler(rate=20)
+    scheduler.acquire()
+    served = []
+
+    def acquire(name, priority):
+        scheduler.acquire(priority)
+        served.append(name)
+
+    threads = [threading.Thread(target=acquire, args=(f"poll{index}", PRIORITY_POLL)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    threads.append(threading.Thread(target=acquire, args=("download", PRIORITY_DOWNLOAD)))
+    threads[-1].start()
+    for thread in threads:
+        thread.join()
+    assert served == ["download", "poll0", "poll1"]
+
+    calls = []
+    release = threading.Event()
+    single_flight = SingleFlight()
+
+    def query():
+        calls.append(1)
+        release.wait(1)
+        return "GENERATION_COMPLETED"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(single_flight.do("42", query))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["GENERATION_COMPLETED"] * 3 and len(calls) == 1
+
+    # stations share the broker, a 429 seen by one of them pauses the others
+    path = str(tmp_path / "scheduler.sock")
+    with SchedulerBroker(path, rate=100):
+        station = BrokerScheduler(path)
+        station.acquire(PRIORITY_POLL)
+        station.block(0.2)
+        start = time.monotonic()
+        BrokerScheduler(path).acquire(PRIORITY_DOWNLOAD)
+        assert time.monotonic() - start > 0.1
+        station.close()
+    # without a broker the requests are scheduled locally
+    BrokerScheduler(path).acquire()
+
+
+def test_backoff_grows_up_to_maximum():
+    backoff = Backoff(initial=0.5, maximum=2, jitter=0)
+    assert [backoff.next_delay() for _ in range(4)] == [0.5, 1, 2, 2]
+    # <delay>0</delay> doesn't poll in a busy loop
+    assert polling_backoff(0).next_delay() >= DEFAULT_FIRST_DELAY / 2
+
+
+def test_client_retries_after_429(monkeypatch):
+    responses = [FakeResponse({}, status_code=429), FakeResponse({"content": []})]
+    responses[0].headers = {"Retry-After": "0"}
+    client = api_utils.EL2GOClient("retry-key")
+    monkeypatch.setattr(client.session, "request", lambda *args, **kwargs: responses.pop(0))
+    rate_limited = responses[0]
+    assert client.get("http://el2go").status_code == 200
+    assert not responses and rate_limited.closed
+
+
+def test_streamed_apdus_match_full_decode():
+    provisionings = {"1": [b"\x01" * 100, b"\xff\x00"], "22": [bytes(range(256))]}
+    response = FakeClient(provisionings).post("http://el2go", json={"deviceIds": ["1", "22"]})
+    expected = [
+        (str(device["deviceId"]), base64.b64decode(rtp["apdus"]["createApdu"]["apdu"]))
+        for device in response.json() for rtp in device["rtpProvisionings"]
+    ]
+    assert list(stream_apdus(response)) == expected
+
+
+def test_device_without_secure_objects_gets_empty_file(tmp_path):
+    response = FakeResponse([{"deviceId": 5, "rtpProvisionings": []}])
+    output = str(tmp_path / "Secure_Objects.bin")
+    assert write_apdus(stream_secure_objects(response), lambda device_id: output) == {"5": 0}
+    assert open(output, "rb").read() == b""
+    assert blob_index.check_blob_file(output) is None
+
+
+def test_iter_json_array_splits_scalars_across_chunks():
+    assert list(iter_json_array([b" [1", b"23, ", b"\"a\xc3", b"\xa9\"", b" , {}]"])) == [123, "a\u00e9", {}]
+    assert list(iter_json_array([b"[", b" ]"])) == []
+
+    # quotes, escapes and brackets inside strings split at every byte
+    document = ["a\\\"],{", {"k": [1, "],\u00e9", {}], "e": []}, [], -1.5e3, None]
+    content = json.dumps(document).encode("utf-8")
+    assert list(iter_json_array(content[offset:offset + 1] for offset in range(len(content)))) == document
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'[{"a": 1}, {"b": "x']))
+
+
+def test_store_skips_completed_and_detects_tampering(tmp_path, monkeypatch):
+    store = SecureObjectStore(str(tmp_path), "RW61x")
+    assert store.lookup("42") is None
+    entry = store.put("42", b"\x01\x02\x03")
+    assert store.lookup("42") == entry
+    assert list(store.completed_devices()) == ["42"]
+    assert SecureObjectStore(str(tmp_path), "IMX8").lookup("42") is None
+
+    with open(store.blob_path("42"), "wb") as f:
+        f.write(b"\x01\x02\x04")
+    assert store.lookup("42") is None
+
+    # a blob checked once is not hashed again while it is unchanged, the index is read again only
+    # once it has grown
+    entry = store.put("42", b"\x05")
+    past = time.time() - 10
+    os.utime(store.blob_path("42"), (past, past))
+    assert store.lookup("42") == entry
+    hashed = []
+    monkeypatch.setattr(store_module, "file_sha256", lambda path: hashed.append(path) or "")
+    assert store.lookup("42") == entry and not hashed
+    assert store.entries["42"] == entry
+    other_station = SecureObjectStore(str(tmp_path), "RW61x")
+    with open(other_station.blob_path("43"), "wb") as f:
+        f.write(b"\x00\x00")
+    other_station.add("43", "ab", 2)
+    assert store.lookup("43") is None and hashed and store.entries["43"]["sha256"] == "ab"
+
+
+def test_cache_evicts_by_age_and_size(tmp_path):
+    cache = ProvisioningCache(str(tmp_path / "cache"), max_age=60, max_size=10)
+    blob = tmp_path / "blob.bin"
+    blob.write_bytes(b"\x00" * 6)
+    cache.put("49", "1", str(blob))
+    assert cache.get("49", "1", str(tmp_path / "out.bin"))
+    assert (tmp_path / "out.bin").read_bytes() == b"\x00" * 6
+    assert not cache.get("50", "1", str(tmp_path / "out.bin"))
+
+    # the second entry does not fit next to the first, the least recently used one goes
+    cache.put("49", "2", str(blob))
+    assert not cache.get("49", "1", str(tmp_path / "out.bin"))
+    assert cache.get("49", "2", str(tmp_path / "out.bin"))
+
+    cache.max_age = -1
+    assert not cache.get("49", "2", str(tmp_path / "out.bin"))
+    cache.evict()
+    assert not os.listdir(tmp_path / "cache" / "49")
+
+
+class FakeInterface:
+    pass
+
+
+class FakeFuseMboot:
+    """Answers flash-read-once and read-memory from a fixed set of fuse words."""
+
+    status_string = "Success"
+
+    def __init__(self, fuses):
+        self._interface = FakeInterface()
+        self.fuses = fuses
+        self.commands = 0
+
+    def efuse_read_once(self, index):
+        self.commands += 1
+        return self.fuses[index]
+
+    def read_memory(self, address, length):
+        self.commands += 1
+        return b"".join(self.fuses[index].to_bytes(4, "little") for index in sorted(self.fuses))[:length]
+
+
+def test_read_device_id_matches_fuse_string():
+    fuses = {46: 0x12345678, 47: 0x9ABCDEF0, 48: 0x0, 49: 0xDEADBEEF}
+    expected = str(int("".join(str_little_endian(fuses[index]) for index in range(46, 50)), 16))
+    config = ConfigParameters()
+    config.uuid_fuse_start = 46
+    config.uuid_fuse_end = 49
+
+    mboot = FakeFuseMboot(fuses)
+    assert el2go_tp_app.read_device_id(mboot, config) == expected
+    assert mboot.commands == 4
+
+    config.uuid_memory_address = 0x40130000
+    mboot = FakeFuseMboot(fuses)
+    assert el2go_tp_app.read_device_id(mboot, config) == expected
+    assert mboot.commands == 1
+
+
+def test_uuid_is_read_again_after_board_swap_in_session():
+    config = ConfigParameters()
+    config.uuid_fuse_start = 46
+    config.uuid_fuse_end = 49
+    interface = session.PersistentInterface(simulator.SimulatedInterface(uuid=1))
+    with el2go_tp_app.EL2GOMboot(interface) as mboot:
+        assert el2go_tp_app.read_device_id(mboot, config) == "1"
+
+    # another board on the same port, the interface itself stays opened between session commands
+    interface.uuid = 2
+    assert interface.is_opened
+    with el2go_tp_app.EL2GOMboot(interface) as mboot:
+        assert el2go_tp_app.read_device_id(mboot, config) == "2"
+    assert interface.commands == ["fuse"] * 8
+
+
+class FakeEL2GOMboot(FakeFuseMboot):
+    """Provisioning firmware which accepts every blob written to it."""
+
+    status_code = 0
+
+    def __init__(self, fuses):
+        super().__init__(fuses)
+        self.memory = {}
+
+    def el2go_get_version(self):
+        return [0x010203]
+
+    def write_memory(self, address, data):
+        self.memory[address] = bytes(data)
+        return True
+
+    def write_secure_objects(self, address, chunks):
+        return self.write_memory(address, b"".join(chunks))
+
+    def close_device(self, address, dry_run=False):
+        return [0x5A5A5A5A] if self.memory.get(address) else [0x1]
+
+
+def test_pipeline_provisions_from_background_download(tmp_path, monkeypatch):
+    def fake_download(config, output, cache=None, refresh=False, apdus=None, journal=None, cancel=None):
+        with open(output, "wb") as f:
+            f.write(b"\xaa\xbb")
+        apdus += [b"\xaa", b"\xbb"]
+        return "GENERATION_COMPLETED"
+
+    monkeypatch.setattr(pipeline, "get_device_secure_objects", fake_download)
+    config = ConfigParameters()
+    config.uuid_fuse_start = 46
+    config.uuid_fuse_end = 46
+    mboot = FakeEL2GOMboot({46: 0x01000000})
+    result = pipeline.provision(mboot, config, 0x20000000, False, "fake", str(tmp_path))
+    assert result.success, result.message
+    assert result.device_id == "1"
+    assert mboot.memory[0x20000000] == b"\xaa\xbb"
+    assert SecureObjectStore(str(tmp_path), "").lookup("1")
+
+    # a board without a responsive firmware fails at once, the background polling is cancelled
+    stopped = threading.Event()
+
+    def polling_download(config, output, cache=None, refresh=False, apdus=None, journal=None, cancel=None):
+        if cancel.wait(5):
+            stopped.set()
+        return "CANCELLED"
+
+    monkeypatch.setattr(pipeline, "get_device_secure_objects", polling_download)
+    monkeypatch.setattr(mboot, "el2go_get_version", lambda: None)
+    mboot.status_code = el2go_tp_app.StatusCode.NO_RESPONSE
+    result = pipeline.provision(mboot, config, 0x20000000, False, "fake", str(tmp_path / "other"))
+    assert not result.success and "not responding" in result.message
+    assert stopped.wait(1)
+
+
+def test_provision_batch_on_simulated_boards(tmp_path, monkeypatch):
+    # blobs are written to the working directory without a store
+    monkeypatch.chdir(tmp_path)
+    backend = MockBackend(payload_size=64)
+    with MockEL2GOServer(backend) as server:
+        config_file = tmp_path / "config.xml"
+        config_file.write_text(CONFIG_XML.replace("http://127.0.0.1:1/api/v1", server.url))
+        runner = CliRunner()
+        result = runner.invoke(cli.main, [
+            "--json", "provision-batch", str(config_file), "0x20000000",
+            "--sim", "uuid=0x11", "--sim", "uuid=0x22,provision_fail_rate=1",
+        ])
+    assert result.exit_code == 0, result.output
+    # the configuration parser prints the location of the file before the JSON document
+    output, _ = json.JSONDecoder().raw_decode(result.stdout[result.stdout.index("["):])
+    results = {item["device_id"]: item for item in output}
+    assert results["17"]["success"], results["17"]["message"]
+    assert not results["34"]["success"]
+
+
+def test_el2go_commands_are_retried_by_policy():
+    policy = el2go_tp_app.CommandPolicy(retries=2)
+    # a damaged answer may belong to a command the firmware has run
+    assert not policy.should_retry(el2go_tp_app.StatusCode.PACKETIZER_INVALID_CRC)
+    assert not policy.should_retry(el2go_tp_app.StatusCode.NO_RESPONSE)
+    assert el2go_tp_app.CommandPolicy(idempotent=True).should_retry(el2go_tp_app.StatusCode.TP_PACKET_ERROR)
+    assert not el2go_tp_app.CommandPolicy(idempotent=True).should_retry(el2go_tp_app.StatusCode.FAIL)
+
+    interface = simulator.SimulatedInterface(version_timeouts=2, provision_timeouts=1)
+    interface.memory[0x20000000] = b"\x01"
+    with el2go_tp_app.EL2GOMboot(interface) as mboot:
+        assert mboot.el2go_get_version() == [simulator.SIM_FW_VERSION]
+        assert mboot.attempts == 3
+        # a lost answer of a real provisioning is not sent again, fuses may already be burned
+        assert mboot.close_device(0x20000000) is None
+        assert mboot.attempts == 1 and mboot.status_code == el2go_tp_app.StatusCode.NO_RESPONSE
+        # a dry run is
+        interface.overrides["provision_timeouts"] = 2
+        assert mboot.close_device(0x20000000, dry_run=True) == [simulator.SIM_PROV_SUCCESS]
+        assert mboot.attempts == 2
+        # the ACK of a written command getting lost does not make it safe to send it again
+        write_command = interface.write_command
+
+        def lost_ack_write_command(packet):
+            write_command(packet)
+            raise TimeoutError("no ACK")
+
+        interface.write_command = lost_ack_write_command
+        assert mboot.close_device(0x20000000) is None
+        assert mboot.attempts == 1 and mboot.status_code == el2go_tp_app.StatusCode.NO_RESPONSE
+        interface.write_command = write_command
+    assert interface.commands == ["version"] * 3 + ["provision"] * 4
+
+    # the version timeout never exceeds the one the interface was opened with, e.g. --probe-timeout
+    class Device:
+        timeout = 200
+
+    interface = simulator.SimulatedInterface()
+    interface.device, write_command, timeouts = Device(), interface.write_command, []
+    interface.write_command = lambda packet: timeouts.append(interface.device.timeout) or write_command(packet)
+    with el2go_tp_app.EL2GOMboot(interface) as mboot:
+        mboot.el2go_get_version()
+    with el2go_tp_app.EL2GOMboot(interface, command_timeouts={el2go_tp_app.EL2GO_TP_GET_FW_VERSION_CMD: 50}) as mboot:
+        mboot.el2go_get_version()
+    assert timeouts == [200, 50] and interface.device.timeout == 200
+    assert el2go_tp_app.EL2GOMboot(interface).command_policies == el2go_tp_app.DEFAULT_COMMAND_POLICIES
+
+
+def test_probe_rejects_boards_before_api_calls(tmp_path, monkeypatch):
+    runner = CliRunner()
+    result = runner.invoke(cli.main, [
+        "--json", "probe", "--sim", "uuid=1", "--sim", "uuid=2,version_fail_rate=1",
+        "--sim", "uuid=3,fw_version=0x02000000", "--fw-version", hex(simulator.SIM_FW_VERSION),
+    ])
+    assert result.exit_code == 0, result.output
+    # stderr is mixed into the output before Click 8.2, the JSON document comes first
+    results, _ = json.JSONDecoder().raw_decode(result.stdout)
+    assert [item["ready"] for item in results] == [True, False, False]
+    assert results[0]["bootloader_version"] == "K3.1.0"
+    assert "0x2000000" in results[2]["message"]
+
+    backend = MockBackend()
+    with MockEL2GOServer(backend) as server:
+        config = benchmark.benchmark_config(server.url)
+        dead = {"plugin": simulator.sim_plugin("uuid=4,property_timeout_rate=1")}
+        device_result = batch.provision_device(dead, config, 0x20000000, False, 5000, str(tmp_path), probe_timeout=100)
+    assert not device_result.success and "probe" in device_result.message
+    assert backend.requests == 0
+
+    # --version-timeout reaches the probe as well
+    timeouts = []
+    monkeypatch.setattr(batch, "EL2GOMboot", lambda interface, command_timeouts=None: timeouts.append(
+        command_timeouts) or el2go_tp_app.EL2GOMboot(interface, command_timeouts=command_timeouts))
+    result = CliRunner().invoke(cli.main, ["--version-timeout", "50", "probe", "--sim", "uuid=1"])
+    assert result.exit_code == 0, result.output
+    assert timeouts == [{el2go_tp_app.EL2GO_TP_GET_FW_VERSION_CMD: 50}]
+
+
+def test_watcher_provisions_each_attached_board_once(tmp_path, monkeypatch):
+    scans = [["a"], ["a", "b"], ["b"], ["a", "b"]]
+    running, peak, seen = [], [], []
+
+    def provision(interface_args):
+        running.append(interface_args["port"])
+        peak.append(len(running))
+        time.sleep(0.02)
+        running.remove(interface_args["port"])
+        return pipeline.DeviceResult(interface=interface_args["port"], success=True)
+
+    board_watcher = watcher.BoardWatcher(lambda: [{"port": port} for port in (scans.pop(0) if scans else [])],
+                                         provision, workers=1, interval=0.01)
+    assert board_watcher.run(lambda result: seen.append(result.interface), max_boards=3) == 3
+    assert sorted(seen) == ["a", "a", "b"] and max(peak) == 1
+
+    monkeypatch.chdir(tmp_path)
+    backend = MockBackend(payload_size=32)
+    with MockEL2GOServer(backend) as server:
+        config_file = tmp_path / "config.xml"
+        config_file.write_text(CONFIG_XML.replace("http://127.0.0.1:1/api/v1", server.url))
+        result = CliRunner().invoke(cli.main, [
+            "--json", "watch", str(config_file), "0x20000000", "--no-usb", "--sim", "uuid=5", "-n", "1", "-i", "0.01",
+        ])
+    assert result.exit_code == 0, result.output
+    output, _ = json.JSONDecoder().raw_decode(result.stdout[result.stdout.index("{"):])
+    assert output["success"] and output["device_id"] == "5"
+
+
+def test_simulated_board_answers_el2go_commands():
+    interface = simulator.SimulatedInterface(uuid=0x0123456789ABCDEF, fuse_address=0x40130000)
+    config = ConfigParameters()
+    config.uuid_fuse_start = 46
+    config.uuid_fuse_end = 49
+    with el2go_tp_app.EL2GOMboot(interface) as mboot:
+        assert el2go_tp_app.read_device_id(mboot, config) == str(0x0123456789ABCDEF)
+        assert mboot.el2go_get_version() == [simulator.SIM_FW_VERSION]
+        assert mboot.close_device(0x20000000) == [simulator.SIM_PROV_FAILURE]
+        assert mboot.write_memory(0x20000000, b"\x01" * 10)
+        assert mboot.close_device(0x20000000) == [simulator.SIM_PROV_SUCCESS]
+        chunks = [memoryview(b"\x01\x02"), bytearray(b"\x03"), b"\x04"]
+        assert mboot.provision_secure_objects(0x20001000, chunks) == [simulator.SIM_PROV_SUCCESS]
+    assert interface.memory[0x20001000] == b"\x01\x02\x03\x04"
+    assert interface.commands == ["fuse"] * 4 + ["version", "provision", "write", "provision", "write", "provision"]
+
+    interface = simulator.SimulatedInterface(version_timeout_rate=1)
+    with el2go_tp_app.EL2GOMboot(interface) as mboot:
+        assert mboot.el2go_get_version() is None
+        assert mboot.status_code == el2go_tp_app.EL2GOStatus.NO_RESPONSE
+
+
+def test_journal_resumes_interrupted_provisioning(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    backend = MockBackend(payload_size=32)
+    journal = ProvisioningJournal(str(tmp_path / "journal.jsonl"))
+    with MockEL2GOServer(backend) as server:
+        config = benchmark.benchmark_config(server.url, timeout=10)
+        config.uuid_fuse_start = 46
+        config.uuid_fuse_end = 49
+        with el2go_tp_app.EL2GOMboot(simulator.SimulatedInterface(uuid=153, provision_fail_rate=1)) as mboot:
+            assert not pipeline.provision(mboot, config, 0x20000000, False, journal=journal).success
+        assert journal.last_stage("153") == "written"
+        # without a store the blob only goes to the cache, the working directory stays clean
+        assert not list(tmp_path.glob("Secure_Objects_*"))
+
+        # the cache is gone as well, assign and generation polling are not repeated
+        shutil.rmtree(os.path.join(os.environ["EL2GO_TP_APP_HOME"], "cache"))
+        requests = backend.requests
+        with el2go_tp_app.EL2GOMboot(simulator.SimulatedInterface(uuid=153)) as mboot:
+            assert pipeline.provision(mboot, config, 0x20000000, False, journal=journal).success
+        assert backend.requests == requests + 1
+
+    journal = ProvisioningJournal(journal.path)
+    assert journal.last_stage("153") == "provisioned"
+    board = simulator.SimulatedInterface(uuid=153)
+    with el2go_tp_app.EL2GOMboot(board) as mboot:
+        result = pipeline.provision(mboot, config, 0x20000000, False, journal=journal)
+    assert result.success and "already" in result.message
+    assert "write" not in board.commands
+    assert journal.summary()["stages"]["provisioned"] == 1
+
+    # records of another station are kept by compaction, assignments expire
+    other_station = ProvisioningJournal(journal.path)
+    other_station.record("154", "assigned", device_group_id="7")
+    assert other_station.is_done("154", "assigned", max_age=config.index_ttl, device_group_id="7")
+    journal.compact()
+    assert ProvisioningJournal(journal.path).last_stage("154") == "assigned"
+    monkeypatch.setattr(time, "time", lambda: journal.devices["154"]["time"] + 11)
+    assert journal.is_done("154", "assigned", device_group_id="7")
+    assert not journal.is_done("154", "assigned", max_age=10, device_group_id="7")
+    assert journal.is_done("153", "provisioned")
+
+
+class CountingInterface:
+    def __init__(self):
+        self.is_opened = False
+        self.opens = 0
+
+    def open(self):
+        self.opens += 1
+        self.is_opened = True
+
+    def close(self):
+        self.is_opened = False
+
+
+def test_session_keeps_interface_open_across_commands():
+    interface = session.PersistentInterface(CountingInterface())
+
+    @click.group()
+    def group():
+        pass
+
+    @group.command()
+    @click.pass_context
+    def touch(ctx):
+        interface = ctx.obj["interface"]
+        interface.open()
+        click.echo(f"opens={interface.opens}")
+        interface.close()
+
+    output = io.StringIO()
+    lines = ["touch", "touch", "unknown", "exit", "touch"]
+    assert not session.serve_lines(group, {"interface": interface}, lines, output)
+    assert output.getvalue().split("\n")[:4] == ["opens=1", "END", "opens=1", "END"]
+    assert "Unknown command 'unknown'" in output.getvalue()
+    assert interface.is_opened
+
+    # a client disconnecting while a command prints ends only its own connection
+    class BrokenWriter(io.StringIO):
+        def write(self, text):
+            raise BrokenPipeError("client gone")
+
+    class FakeConnection:
+        def __init__(self, lines, writer):
+            self.files = {"r": io.StringIO(lines), "w": writer}
+
+        def makefile(self, mode):
+            return self.files[mode]
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    class FakeServer:
+        connections = [FakeConnection("touch\n", BrokenWriter()), FakeConnection("touch\nexit\n", io.StringIO())]
+
+        def accept(self):
+            return self.connections.pop(0), None
+
+    server = FakeServer()
+    session.serve_socket(group, {"interface": interface}, server)
+    assert not server.connections
+    interface.shutdown()
+    assert not interface.is_opened
+
+
+# Seconds `import el2go_tp_app.cli` may take, the station runs the CLI several times per board
+IMPORT_TIME_BUDGET = 0.5
+HEAVY_MODULES = ["requests", "spsdk.mboot.mcuboot", "spsdk.mboot.scanner", "xml.etree.ElementTree"]
+
 
+def test_cli_import_is_lazy_and_within_budget():
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import el2go_tp_app.cli\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps([elapsed, [name for name in {HEAVY_MODULES!r} if name in sys.modules]]))\n"
+    )
+    # best of three runs, the first one may pay for a cold disk cache
+    runs = [json.loads(subprocess.check_output([sys.executable, "-c", code])) for _ in range(3)]
+    assert all(not loaded for _, loaded in runs), runs
+    assert min(elapsed for elapsed, _ in runs) < IMPORT_TIME_BUDGET